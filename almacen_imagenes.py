@@ -0,0 +1,112 @@
+# Almacén de imágenes direccionado por contenido: CARPETA_IMAGENES/ab/cd/<sha256>.<ext>
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from configuracion import CARPETA_IMAGENES, SUBIDA_MAX_BYTES, SUBIDA_TAMANO_BLOQUE
+
+FIRMAS = ((b"\xff\xd8\xff", ".jpg"), (b"\x89PNG\r\n\x1a\n", ".png"), (b"GIF8", ".gif"), (b"BM", ".bmp"))
+PATRON_CLAVE = re.compile(r"[0-9a-f]{64}")
+
+class ImagenDemasiadoGrandeError(Exception):
+    """La subida supera el tamaño máximo permitido"""
+
+class ImagenInvalidaError(Exception):
+    """La subida no es una imagen que se pueda decodificar"""
+
+def extension_de(cabecera):
+    """Extensión según los primeros bytes del archivo"""
+    if cabecera[:4] == b"RIFF" and cabecera[8:12] == b"WEBP": return ".webp"
+    for firma, extension in FIRMAS:
+        if cabecera.startswith(firma): return extension
+    return ".bin"
+
+class AlmacenImagenes:
+    def __init__(self, carpeta=CARPETA_IMAGENES, max_bytes=SUBIDA_MAX_BYTES, tamano_bloque=SUBIDA_TAMANO_BLOQUE):
+        """
+        Guarda cada imagen una sola vez, con el SHA256 de su contenido como nombre
+        Dos niveles de subcarpetas (primeros 4 caracteres del hash) mantienen pequeños los directorios.
+        """
+        self.carpeta = carpeta
+        self.max_bytes = max_bytes
+        self.tamano_bloque = tamano_bloque
+        self._temporales = os.path.join(carpeta, ".tmp")
+        os.makedirs(self._temporales, exist_ok=True)
+        self._lock = threading.Lock()
+        self._guardadas = 0
+        self._duplicadas = 0
+        self._rechazadas = 0
+        self._invalidas = 0
+        self._bytes_escritos = 0
+
+    def ruta_de(self, clave, extension):
+        return os.path.join(self.carpeta, clave[:2], clave[2:4], clave + extension)
+
+    def guardar(self, origen, validar=None):
+        """
+        Copia un archivo abierto (p. ej. UploadFile.file) al almacén por bloques, calculando el hash al vuelo
+        validar: función opcional con la ruta del temporal ya escrito; si lanza, la subida no llega al almacén
+        Retorna {"ruta", "clave", "tamano", "duplicada"}; lanza ImagenDemasiadoGrandeError si supera max_bytes
+        e ImagenInvalidaError si no pasa `validar`.
+        Bloqueante: desde el event loop se llama con run_in_threadpool.
+        """
+        hash_contenido = hashlib.sha256()
+        tamano = 0
+        cabecera = b""
+        fd, temporal = tempfile.mkstemp(dir=self._temporales)
+        try:
+            with os.fdopen(fd, "wb") as destino:
+                while True:
+                    bloque = origen.read(self.tamano_bloque)
+                    if not bloque: break
+                    tamano += len(bloque)
+                    if tamano > self.max_bytes:
+                        with self._lock: self._rechazadas += 1
+                        raise ImagenDemasiadoGrandeError(f"La imagen supera el máximo de {self.max_bytes // 1024} KB")
+                    if len(cabecera) < 12: cabecera += bloque[:12]
+                    hash_contenido.update(bloque)
+                    destino.write(bloque)
+            if validar is not None:
+                try: validar(temporal)
+                except Exception as e:
+                    with self._lock: self._invalidas += 1
+                    raise ImagenInvalidaError("El archivo no es una imagen válida") from e
+            clave = hash_contenido.hexdigest()
+            ruta = self.ruta_de(clave, extension_de(cabecera))
+            duplicada = os.path.exists(ruta)
+            if duplicada:
+                os.remove(temporal)
+            else:
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                os.replace(temporal, ruta)  # atómico: nunca queda a la vista un archivo a medio escribir
+        except BaseException:
+            if os.path.exists(temporal): os.remove(temporal)
+            raise
+        with self._lock:
+            if duplicada: self._duplicadas += 1
+            else:
+                self._guardadas += 1
+                self._bytes_escritos += tamano
+        return {"ruta": ruta, "clave": clave, "tamano": tamano, "duplicada": duplicada}
+
+    @staticmethod
+    def clave_de(ruta):
+        """Hash de contenido de una imagen guardada; las rutas antiguas (escaneo_*.jpg) se leen y se hashean"""
+        nombre = os.path.splitext(os.path.basename(ruta))[0]
+        if PATRON_CLAVE.fullmatch(nombre): return nombre
+        hash_contenido = hashlib.sha256()
+        with open(ruta, "rb") as f:
+            for bloque in iter(lambda: f.read(SUBIDA_TAMANO_BLOQUE), b""): hash_contenido.update(bloque)
+        return hash_contenido.hexdigest()
+
+    def metricas(self):
+        with self._lock:
+            return {
+                "guardadas": self._guardadas,
+                "duplicadas": self._duplicadas,
+                "rechazadas_tamano": self._rechazadas,
+                "rechazadas_invalidas": self._invalidas,
+                "bytes_escritos": self._bytes_escritos,
+                "max_bytes": self.max_bytes
+            }
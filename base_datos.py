@@ -1,39 +1,564 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from psycopg2.extensions import parse_dsn, TRANSACTION_STATUS_IDLE
+from contextlib import contextmanager
+import base64
+import csv
+from datetime import datetime, timedelta
 import hashlib
 import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from metricas import espera_conexion, consultas_db, acumular_en_peticion
+from configuracion import (POOL_MIN_CONEXIONES, POOL_MAX_CONEXIONES, POOL_TIMEOUT_ESPERA, POOL_MAX_INACTIVIDAD,
+                           HISTORIAL_FILAS_POR_LOTE, ADMIN_USUARIO, ADMIN_CONTRASENA, NOMBRE_BASE_DATOS,
+                           HISTORIAL_RETENCION_MESES, HISTORIAL_RETENCION_DESACOPLAR, HISTORIAL_PURGA_LOTE)
+
+# Subir cada vez que cambie _crear_esquema: los procesos con el esquema al día no ejecutan DDL
+VERSION_ESQUEMA = 6  # 6: recrea los índices del historial que la migración a la 5 dejaba sin crear
+INDICES_HISTORIAL = ("idx_historial_usuario", "idx_historial_fecha", "idx_historial_usuario_fecha_id", "idx_historial_fecha_id")
+CLAVE_BLOQUEO_ESQUEMA = 72104151  # clave de pg_advisory_xact_lock para la inicialización
+CLAVE_BLOQUEO_PARTICIONES = 72104152  # serializa la creación y el retiro de particiones del historial
+MESES_ADELANTADOS = 1  # particiones creadas por adelantado además de la del mes en curso
+
+def mes_de(fecha):
+    """Inicio del mes de `fecha` (datetime a las 00:00 del día 1)"""
+    return datetime(fecha.year, fecha.month, 1)
+
+def sumar_meses(mes, meses):
+    indice = mes.year * 12 + mes.month - 1 + meses
+    return datetime(indice // 12, indice % 12 + 1, 1)
+
+def nombre_particion(mes):
+    return f"historial_escaneos_{mes:%Y_%m}"
+
+def codificar_cursor(fecha_escaneo, escaneo_id):
+    """Cursor opaco de paginación a partir de (fecha_escaneo, id)"""
+    return base64.urlsafe_b64encode(f"{fecha_escaneo.isoformat()}|{escaneo_id}".encode()).decode().rstrip("=")
+
+def decodificar_cursor(cursor):
+    """Retorna (fecha_escaneo, id); lanza ValueError si el cursor no es válido"""
+    try:
+        texto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        fecha, escaneo_id = texto.split("|")
+        return datetime.fromisoformat(fecha), int(escaneo_id)
+    except Exception:
+        raise ValueError("Cursor de paginación inválido")
+
+# Columnas de la exportación e importación masiva del historial, en este orden
+COLUMNAS_HISTORIAL = ("id", "usuario_id", "nombre_usuario", "ruta_imagen", "resultado", "confianza", "fecha_escaneo")
+
+def verificar_cabecera_csv(linea):
+    """Lanza ValueError si la primera línea (bytes) de un CSV a importar no trae las columnas de la exportación"""
+    if tuple(next(csv.reader([linea.decode("utf-8-sig")]), ())) != COLUMNAS_HISTORIAL:
+        raise ValueError(f"El CSV debe empezar con la cabecera {','.join(COLUMNAS_HISTORIAL)}")
+
+class _SalidaCopia:
+    """Destino de copy_expert: junta lo que escribe COPY (una llamada por fila) en bloques para la cola"""
+    def __init__(self, cola, tamano_bloque):
+        self.cola = cola
+        self.tamano_bloque = tamano_bloque
+        self._partes = []
+        self._tamano = 0
+
+    def write(self, datos):
+        self._partes.append(datos)
+        self._tamano += len(datos)
+        if self._tamano >= self.tamano_bloque: self.vaciar()
+
+    def vaciar(self):
+        if not self._partes: return
+        self.cola.put(b"".join(self._partes))
+        self._partes, self._tamano = [], 0
+
+def transmitir_copia(conexion, copiar, tamano_bloque=64 * 1024, bloques_en_vuelo=8):
+    """
+    Ejecuta `copiar(destino)` (un COPY ... TO STDOUT) en un hilo y entrega lo copiado en bloques de bytes
+    La cola acotada frena a COPY cuando el cliente lee más despacio: la memoria no depende del tamaño de la exportación.
+    Si se deja de leer antes del final, el COPY se cancela en el servidor.
+    """
+    cola = queue.Queue(maxsize=bloques_en_vuelo)
+    fin = object()
+    errores = []
+
+    def producir():
+        try:
+            destino = _SalidaCopia(cola, tamano_bloque)
+            copiar(destino)
+            destino.vaciar()
+        except BaseException as e:
+            errores.append(e)
+        finally:
+            cola.put(fin)
+
+    hilo = threading.Thread(target=producir, name="copia-historial", daemon=True)
+    hilo.start()
+    completo = False
+    try:
+        while (bloque := cola.get()) is not fin:
+            yield bloque
+        completo = True
+    finally:
+        if not completo:
+            conexion.cancel()
+            while cola.get() is not fin: pass
+        hilo.join()
+    if errores: raise errores[0]
+
+OPERACIONES_SQL = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+def registrar_consulta(consulta, segundos):
+    """Histograma por tipo de sentencia y tiempo de base de datos de la petición en curso"""
+    if isinstance(consulta, bytes): consulta = consulta[:16].decode(errors="ignore")
+    palabra = str(consulta).lstrip()[:6].upper()
+    consultas_db.observar(segundos, palabra if palabra in OPERACIONES_SQL else "OTRA")
+    acumular_en_peticion("db", segundos)
+
+_cursores_medidos = {}
+
+def cursor_medido(base):
+    """Subclase de la clase de cursor `base` que mide cada execute (cacheada por clase)"""
+    clase = _cursores_medidos.get(base)
+    if clase is None:
+        class clase(base):
+            def execute(self, consulta, parametros=None):
+                inicio = time.perf_counter()
+                try: return super().execute(consulta, parametros)
+                finally: registrar_consulta(consulta, time.perf_counter() - inicio)
+
+            def executemany(self, consulta, lista_parametros):
+                inicio = time.perf_counter()
+                try: return super().executemany(consulta, lista_parametros)
+                finally: registrar_consulta(consulta, time.perf_counter() - inicio)
+        _cursores_medidos[base] = clase
+    return clase
+
+class ConexionMedida(psycopg2.extensions.connection):
+    """Conexión cuyos cursores (de cualquier cursor_factory, incluidos los con nombre) miden sus consultas"""
+    def cursor(self, *args, **kwargs):
+        kwargs["cursor_factory"] = cursor_medido(kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor)
+        return super().cursor(*args, **kwargs)
+
+class PoolAgotadoError(Exception):
+    """No se obtuvo una conexión libre dentro del tiempo de espera"""
+
+class PoolConexiones:
+    def __init__(self, connection_string, minimo=POOL_MIN_CONEXIONES, maximo=POOL_MAX_CONEXIONES,
+                 timeout=POOL_TIMEOUT_ESPERA, max_inactividad=POOL_MAX_INACTIVIDAD):
+        """
+        Pool acotado y thread-safe de conexiones PostgreSQL
+        minimo: conexiones que se abren al arrancar
+        maximo: conexiones abiertas como máximo (en uso + libres)
+        timeout: segundos que se espera por una conexión libre
+        max_inactividad: segundos inactiva tras los que se valida con SELECT 1
+        """
+        self.connection_string = connection_string
+        self.maximo = max(1, maximo)
+        self.timeout = timeout
+        self.max_inactividad = max_inactividad
+        self._parametros = parse_dsn(connection_string)
+        self._condicion = threading.Condition()
+        self._libres = []  # (conexion, momento en que se devolvió)
+        self._total = 0
+        self._en_uso = 0
+        self._esperando = 0
+        self._cerrado = False
+        self._checkouts = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+        self._timeouts = 0
+        self._descartadas = 0
+        for _ in range(min(minimo, self.maximo)):
+            self._total += 1
+            self._libres.append((self._crear_conexion(), time.monotonic()))
+
+    def _crear_conexion(self):
+        """Abre una conexión nueva prefiriendo IPv4 sin modificar socket.getaddrinfo global"""
+        extra = {}
+        host = self._parametros.get("host")
+        if host and "hostaddr" not in self._parametros and "," not in host and not host.startswith("/"):
+            try:
+                puerto = int(self._parametros.get("port") or 5432)
+                direcciones = socket.getaddrinfo(host, puerto, socket.AF_INET, socket.SOCK_STREAM)
+                if direcciones:
+                    # libpq conecta a hostaddr y sigue usando host para TLS
+                    extra["hostaddr"] = direcciones[0][4][0]
+            except (socket.gaierror, ValueError):
+                pass
+        return psycopg2.connect(self.connection_string, connection_factory=ConexionMedida, **extra)
+
+    def _esta_sana(self, conexion, devuelta):
+        """Comprueba que una conexión del pool sigue viva antes de entregarla"""
+        if conexion.closed:
+            return False
+        if time.monotonic() - devuelta < self.max_inactividad:
+            return True
+        try:
+            with conexion.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conexion.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _cerrar_silencioso(self, conexion):
+        try:
+            conexion.close()
+        except Exception:
+            pass
+
+    def obtener(self):
+        """Saca una conexión del pool, esperando como máximo `timeout` segundos"""
+        inicio = time.monotonic()
+        limite = inicio + self.timeout
+        conexion, devuelta = None, None
+        with self._condicion:
+            self._esperando += 1
+            try:
+                while True:
+                    if self._cerrado:
+                        raise PoolAgotadoError("El pool de conexiones está cerrado")
+                    if self._libres:
+                        conexion, devuelta = self._libres.pop()
+                        break
+                    if self._total < self.maximo:
+                        self._total += 1
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._timeouts += 1
+                        raise PoolAgotadoError(f"Sin conexiones libres tras {self.timeout}s")
+                    self._condicion.wait(restante)
+            finally:
+                self._esperando -= 1
+            espera = time.monotonic() - inicio
+            self._en_uso += 1
+            self._checkouts += 1
+            self._espera_total += espera
+            self._espera_max = max(self._espera_max, espera)
+
+        try:
+            if conexion is not None and not self._esta_sana(conexion, devuelta):
+                self._cerrar_silencioso(conexion)
+                with self._condicion:
+                    self._descartadas += 1
+                conexion = None
+            if conexion is None:
+                conexion = self._crear_conexion()
+            # Incluye la espera por una conexión libre, la validación y, si hizo falta, la conexión nueva
+            segundos = time.monotonic() - inicio
+            espera_conexion.observar(segundos)
+            acumular_en_peticion("db_conexion", segundos)
+            return conexion
+        except Exception:
+            with self._condicion:
+                self._total -= 1
+                self._en_uso -= 1
+                self._condicion.notify()
+            raise
+
+    def devolver(self, conexion, descartar=False):
+        """Devuelve una conexión al pool; las rotas o cerradas se descartan"""
+        if not descartar:
+            try:
+                if conexion.closed:
+                    descartar = True
+                elif conexion.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conexion.rollback()
+            except psycopg2.Error:
+                descartar = True
+        with self._condicion:
+            self._en_uso -= 1
+            if descartar or self._cerrado:
+                self._total -= 1
+                if descartar:
+                    self._descartadas += 1
+            else:
+                self._libres.append((conexion, time.monotonic()))
+                conexion = None
+            self._condicion.notify()
+        if conexion is not None:
+            self._cerrar_silencioso(conexion)
+
+    @contextmanager
+    def conexion(self):
+        """Context manager: `with pool.conexion() as c:` presta una conexión y la devuelve al salir"""
+        conexion = self.obtener()
+        try:
+            yield conexion
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.devolver(conexion, descartar=True)
+            raise
+        except BaseException:
+            self.devolver(conexion)
+            raise
+        else:
+            self.devolver(conexion)
+
+    def metricas(self):
+        """Estado actual del pool y tiempos de espera acumulados"""
+        with self._condicion:
+            return {
+                "total": self._total,
+                "libres": len(self._libres),
+                "en_uso": self._en_uso,
+                "esperando": self._esperando,
+                "maximo": self.maximo,
+                "checkouts": self._checkouts,
+                "espera_promedio_ms": round(self._espera_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "espera_max_ms": round(self._espera_max * 1000, 3),
+                "timeouts": self._timeouts,
+                "descartadas": self._descartadas
+            }
+
+    def cerrar(self):
+        """Cierra las conexiones libres; las que están en uso se cierran al devolverse"""
+        with self._condicion:
+            self._cerrado = True
+            libres, self._libres = self._libres, []
+            self._total -= len(libres)
+            self._condicion.notify_all()
+        for conexion, _ in libres:
+            self._cerrar_silencioso(conexion)
 
 class BaseDatos:
-    def __init__(self, connection_string=None):
+    """
+    Interfaz de almacenamiento: usuarios, escaneos, historial, estadísticas, cola de trabajos y caché
+    Los métodos retornan dicts {"exito": ..., "mensaje": ...} como el resto de la API.
+    Implementaciones: BaseDatosPostgres (este módulo) y BaseDatosSQLite (base_datos_sqlite.py)
+    """
+    nombre = "base"
+
+    def metricas_pool(self):
+        """Estado de las conexiones abiertas"""
+        raise NotImplementedError
+
+    def cerrar(self):
+        """Cierra las conexiones"""
+        raise NotImplementedError
+
+    def inicializar_base_datos(self):
+        """Crea o actualiza el esquema; retorna True si aplicó cambios"""
+        raise NotImplementedError
+
+    def crear_usuario(self, nombre_usuario, contrasena): raise NotImplementedError
+    def verificar_usuario(self, nombre_usuario, contrasena): raise NotImplementedError
+    def listar_usuarios(self): raise NotImplementedError
+    def eliminar_usuario(self, usuario_id): raise NotImplementedError
+    def cambiar_contrasena(self, usuario_id, contrasena): raise NotImplementedError
+    def guardar_escaneo(self, usuario_id, nombre_usuario, ruta_imagen, resultado, confianza): raise NotImplementedError
+    def guardar_escaneos_lote(self, registros): raise NotImplementedError
+    def eliminar_escaneo(self, escaneo_id): raise NotImplementedError
+    def eliminar_historial_completo(self): raise NotImplementedError
+    def purgar_historial(self, antes_de=None, usuario_id=None, lote=HISTORIAL_PURGA_LOTE): raise NotImplementedError
+    def mantener_historial(self, retencion_meses=HISTORIAL_RETENCION_MESES, desacoplar=HISTORIAL_RETENCION_DESACOPLAR): raise NotImplementedError
+    def obtener_estadisticas(self, usuario_id): raise NotImplementedError
+    def obtener_version_historial(self, usuario_id): raise NotImplementedError
+    def obtener_estadisticas_periodo(self, usuario_id, agrupar="dia", desde=None): raise NotImplementedError
+    def obtener_historial(self, usuario_id, limite=None, despues_de=None): raise NotImplementedError
+    def iterar_historial(self, usuario_id=None, filas_por_lote=HISTORIAL_FILAS_POR_LOTE): raise NotImplementedError
+    def lotes_historial(self, usuario_id=None, desde=None, hasta=None, filas_por_lote=HISTORIAL_FILAS_POR_LOTE): raise NotImplementedError
+    def exportar_historial_csv(self, usuario_id=None, desde=None, hasta=None): raise NotImplementedError
+    def importar_historial_csv(self, archivo): raise NotImplementedError
+    def crear_trabajo(self, usuario_id, nombre_usuario, ruta_imagen, trabajo_id=None): raise NotImplementedError
+    def tomar_trabajo(self): raise NotImplementedError
+    def completar_trabajo(self, trabajo_id, resultado): raise NotImplementedError
+    def fallar_trabajo(self, trabajo_id, mensaje, definitivo): raise NotImplementedError
+    def liberar_trabajo(self, trabajo_id): raise NotImplementedError
+    def reencolar_trabajos_huerfanos(self, timeout_segundos): raise NotImplementedError
+    def obtener_trabajo(self, trabajo_id): raise NotImplementedError
+    def obtener_cache_analisis(self, hash_imagen, ttl_segundos): raise NotImplementedError
+    def guardar_cache_analisis(self, hash_imagen, predicciones, analisis_colores): raise NotImplementedError
+    def revocar_sesion(self, clave, expira, fecha_revocacion=None): raise NotImplementedError
+    def obtener_revocaciones(self): raise NotImplementedError
+
+    def nombre_reservado(self, nombre_usuario):
+        """Variantes en mayúsculas/minúsculas del admin: el rol se concede por nombre exacto y no deben poder registrarse"""
+        return nombre_usuario.casefold() == ADMIN_USUARIO.casefold()
+
+    def encriptar_contrasena(self, contrasena):
+        """Encripta la contraseña usando SHA256"""
+        return hashlib.sha256(contrasena.encode()).hexdigest()
+
+    def _formatear_usuario(self, usuario):
+        return {
+            "id": usuario["id"],
+            "nombre_usuario": usuario["nombre_usuario"],
+            "fecha_creacion": usuario["fecha_creacion"].isoformat(),
+            "total_escaneos": usuario["total_escaneos"]
+        }
+
+    def _formatear_escaneo(self, escaneo, incluir_usuario=False):
+        """Convierte una fila de historial_escaneos al formato JSON de la API"""
+        fila = {"id": escaneo["id"]}
+        if incluir_usuario: fila["usuario_id"] = escaneo["usuario_id"]
+        fila.update({
+            "nombre_usuario": escaneo["nombre_usuario"],
+            "resultado": escaneo["resultado"],
+            "confianza": escaneo["confianza"],
+            "fecha_escaneo": escaneo["fecha_escaneo"].isoformat()
+        })
+        return fila
+
+    def _pagina_historial(self, escaneos, limite, incluir_usuario):
+        """Respuesta de obtener_historial a partir de hasta limite + 1 filas ordenadas"""
+        hay_mas = limite is not None and len(escaneos) > limite
+        if hay_mas: escaneos = escaneos[:limite]
+        respuesta = {"exito": True, "historial": [self._formatear_escaneo(e, incluir_usuario) for e in escaneos]}
+        if limite is not None:
+            ultimo = escaneos[-1] if hay_mas else None
+            respuesta["siguiente_cursor"] = codificar_cursor(ultimo["fecha_escaneo"], ultimo["id"]) if ultimo else None
+        return respuesta
+
+    def _formatear_estadisticas(self, total, enfermas, suma_confianza):
+        return {
+            "total_escaneos": total,
+            "plantas_enfermas": enfermas,
+            "plantas_sanas": total - enfermas,
+            "confianza_promedio": round(suma_confianza / total, 2) if total else 0.0
+        }
+
+    def _formatear_trabajo(self, trabajo):
+        return {
+            "id": str(trabajo["id"]),
+            "usuario_id": trabajo["usuario_id"],
+            "estado": trabajo["estado"],
+            "intentos": trabajo["intentos"],
+            "resultado": trabajo["resultado"],
+            "mensaje": trabajo["mensaje"],
+            "fecha_creacion": trabajo["fecha_creacion"].isoformat(),
+            "fecha_actualizacion": trabajo["fecha_actualizacion"].isoformat()
+        }
+
+class BaseDatosPostgres(BaseDatos):
+    nombre = "postgres"
+
+    def __init__(self, connection_string=None, inicializar=True):
         """
-        Inicializa la conexión a PostgreSQL
+        Inicializa el pool de conexiones a PostgreSQL
         connection_string: URL de conexión de Supabase
+        inicializar: False si otro proceso ya preparó el esquema (trabajadores de servidor.py)
         """
         self.connection_string = connection_string or os.getenv("DATABASE_URL")
         if not self.connection_string:
             raise ValueError("❌ No se encontró DATABASE_URL en las variables de entorno")
-        self.inicializar_base_datos()
-    
-    def obtener_conexion(self):
-        """Crea y retorna una conexión a PostgreSQL"""
-        # Forzar IPv4 para evitar problemas con IPv6
-        import socket
-        old_getaddrinfo = socket.getaddrinfo
-        def new_getaddrinfo(*args, **kwargs):
-            responses = old_getaddrinfo(*args, **kwargs)
-            return [response for response in responses if response[0] == socket.AF_INET]
-        socket.getaddrinfo = new_getaddrinfo
-        
-        conexion = psycopg2.connect(self.connection_string)
-        socket.getaddrinfo = old_getaddrinfo
-        return conexion
+        self.pool = PoolConexiones(self.connection_string)
+        self._particiones = set()  # meses con partición ya comprobada por este proceso
+        if inicializar: self.inicializar_base_datos()
+    
+    def conexion(self):
+        """Presta una conexión del pool: `with db.conexion() as c:`"""
+        return self.pool.conexion()
+    
+    def metricas_pool(self):
+        """Retorna las métricas del pool de conexiones"""
+        return self.pool.metricas()
+    
+    def cerrar(self):
+        """Cierra el pool de conexiones"""
+        self.pool.cerrar()
+    
+    def _existe_tabla(self, cursor, tabla):
+        """Consulta pg_tables (no to_regclass, que puede no ver tablas recién confirmadas por otro proceso)"""
+        cursor.execute('''
+            SELECT EXISTS (SELECT 1 FROM pg_catalog.pg_tables WHERE schemaname = current_schema() AND tablename = %s)
+        ''', (tabla,))
+        return cursor.fetchone()[0]
+    
+    def _historial_particionado(self, cursor):
+        cursor.execute('''
+            SELECT EXISTS (SELECT 1 FROM pg_catalog.pg_partitioned_table p JOIN pg_catalog.pg_class c ON c.oid = p.partrelid
+                           WHERE c.relname = 'historial_escaneos' AND c.relnamespace = current_schema()::regnamespace)
+        ''')
+        return cursor.fetchone()[0]
+    
+    def _crear_particion(self, cursor, mes):
+        """Partición [mes, mes siguiente) del historial; el nombre sale de la fecha, nunca de datos del usuario"""
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {nombre_particion(mes)} PARTITION OF historial_escaneos
+            FOR VALUES FROM (%s) TO (%s)
+        ''', (mes, sumar_meses(mes, 1)))
+        self._particiones.add(mes)
+    
+    def _particiones_historial(self, cursor):
+        """[(nombre, mes), ...] de las particiones acopladas, de la más antigua a la más reciente"""
+        cursor.execute('''
+            SELECT c.relname FROM pg_catalog.pg_inherits i JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'historial_escaneos'::regclass
+            ORDER BY c.relname
+        ''')
+        return [(nombre, datetime.strptime(nombre[-7:], "%Y_%m")) for nombre, in cursor.fetchall()]
+    
+    def _asegurar_particiones(self, fechas, cursor=None):
+        """
+        Crea las particiones que falten para `fechas`; sin consultar la base si este proceso ya las vio
+        cursor: el de una transacción en curso, que las crea sin pedir otra conexión al pool y las confirma
+        (o deshace) con el resto; quien lo pasa vacía self._particiones si la transacción falla
+        """
+        faltan = {mes_de(fecha) for fecha in fechas} - self._particiones
+        if not faltan: return
+        if cursor is not None:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (CLAVE_BLOQUEO_PARTICIONES,))
+            for mes in sorted(faltan): self._crear_particion(cursor, mes)
+            return
+        with self.conexion() as conexion, conexion.cursor() as cursor:
+            self._asegurar_particiones(fechas, cursor)
+            conexion.commit()
+    
+    def _version_esquema(self, cursor):
+        """Versión del esquema registrada en la base de datos (0 si nunca se inicializó)"""
+        if not self._existe_tabla(cursor, "esquema_version"):
+            return 0
+        cursor.execute("SELECT version FROM esquema_version")
+        fila = cursor.fetchone()
+        return fila[0] if fila else 0
     
     def inicializar_base_datos(self):
-        """Crea las tablas si no existen"""
-        conexion = self.obtener_conexion()
-        cursor = conexion.cursor()
-        
+        """
+        Crea o actualiza el esquema solo si su versión no es la actual y prepara las particiones del historial
+        Retorna True si aplicó el esquema, False si ya estaba al día
+        """
+        aplicado = self._aplicar_esquema()
+        r = self.mantener_historial()
+        if not r["exito"]: print(f"❌ {r['mensaje']}")
+        return aplicado
+    
+    def _aplicar_esquema(self):
+        with self.conexion() as conexion, conexion.cursor() as cursor:
+            if self._version_esquema(cursor) >= VERSION_ESQUEMA:
+                conexion.rollback()
+                print(f"✅ Esquema PostgreSQL al día (versión {VERSION_ESQUEMA})")
+                return False
+            
+            # Un solo proceso aplica el esquema; el resto espera el bloqueo y vuelve a comprobar la versión
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (CLAVE_BLOQUEO_ESQUEMA,))
+            if self._version_esquema(cursor) >= VERSION_ESQUEMA:
+                conexion.rollback()
+                print(f"✅ Esquema PostgreSQL al día (versión {VERSION_ESQUEMA})")
+                return False
+            
+            self._crear_esquema(cursor)
+            self._crear_admin(cursor)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS esquema_version (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    version INTEGER NOT NULL,
+                    fecha_actualizacion TIMESTAMP NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                INSERT INTO esquema_version (id, version, fecha_actualizacion) VALUES (TRUE, %s, %s)
+                ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version, fecha_actualizacion = EXCLUDED.fecha_actualizacion
+            ''', (VERSION_ESQUEMA, datetime.now()))
+            conexion.commit()
+        print(f"✅ Base de datos PostgreSQL inicializada correctamente (versión {VERSION_ESQUEMA})")
+        return True
+    
+    def _crear_esquema(self, cursor):
+        """Tablas e índices; todo es idempotente (IF NOT EXISTS)"""
         # Tabla de usuarios
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS usuarios (
@@ -44,19 +569,41 @@ class BaseDatos:
             )
         ''')
         
-        # Tabla de historial de escaneos
+        # Historial particionado por mes de fecha_escaneo: la retención retira particiones enteras
+        # y las consultas sobre lo reciente solo tocan las particiones del final
+        migrar = self._existe_tabla(cursor, "historial_escaneos") and not self._historial_particionado(cursor)
+        if migrar:
+            # Tabla anterior a la versión 5: se aparta y sus filas se copian a las particiones
+            cursor.execute("ALTER TABLE historial_escaneos RENAME TO historial_escaneos_sin_particionar")
+            cursor.execute("ALTER TABLE historial_escaneos_sin_particionar RENAME CONSTRAINT historial_escaneos_pkey TO historial_escaneos_sin_particionar_pkey")
+            # Sus índices conservan el nombre: sin borrarlos, los CREATE INDEX IF NOT EXISTS de abajo no harían nada
+            # y la tabla particionada se quedaría solo con la clave primaria al borrar la anterior
+            cursor.execute(f"DROP INDEX IF EXISTS {', '.join(INDICES_HISTORIAL)}")
+        # Secuencia explícita: la de la tabla anterior (SERIAL) se conserva y los ids siguen donde iban
+        cursor.execute("CREATE SEQUENCE IF NOT EXISTS historial_escaneos_id_seq")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS historial_escaneos (
-                id SERIAL PRIMARY KEY,
+                id INTEGER NOT NULL DEFAULT nextval('historial_escaneos_id_seq'),
                 usuario_id INTEGER NOT NULL,
                 nombre_usuario VARCHAR(100) NOT NULL,
                 ruta_imagen TEXT,
                 resultado VARCHAR(50) NOT NULL,
                 confianza REAL NOT NULL,
                 fecha_escaneo TIMESTAMP NOT NULL,
+                PRIMARY KEY (id, fecha_escaneo),
                 FOREIGN KEY (usuario_id) REFERENCES usuarios (id) ON DELETE CASCADE
-            )
+            ) PARTITION BY RANGE (fecha_escaneo)
         ''')
+        cursor.execute("ALTER SEQUENCE historial_escaneos_id_seq OWNED BY historial_escaneos.id")
+        if migrar:
+            cursor.execute("SELECT DISTINCT date_trunc('month', fecha_escaneo) FROM historial_escaneos_sin_particionar")
+            for mes, in cursor.fetchall(): self._crear_particion(cursor, mes)
+            cursor.execute('''
+                INSERT INTO historial_escaneos (id, usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo)
+                SELECT id, usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo
+                FROM historial_escaneos_sin_particionar
+            ''')
+            cursor.execute("DROP TABLE historial_escaneos_sin_particionar")
         
         # Crear índices para mejorar rendimiento
         cursor.execute('''
@@ -69,34 +616,100 @@ class BaseDatos:
             ON historial_escaneos(fecha_escaneo DESC)
         ''')
         
-        conexion.commit()
-        cursor.close()
-        conexion.close()
-        print("✅ Base de datos PostgreSQL inicializada correctamente")
+        # Índices compuestos para paginar por (fecha_escaneo, id)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_historial_usuario_fecha_id
+            ON historial_escaneos(usuario_id, fecha_escaneo DESC, id DESC)
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_historial_fecha_id
+            ON historial_escaneos(fecha_escaneo DESC, id DESC)
+        ''')
+        
+        # Caché persistente de análisis (clave: SHA256 de la imagen)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cache_analisis (
+                hash_imagen CHAR(64) PRIMARY KEY,
+                predicciones JSONB NOT NULL,
+                analisis_colores JSONB NOT NULL,
+                fecha_creacion TIMESTAMP NOT NULL
+            )
+        ''')
+        
+        # Contadores por usuario, mantenidos en la misma transacción que cada alta o baja de escaneos
+        contadores_nuevos = not self._existe_tabla(cursor, "estadisticas_usuario")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS estadisticas_usuario (
+                usuario_id INTEGER PRIMARY KEY REFERENCES usuarios (id) ON DELETE CASCADE,
+                total_escaneos INTEGER NOT NULL DEFAULT 0,
+                plantas_enfermas INTEGER NOT NULL DEFAULT 0,
+                suma_confianza DOUBLE PRECISION NOT NULL DEFAULT 0,
+                version BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        # Versión del historial de cada usuario: sube con cada alta o baja, sirve de ETag
+        cursor.execute("ALTER TABLE estadisticas_usuario ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0")
+        if contadores_nuevos:
+            self._recalcular_estadisticas(cursor)
+        
+        # Cola persistente de análisis asíncronos
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trabajos_analisis (
+                id UUID PRIMARY KEY,
+                usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+                nombre_usuario VARCHAR(100) NOT NULL,
+                ruta_imagen TEXT NOT NULL,
+                estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                resultado JSONB,
+                mensaje TEXT,
+                fecha_creacion TIMESTAMP NOT NULL,
+                fecha_actualizacion TIMESTAMP NOT NULL
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_trabajos_pendientes
+            ON trabajos_analisis(fecha_creacion) WHERE estado = 'pendiente'
+        ''')
+        
+        # Sesiones revocadas antes de expirar: "token:<jti>" o "usuario:<id>" (todos sus tokens anteriores)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sesiones_revocadas (
+                clave VARCHAR(80) PRIMARY KEY,
+                fecha_revocacion TIMESTAMP NOT NULL,
+                expira TIMESTAMP NOT NULL
+            )
+        ''')
     
-    def encriptar_contrasena(self, contrasena):
-        """Encripta la contraseña usando SHA256"""
-        return hashlib.sha256(contrasena.encode()).hexdigest()
+    def _crear_admin(self, cursor):
+        """Crea el usuario administrador si no existe"""
+        cursor.execute('''
+            INSERT INTO usuarios (nombre_usuario, contrasena, fecha_creacion)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (nombre_usuario) DO NOTHING
+        ''', (ADMIN_USUARIO, self.encriptar_contrasena(ADMIN_CONTRASENA), datetime.now()))
+        if cursor.rowcount:
+            print("✅ Admin creado")
     
     def crear_usuario(self, nombre_usuario, contrasena):
         """Crea un nuevo usuario"""
+        if self.nombre_reservado(nombre_usuario):
+            return {"exito": False, "mensaje": "El usuario ya existe"}
         try:
-            conexion = self.obtener_conexion()
-            cursor = conexion.cursor()
-            
-            contrasena_encriptada = self.encriptar_contrasena(contrasena)
-            fecha_actual = datetime.now()
-            
-            cursor.execute('''
-                INSERT INTO usuarios (nombre_usuario, contrasena, fecha_creacion)
-                VALUES (%s, %s, %s)
-                RETURNING id
-            ''', (nombre_usuario, contrasena_encriptada, fecha_actual))
-            
-            usuario_id = cursor.fetchone()[0]
-            conexion.commit()
-            cursor.close()
-            conexion.close()
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                contrasena_encriptada = self.encriptar_contrasena(contrasena)
+                fecha_actual = datetime.now()
+                
+                cursor.execute('''
+                    INSERT INTO usuarios (nombre_usuario, contrasena, fecha_creacion)
+                    VALUES (%s, %s, %s)
+                    RETURNING id
+                ''', (nombre_usuario, contrasena_encriptada, fecha_actual))
+                
+                usuario_id = cursor.fetchone()[0]
+                conexion.commit()
             
             return {"exito": True, "mensaje": "Usuario creado exitosamente", "usuario_id": usuario_id}
         except psycopg2.IntegrityError:
@@ -107,19 +720,15 @@ class BaseDatos:
     def verificar_usuario(self, nombre_usuario, contrasena):
         """Verifica las credenciales del usuario"""
         try:
-            conexion = self.obtener_conexion()
-            cursor = conexion.cursor(cursor_factory=RealDictCursor)
-            
-            contrasena_encriptada = self.encriptar_contrasena(contrasena)
-            
-            cursor.execute('''
-                SELECT id, nombre_usuario FROM usuarios
-                WHERE nombre_usuario = %s AND contrasena = %s
-            ''', (nombre_usuario, contrasena_encriptada))
-            
-            usuario = cursor.fetchone()
-            cursor.close()
-            conexion.close()
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                contrasena_encriptada = self.encriptar_contrasena(contrasena)
+                
+                cursor.execute('''
+                    SELECT id, nombre_usuario FROM usuarios
+                    WHERE nombre_usuario = %s AND contrasena = %s
+                ''', (nombre_usuario, contrasena_encriptada))
+                
+                usuario = cursor.fetchone()
             
             if usuario:
                 return {
@@ -135,65 +744,609 @@ class BaseDatos:
         except Exception as e:
             return {"exito": False, "mensaje": f"Error al verificar usuario: {str(e)}"}
     
+    def listar_usuarios(self):
+        """Usuarios con su total de escaneos (leído de los contadores), más recientes primero"""
+        try:
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute('''
+                    SELECT u.id, u.nombre_usuario, u.fecha_creacion, COALESCE(e.total_escaneos, 0) AS total_escaneos
+                    FROM usuarios u
+                    LEFT JOIN estadisticas_usuario e ON e.usuario_id = u.id
+                    ORDER BY u.fecha_creacion DESC
+                ''')
+                usuarios = cursor.fetchall()
+            return {"exito": True, "usuarios": [self._formatear_usuario(u) for u in usuarios]}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al listar usuarios: {str(e)}"}
+    
+    def eliminar_usuario(self, usuario_id):
+        """
+        Elimina un usuario; el administrador no se puede eliminar
+        Su historial se borra antes por lotes: la cascada lo haría en una sola transacción tan larga como el historial
+        """
+        try:
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute("SELECT lower(nombre_usuario) = lower(%s) FROM usuarios WHERE id = %s", (ADMIN_USUARIO, usuario_id))
+                fila = cursor.fetchone()
+            if fila and fila[0]:
+                return {"exito": False, "mensaje": "No eliminar admin", "protegido": True}
+            if fila:
+                r = self.purgar_historial(usuario_id=usuario_id)
+                if not r["exito"]: return {"exito": False, "mensaje": f"Error al eliminar usuario: {r['mensaje']}"}
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute('''
+                    DELETE FROM usuarios WHERE id = %s AND lower(nombre_usuario) <> lower(%s)
+                ''', (usuario_id, ADMIN_USUARIO))
+                eliminados = cursor.rowcount
+                if not eliminados:
+                    cursor.execute("SELECT 1 FROM usuarios WHERE id = %s", (usuario_id,))
+                    if cursor.fetchone():
+                        return {"exito": False, "mensaje": "No eliminar admin", "protegido": True}
+                conexion.commit()
+            return {"exito": True, "mensaje": "Eliminado", "eliminados": eliminados}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al eliminar usuario: {str(e)}"}
+    
+    def cambiar_contrasena(self, usuario_id, contrasena):
+        """Reemplaza la contraseña de un usuario"""
+        try:
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute("UPDATE usuarios SET contrasena = %s WHERE id = %s", (self.encriptar_contrasena(contrasena), usuario_id))
+                conexion.commit()
+            return {"exito": True, "mensaje": "Actualizada"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al cambiar contraseña: {str(e)}"}
+    
     def guardar_escaneo(self, usuario_id, nombre_usuario, ruta_imagen, resultado, confianza):
         """Guarda un registro de escaneo en el historial"""
         try:
-            conexion = self.obtener_conexion()
-            cursor = conexion.cursor()
-            
             fecha_actual = datetime.now()
-            
-            cursor.execute('''
-                INSERT INTO historial_escaneos 
-                (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_actual))
-            
-            escaneo_id = cursor.fetchone()[0]
-            conexion.commit()
-            cursor.close()
-            conexion.close()
+            self._asegurar_particiones([fecha_actual])
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO historial_escaneos 
+                    (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_actual))
+                
+                escaneo_id = cursor.fetchone()[0]
+                self._sumar_estadisticas(cursor, [(usuario_id, resultado, confianza)])
+                conexion.commit()
             
             return {"exito": True, "mensaje": "Escaneo guardado exitosamente", "escaneo_id": escaneo_id}
         except Exception as e:
+            self._particiones.clear()  # por si otro proceso retiró una partición: se vuelve a comprobar al reintentar
             return {"exito": False, "mensaje": f"Error al guardar escaneo: {str(e)}"}
     
-    def obtener_historial(self, usuario_id):
-        """Obtiene el historial de escaneos de un usuario"""
+    def guardar_escaneos_lote(self, registros):
+        """
+        Guarda varios escaneos con un único INSERT multi-fila
+        registros: lista de (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza[, fecha_escaneo])
+        """
         try:
-            conexion = self.obtener_conexion()
-            cursor = conexion.cursor(cursor_factory=RealDictCursor)
+            fecha_actual = datetime.now()
+            filas = [tuple(registro[:5]) + (registro[5] if len(registro) > 5 else fecha_actual,) for registro in registros]
+            self._asegurar_particiones([fila[5] for fila in filas])
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                ids = execute_values(cursor, '''
+                    INSERT INTO historial_escaneos 
+                    (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo)
+                    VALUES %s
+                    RETURNING id
+                ''', filas, page_size=max(1, len(filas)), fetch=True)
+                self._sumar_estadisticas(cursor, [(fila[0], fila[3], fila[4]) for fila in filas])
+                conexion.commit()
             
+            return {"exito": True, "mensaje": f"{len(ids)} escaneos guardados", "escaneo_ids": [fila[0] for fila in ids]}
+        except Exception as e:
+            self._particiones.clear()
+            return {"exito": False, "mensaje": f"Error al guardar escaneos: {str(e)}"}
+    
+    def _sumar_estadisticas(self, cursor, escaneos):
+        """Suma escaneos (usuario_id, resultado, confianza) a los contadores de cada usuario"""
+        por_usuario = {}
+        for usuario_id, resultado, confianza in escaneos:
+            total, enfermas, suma = por_usuario.get(usuario_id, (0, 0, 0.0))
+            por_usuario[usuario_id] = (total + 1, enfermas + (resultado == "Enferma"), suma + confianza)
+        execute_values(cursor, '''
+            INSERT INTO estadisticas_usuario (usuario_id, total_escaneos, plantas_enfermas, suma_confianza, version)
+            VALUES %s
+            ON CONFLICT (usuario_id) DO UPDATE SET
+                total_escaneos = estadisticas_usuario.total_escaneos + EXCLUDED.total_escaneos,
+                plantas_enfermas = estadisticas_usuario.plantas_enfermas + EXCLUDED.plantas_enfermas,
+                suma_confianza = estadisticas_usuario.suma_confianza + EXCLUDED.suma_confianza,
+                version = estadisticas_usuario.version + 1
+        ''', [(usuario_id,) + valores + (1,) for usuario_id, valores in por_usuario.items()])
+    
+    def _recalcular_estadisticas(self, cursor):
+        """Reconstruye los contadores a partir de historial_escaneos"""
+        cursor.execute("DELETE FROM estadisticas_usuario")
+        cursor.execute('''
+            INSERT INTO estadisticas_usuario (usuario_id, total_escaneos, plantas_enfermas, suma_confianza)
+            SELECT usuario_id, COUNT(*), COUNT(*) FILTER (WHERE resultado = 'Enferma'), COALESCE(SUM(confianza), 0)
+            FROM historial_escaneos
+            GROUP BY usuario_id
+        ''')
+    
+    def _descontar(self, cursor, origen, parametros=()):
+        """Descuenta de los contadores las filas (usuario_id, resultado, confianza) que produce `origen`; retorna cuántas"""
+        cursor.execute(f'''
+            WITH filas AS (
+                {origen}
+            ), por_usuario AS (
+                SELECT usuario_id, COUNT(*) AS total,
+                       COUNT(*) FILTER (WHERE resultado = 'Enferma') AS enfermas,
+                       COALESCE(SUM(confianza), 0) AS suma
+                FROM filas GROUP BY usuario_id
+            ), descontados AS (
+                UPDATE estadisticas_usuario e
+                SET total_escaneos = e.total_escaneos - p.total,
+                    plantas_enfermas = e.plantas_enfermas - p.enfermas,
+                    suma_confianza = e.suma_confianza - p.suma,
+                    version = e.version + 1
+                FROM por_usuario p WHERE e.usuario_id = p.usuario_id
+            )
+            SELECT COALESCE(SUM(total), 0)::bigint FROM por_usuario
+        ''', parametros)
+        return cursor.fetchone()[0]
+    
+    def _eliminar_escaneos(self, cursor, condicion="", parametros=()):
+        """Borra escaneos y descuenta de los contadores en la misma transacción; retorna las filas borradas"""
+        return self._descontar(cursor, f"DELETE FROM historial_escaneos {condicion} RETURNING usuario_id, resultado, confianza", parametros)
+    
+    def eliminar_escaneo(self, escaneo_id):
+        """Elimina un escaneo del historial"""
+        try:
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                eliminados = self._eliminar_escaneos(cursor, "WHERE id = %s", (escaneo_id,))
+                conexion.commit()
+            return {"exito": True, "mensaje": "Registro eliminado", "eliminados": eliminados}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al eliminar escaneo: {str(e)}"}
+    
+    def eliminar_historial_completo(self):
+        """Vacía el historial con TRUNCATE (sin recorrer filas ni escribirlas en el WAL) y reinicia los contadores"""
+        try:
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                # Con el historial bloqueado nadie más suma escaneos: los contadores dicen cuántos había
+                cursor.execute("TRUNCATE historial_escaneos")
+                cursor.execute("SELECT COALESCE(SUM(total_escaneos), 0) FROM estadisticas_usuario")
+                eliminados = cursor.fetchone()[0]
+                # Los contadores se ponen a cero sin borrar la fila: la versión nunca retrocede
+                cursor.execute('''
+                    UPDATE estadisticas_usuario
+                    SET total_escaneos = 0, plantas_enfermas = 0, suma_confianza = 0, version = version + 1
+                ''')
+                conexion.commit()
+            return {"exito": True, "mensaje": f"Se eliminaron {eliminados} registros", "eliminados": eliminados}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al eliminar historial: {str(e)}"}
+    
+    def _retirar_particiones(self, cursor, hasta, desacoplar=False):
+        """
+        Retira las particiones que terminan antes de `hasta`, descontando antes sus escaneos de los contadores
+        Retorna (nombres, escaneos); desacopladas quedan como tablas sueltas fuera del historial
+        """
+        retiradas, eliminados = [], 0
+        for nombre, mes in self._particiones_historial(cursor):
+            if sumar_meses(mes, 1) > hasta: break
+            eliminados += self._descontar(cursor, f"SELECT usuario_id, resultado, confianza FROM {nombre}")
+            cursor.execute(f"ALTER TABLE historial_escaneos DETACH PARTITION {nombre}" if desacoplar else f"DROP TABLE {nombre}")
+            self._particiones.discard(mes)
+            retiradas.append(nombre)
+        return retiradas, eliminados
+    
+    def purgar_historial(self, antes_de=None, usuario_id=None, lote=HISTORIAL_PURGA_LOTE):
+        """
+        Borra los escaneos anteriores a `antes_de` (todos si es None) de un usuario o de todos
+        Sin usuario, las particiones que caen enteras antes de `antes_de` se retiran de una vez; el resto se borra
+        en lotes de `lote` filas con una transacción por lote, sin bloqueos largos ni transacciones enormes.
+        """
+        if antes_de is None and usuario_id is None: return self.eliminar_historial_completo()
+        try:
+            retiradas, eliminados, lotes = [], 0, 0
+            if usuario_id is None:
+                with self.conexion() as conexion, conexion.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (CLAVE_BLOQUEO_PARTICIONES,))
+                    # Nunca la del mes en curso: otros procesos la dan por existente al insertar
+                    retiradas, eliminados = self._retirar_particiones(cursor, min(antes_de, mes_de(datetime.now())))
+                    conexion.commit()
+            condiciones, parametros = [], []
+            if usuario_id is not None:
+                condiciones.append("usuario_id = %s")
+                parametros.append(usuario_id)
+            if antes_de is not None:
+                condiciones.append("fecha_escaneo < %s")
+                parametros.append(antes_de)
+            while True:
+                with self.conexion() as conexion, conexion.cursor() as cursor:
+                    borrados = self._eliminar_escaneos(cursor, f'''
+                        WHERE (id, fecha_escaneo) IN (
+                            SELECT id, fecha_escaneo FROM historial_escaneos WHERE {' AND '.join(condiciones)} LIMIT %s
+                        )''', parametros + [lote])
+                    conexion.commit()
+                eliminados += borrados
+                lotes += 1
+                if borrados < lote: break
+            return {"exito": True, "mensaje": f"Se eliminaron {eliminados} registros", "eliminados": eliminados,
+                    "lotes": lotes, "particiones_retiradas": retiradas}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al purgar historial: {str(e)}"}
+    
+    def mantener_historial(self, retencion_meses=HISTORIAL_RETENCION_MESES, desacoplar=HISTORIAL_RETENCION_DESACOPLAR):
+        """
+        Crea la partición del mes en curso y las siguientes, y aplica la retención
+        retencion_meses: se retiran las particiones que terminaron hace más de esos meses (0 = conservar todo)
+        desacoplar: desacoplar en vez de borrar, para archivarlas aparte
+        """
+        try:
+            actual = mes_de(datetime.now())
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (CLAVE_BLOQUEO_PARTICIONES,))
+                for i in range(MESES_ADELANTADOS + 1): self._crear_particion(cursor, sumar_meses(actual, i))
+                retiradas, eliminados = [], 0
+                if retencion_meses > 0:
+                    retiradas, eliminados = self._retirar_particiones(cursor, sumar_meses(actual, -retencion_meses), desacoplar)
+                conexion.commit()
+            if retiradas: print(f"🗑️ Retención del historial: {len(retiradas)} particiones retiradas ({eliminados} escaneos)")
+            return {"exito": True, "mensaje": f"Se retiraron {len(retiradas)} particiones", "eliminados": eliminados,
+                    "particiones_retiradas": retiradas}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error en el mantenimiento del historial: {str(e)}"}
+    
+    def obtener_estadisticas(self, usuario_id):
+        """Totales del usuario leídos de los contadores: O(1), sin recorrer el historial"""
+        try:
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute('''
+                    SELECT total_escaneos, plantas_enfermas, suma_confianza
+                    FROM estadisticas_usuario WHERE usuario_id = %s
+                ''', (usuario_id,))
+                fila = cursor.fetchone()
+            if not fila: return {"exito": True, "estadisticas": self._formatear_estadisticas(0, 0, 0.0)}
+            return {"exito": True, "estadisticas": self._formatear_estadisticas(fila["total_escaneos"], fila["plantas_enfermas"], fila["suma_confianza"])}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener estadísticas: {str(e)}"}
+    
+    def obtener_version_historial(self, usuario_id):
+        """Versión del historial del usuario (0 si nunca tuvo escaneos): cambia con cada alta o baja"""
+        try:
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute("SELECT version FROM estadisticas_usuario WHERE usuario_id = %s", (usuario_id,))
+                fila = cursor.fetchone()
+            return {"exito": True, "version": fila[0] if fila else 0}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener versión del historial: {str(e)}"}
+    
+    def obtener_estadisticas_periodo(self, usuario_id, agrupar="dia", desde=None):
+        """
+        Escaneos por día o semana calculados en SQL (sin cargar filas)
+        agrupar: "dia" o "semana"
+        desde: fecha mínima de escaneo (None = todo el historial)
+        """
+        unidad = {"dia": "day", "semana": "week"}[agrupar]
+        try:
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute('''
+                    SELECT date_trunc(%s, fecha_escaneo) AS periodo,
+                           COUNT(*) AS total_escaneos,
+                           COUNT(*) FILTER (WHERE resultado = 'Enferma') AS plantas_enfermas,
+                           AVG(confianza) AS confianza_promedio
+                    FROM historial_escaneos
+                    WHERE usuario_id = %s AND (%s::timestamp IS NULL OR fecha_escaneo >= %s)
+                    GROUP BY periodo
+                    ORDER BY periodo DESC
+                ''', (unidad, usuario_id, desde, desde))
+                filas = cursor.fetchall()
+            return {"exito": True, "series": [{
+                "periodo": fila["periodo"].date().isoformat(),
+                "total_escaneos": fila["total_escaneos"],
+                "plantas_enfermas": fila["plantas_enfermas"],
+                "plantas_sanas": fila["total_escaneos"] - fila["plantas_enfermas"],
+                "confianza_promedio": round(fila["confianza_promedio"], 2)
+            } for fila in filas]}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener estadísticas: {str(e)}"}
+    
+    def crear_trabajo(self, usuario_id, nombre_usuario, ruta_imagen, trabajo_id=None):
+        """Encola un análisis asíncrono"""
+        try:
+            trabajo_id = trabajo_id or str(uuid.uuid4())
+            fecha_actual = datetime.now()
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO trabajos_analisis
+                    (id, usuario_id, nombre_usuario, ruta_imagen, fecha_creacion, fecha_actualizacion)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                ''', (trabajo_id, usuario_id, nombre_usuario, ruta_imagen, fecha_actual, fecha_actual))
+                conexion.commit()
+            return {"exito": True, "mensaje": "Análisis encolado", "trabajo_id": trabajo_id}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al encolar análisis: {str(e)}"}
+    
+    def tomar_trabajo(self):
+        """Reserva el trabajo pendiente más antiguo (SKIP LOCKED: varios procesos pueden consumir a la vez)"""
+        with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute('''
-                SELECT * FROM historial_escaneos
-                WHERE usuario_id = %s
-                ORDER BY fecha_escaneo DESC
-            ''', (usuario_id,))
-            
-            escaneos = cursor.fetchall()
-            cursor.close()
-            conexion.close()
-            
-            historial = []
-            for escaneo in escaneos:
-                historial.append({
-                    "id": escaneo["id"],
-                    "nombre_usuario": escaneo["nombre_usuario"],
-                    "resultado": escaneo["resultado"],
-                    "confianza": escaneo["confianza"],
-                    "fecha_escaneo": escaneo["fecha_escaneo"].isoformat()
-                })
-            
-            return {"exito": True, "historial": historial}
+                UPDATE trabajos_analisis
+                SET estado = 'procesando', intentos = intentos + 1, fecha_actualizacion = %s
+                WHERE id = (
+                    SELECT id FROM trabajos_analisis
+                    WHERE estado = 'pendiente'
+                    ORDER BY fecha_creacion
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, usuario_id, nombre_usuario, ruta_imagen, intentos
+            ''', (datetime.now(),))
+            trabajo = cursor.fetchone()
+            conexion.commit()
+        return dict(trabajo) if trabajo else None
+    
+    def _actualizar_trabajo(self, sql, parametros):
+        """Ejecuta un UPDATE sobre trabajos_analisis y retorna las filas afectadas"""
+        with self.conexion() as conexion, conexion.cursor() as cursor:
+            cursor.execute(sql, parametros)
+            conexion.commit()
+            return cursor.rowcount
+    
+    def completar_trabajo(self, trabajo_id, resultado):
+        """Marca el trabajo como completado y guarda su resultado"""
+        return self._actualizar_trabajo('''
+            UPDATE trabajos_analisis SET estado = 'completado', resultado = %s, mensaje = NULL, fecha_actualizacion = %s
+            WHERE id = %s
+        ''', (Json(resultado), datetime.now(), trabajo_id))
+    
+    def fallar_trabajo(self, trabajo_id, mensaje, definitivo):
+        """Registra un fallo: el trabajo vuelve a la cola salvo que se hayan agotado los intentos"""
+        return self._actualizar_trabajo('''
+            UPDATE trabajos_analisis SET estado = %s, mensaje = %s, fecha_actualizacion = %s
+            WHERE id = %s
+        ''', ("error" if definitivo else "pendiente", mensaje, datetime.now(), trabajo_id))
+    
+    def liberar_trabajo(self, trabajo_id):
+        """Devuelve a la cola un trabajo interrumpido sin contarlo como intento"""
+        return self._actualizar_trabajo('''
+            UPDATE trabajos_analisis SET estado = 'pendiente', intentos = GREATEST(intentos - 1, 0), fecha_actualizacion = %s
+            WHERE id = %s AND estado = 'procesando'
+        ''', (datetime.now(), trabajo_id))
+    
+    def reencolar_trabajos_huerfanos(self, timeout_segundos):
+        """Reencola los trabajos que quedaron en 'procesando' por un reinicio o una caída"""
+        try:
+            return self._actualizar_trabajo('''
+                UPDATE trabajos_analisis SET estado = 'pendiente', fecha_actualizacion = %s
+                WHERE estado = 'procesando' AND fecha_actualizacion < %s
+            ''', (datetime.now(), datetime.now() - timedelta(seconds=timeout_segundos)))
+        except Exception:
+            return 0
+    
+    def obtener_trabajo(self, trabajo_id):
+        """Estado y resultado de un análisis asíncrono"""
+        try:
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute('''
+                    SELECT id, usuario_id, estado, intentos, resultado, mensaje, fecha_creacion, fecha_actualizacion
+                    FROM trabajos_analisis WHERE id = %s
+                ''', (trabajo_id,))
+                trabajo = cursor.fetchone()
+            if not trabajo:
+                return {"exito": False, "mensaje": "Trabajo no encontrado"}
+            return {"exito": True, "trabajo": self._formatear_trabajo(trabajo)}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener trabajo: {str(e)}"}
+    
+    def _consulta_historial(self, usuario_id=None, despues_de=None):
+        """Arma la consulta del historial ordenada por (fecha_escaneo, id) descendente"""
+        condiciones, parametros = [], []
+        if usuario_id is not None:
+            condiciones.append("usuario_id = %s")
+            parametros.append(usuario_id)
+        if despues_de is not None:
+            # Paginación por clave: usa los índices sobre (usuario_id, fecha_escaneo, id) y (fecha_escaneo, id)
+            # La condición redundante sobre fecha_escaneo sola deja descartar particiones posteriores al cursor
+            condiciones.append("(fecha_escaneo, id) < (%s, %s) AND fecha_escaneo <= %s")
+            parametros.extend((*despues_de, despues_de[0]))
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        sql = f'''
+            SELECT id, usuario_id, nombre_usuario, resultado, confianza, fecha_escaneo
+            FROM historial_escaneos {where}
+            ORDER BY fecha_escaneo DESC, id DESC
+        '''
+        return sql, parametros
+    
+    def obtener_historial(self, usuario_id, limite=None, despues_de=None):
+        """
+        Obtiene el historial de escaneos de un usuario (todos los usuarios si usuario_id es None)
+        limite: escaneos por página; None retorna el historial completo
+        despues_de: (fecha_escaneo, id) del último escaneo de la página anterior
+        """
+        try:
+            sql, parametros = self._consulta_historial(usuario_id, despues_de)
+            if limite is not None:
+                sql += " LIMIT %s"
+                parametros.append(limite + 1)
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(sql, parametros)
+                escaneos = cursor.fetchall()
+            return self._pagina_historial(escaneos, limite, usuario_id is None)
         except Exception as e:
             return {"exito": False, "mensaje": f"Error al obtener historial: {str(e)}"}
+    
+    def iterar_historial(self, usuario_id=None, filas_por_lote=HISTORIAL_FILAS_POR_LOTE):
+        """Recorre el historial con un cursor de servidor: memoria constante sin importar el tamaño"""
+        sql, parametros = self._consulta_historial(usuario_id)
+        with self.conexion() as conexion, \
+                conexion.cursor(name=f"historial_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = filas_por_lote
+            cursor.execute(sql, parametros)
+            for escaneo in cursor:
+                yield self._formatear_escaneo(escaneo, usuario_id is None)
+    
+    def _consulta_exportacion(self, usuario_id=None, desde=None, hasta=None):
+        """Todas las columnas en orden cronológico; filtros opcionales por usuario y por fecha en [desde, hasta)"""
+        condiciones, parametros = [], []
+        if usuario_id is not None:
+            condiciones.append("usuario_id = %s")
+            parametros.append(usuario_id)
+        if desde is not None:
+            condiciones.append("fecha_escaneo >= %s")
+            parametros.append(desde)
+        if hasta is not None:
+            condiciones.append("fecha_escaneo < %s")
+            parametros.append(hasta)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        return f"SELECT {', '.join(COLUMNAS_HISTORIAL)} FROM historial_escaneos {where} ORDER BY fecha_escaneo, id", parametros
+    
+    def lotes_historial(self, usuario_id=None, desde=None, hasta=None, filas_por_lote=HISTORIAL_FILAS_POR_LOTE):
+        """Tuplas en el orden de COLUMNAS_HISTORIAL, por lotes de un cursor de servidor (para la exportación columnar)"""
+        sql, parametros = self._consulta_exportacion(usuario_id, desde, hasta)
+        with self.conexion() as conexion, conexion.cursor(name=f"exportacion_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = filas_por_lote
+            cursor.execute(sql, parametros)
+            while lote := cursor.fetchmany(filas_por_lote):
+                yield lote
+    
+    def exportar_historial_csv(self, usuario_id=None, desde=None, hasta=None):
+        """CSV con cabecera generado por COPY ... TO STDOUT en el servidor, en bloques de bytes"""
+        sql, parametros = self._consulta_exportacion(usuario_id, desde, hasta)
+        with self.conexion() as conexion, conexion.cursor() as cursor:
+            # COPY no admite parámetros: se incrustan ya escapados por psycopg2
+            copia = cursor.mogrify(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", parametros)
+            inicio = time.perf_counter()
+            yield from transmitir_copia(conexion, lambda destino: cursor.copy_expert(copia, destino))
+            registrar_consulta("SELECT", time.perf_counter() - inicio)
+            conexion.rollback()
+    
+    def importar_historial_csv(self, archivo):
+        """
+        Carga un CSV con las columnas de la exportación: COPY a una tabla temporal y un único INSERT ... SELECT
+        archivo: objeto binario con read/readline (la subida, ya en disco)
+        Los escaneos se asignan por nombre_usuario, porque los ids cambian entre entornos; id y usuario_id
+        se ignoran y las filas de usuarios que no existen se omiten. Todo o nada: una sola transacción.
+        """
+        try:
+            verificar_cabecera_csv(archivo.readline())
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute('''
+                    CREATE TEMP TABLE historial_importado (
+                        id INTEGER, usuario_id INTEGER, nombre_usuario VARCHAR(100), ruta_imagen TEXT,
+                        resultado VARCHAR(50), confianza REAL, fecha_escaneo TIMESTAMP
+                    ) ON COMMIT DROP
+                ''')
+                inicio = time.perf_counter()
+                cursor.copy_expert(f"COPY historial_importado ({', '.join(COLUMNAS_HISTORIAL)}) FROM STDIN WITH (FORMAT csv)",
+                                   archivo, size=256 * 1024)
+                registrar_consulta("INSERT", time.perf_counter() - inicio)
+                cursor.execute("SELECT COUNT(*), array_agg(DISTINCT date_trunc('month', fecha_escaneo)) FROM historial_importado")
+                leidos, meses = cursor.fetchone()
+                self._asegurar_particiones(meses or [], cursor)
+                cursor.execute('''
+                    WITH insertados AS (
+                        INSERT INTO historial_escaneos (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo)
+                        SELECT u.id, u.nombre_usuario, i.ruta_imagen, i.resultado, i.confianza, i.fecha_escaneo
+                        FROM historial_importado i JOIN usuarios u ON u.nombre_usuario = i.nombre_usuario
+                        RETURNING usuario_id, resultado, confianza
+                    ), por_usuario AS (
+                        SELECT usuario_id, COUNT(*) AS total,
+                               COUNT(*) FILTER (WHERE resultado = 'Enferma') AS enfermas,
+                               COALESCE(SUM(confianza), 0) AS suma
+                        FROM insertados GROUP BY usuario_id
+                    ), sumados AS (
+                        INSERT INTO estadisticas_usuario (usuario_id, total_escaneos, plantas_enfermas, suma_confianza, version)
+                        SELECT usuario_id, total, enfermas, suma, 1 FROM por_usuario
+                        ON CONFLICT (usuario_id) DO UPDATE SET
+                            total_escaneos = estadisticas_usuario.total_escaneos + EXCLUDED.total_escaneos,
+                            plantas_enfermas = estadisticas_usuario.plantas_enfermas + EXCLUDED.plantas_enfermas,
+                            suma_confianza = estadisticas_usuario.suma_confianza + EXCLUDED.suma_confianza,
+                            version = estadisticas_usuario.version + 1
+                    )
+                    SELECT COALESCE(SUM(total), 0)::bigint FROM por_usuario
+                ''')
+                importados = cursor.fetchone()[0]
+                conexion.commit()
+            return {"exito": True, "mensaje": f"{importados} escaneos importados", "importados": importados, "omitidos": leidos - importados}
+        except Exception as e:
+            self._particiones.clear()  # las creadas en la transacción deshecha ya no existen
+            return {"exito": False, "mensaje": f"Error al importar historial: {str(e)}"}
+    
+    def obtener_cache_analisis(self, hash_imagen, ttl_segundos):
+        """Busca un análisis cacheado que no haya expirado; retorna None si no existe"""
+        try:
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute('''
+                    SELECT predicciones, analisis_colores FROM cache_analisis
+                    WHERE hash_imagen = %s AND fecha_creacion > %s
+                ''', (hash_imagen, datetime.now() - timedelta(seconds=ttl_segundos)))
+                fila = cursor.fetchone()
+            if fila:
+                return {"predicciones": fila["predicciones"], "analisis_colores": fila["analisis_colores"]}
+            return None
+        except Exception:
+            return None
+    
+    def guardar_cache_analisis(self, hash_imagen, predicciones, analisis_colores):
+        """Guarda (o renueva) un análisis en la caché persistente"""
+        try:
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO cache_analisis (hash_imagen, predicciones, analisis_colores, fecha_creacion)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (hash_imagen) DO UPDATE
+                    SET predicciones = EXCLUDED.predicciones,
+                        analisis_colores = EXCLUDED.analisis_colores,
+                        fecha_creacion = EXCLUDED.fecha_creacion
+                ''', (hash_imagen, Json(predicciones), Json(analisis_colores), datetime.now()))
+                conexion.commit()
+            return {"exito": True, "mensaje": "Análisis guardado en caché"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al guardar caché: {str(e)}"}
+    
+    def revocar_sesion(self, clave, expira, fecha_revocacion=None):
+        """Agrega (o renueva) una entrada de la lista de revocados y purga las que ya expiraron"""
+        try:
+            with self.conexion() as conexion, conexion.cursor() as cursor:
+                ahora = datetime.now()
+                cursor.execute("DELETE FROM sesiones_revocadas WHERE expira < %s", (ahora,))
+                cursor.execute('''
+                    INSERT INTO sesiones_revocadas (clave, fecha_revocacion, expira) VALUES (%s, %s, %s)
+                    ON CONFLICT (clave) DO UPDATE
+                    SET fecha_revocacion = EXCLUDED.fecha_revocacion, expira = EXCLUDED.expira
+                ''', (clave, fecha_revocacion or ahora, expira))
+                conexion.commit()
+            return {"exito": True, "mensaje": "Sesión revocada"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al revocar sesión: {str(e)}"}
+    
+    def obtener_revocaciones(self):
+        """Entradas vigentes de la lista de revocados"""
+        try:
+            with self.conexion() as conexion, conexion.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute('''
+                    SELECT clave, fecha_revocacion, expira FROM sesiones_revocadas WHERE expira > %s
+                ''', (datetime.now(),))
+                filas = cursor.fetchall()
+            return {"exito": True, "revocaciones": [dict(f) for f in filas]}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al leer sesiones revocadas: {str(e)}"}
+
+def crear_base_datos(url=None, inicializar=True):
+    """
+    Elige el motor según la URL: postgresql://... usa PostgreSQL; sqlite:///ruta.db o ninguna URL usa SQLite
+    Sin URL se usa el archivo NOMBRE_BASE_DATOS: despliegues de un solo nodo y pruebas de carga sin red.
+    inicializar: crear o actualizar el esquema al conectar (False si ya lo hizo otro proceso)
+    """
+    if url and not url.startswith("sqlite:///"):
+        return BaseDatosPostgres(url, inicializar)
+    from base_datos_sqlite import BaseDatosSQLite
+    return BaseDatosSQLite(url[len("sqlite:///"):] if url else NOMBRE_BASE_DATOS, inicializar)
 
 # Para pruebas
 if __name__ == "__main__":
     # Prueba solo si tienes DATABASE_URL en .env
     try:
-        db = BaseDatos()
+        db = BaseDatosPostgres()
         print("✅ Conexión exitosa a PostgreSQL")
     except Exception as e:
         print(f"❌ Error: {e}")
\ No newline at end of file
@@ -0,0 +1,650 @@
+# Implementación SQLite de BaseDatos: un archivo local en modo WAL, sin servidor ni red
+import csv
+import io
+import itertools
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from base_datos import (BaseDatos, VERSION_ESQUEMA, COLUMNAS_HISTORIAL, registrar_consulta, mes_de, sumar_meses,
+                        verificar_cabecera_csv)
+from configuracion import (NOMBRE_BASE_DATOS, SQLITE_TIMEOUT, HISTORIAL_FILAS_POR_LOTE, ADMIN_USUARIO, ADMIN_CONTRASENA,
+                           HISTORIAL_RETENCION_MESES, HISTORIAL_RETENCION_DESACOPLAR, HISTORIAL_PURGA_LOTE)
+
+# Fechas como texto ISO 8601 con microsegundos: el orden de texto coincide con el cronológico
+sqlite3.register_adapter(datetime, lambda fecha: fecha.isoformat(timespec="microseconds"))
+sqlite3.register_converter("TIMESTAMP", lambda valor: datetime.fromisoformat(valor.decode()))
+
+PERIODOS = {"dia": "date(fecha_escaneo)", "semana": "date(fecha_escaneo, 'weekday 0', '-6 days')"}
+
+class ConexionSQLiteMedida(sqlite3.Connection):
+    """Conexión que registra la duración de cada sentencia en las métricas de base de datos"""
+    def execute(self, consulta, parametros=()):
+        inicio = time.perf_counter()
+        try: return super().execute(consulta, parametros)
+        finally: registrar_consulta(consulta, time.perf_counter() - inicio)
+
+    def executemany(self, consulta, lista_parametros):
+        inicio = time.perf_counter()
+        try: return super().executemany(consulta, lista_parametros)
+        finally: registrar_consulta(consulta, time.perf_counter() - inicio)
+
+class BaseDatosSQLite(BaseDatos):
+    nombre = "sqlite"
+
+    def __init__(self, ruta=NOMBRE_BASE_DATOS, inicializar=True):
+        """
+        ruta: archivo de la base de datos (se crea si no existe)
+        inicializar: False si otro proceso ya preparó el esquema (trabajadores de servidor.py)
+        Cada hilo usa su propia conexión; WAL permite lecturas concurrentes con un escritor.
+        """
+        self.ruta = ruta
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conexiones = []
+        self._en_uso = 0
+        if inicializar: self.inicializar_base_datos()
+
+    def _abrir(self):
+        conexion = sqlite3.connect(self.ruta, timeout=SQLITE_TIMEOUT, isolation_level=None, check_same_thread=False,
+                                   detect_types=sqlite3.PARSE_DECLTYPES, factory=ConexionSQLiteMedida)
+        conexion.row_factory = sqlite3.Row
+        conexion.execute("PRAGMA journal_mode = WAL")
+        conexion.execute("PRAGMA synchronous = NORMAL")  # con WAL no se pierde consistencia, solo la última transacción ante un corte de luz
+        conexion.execute("PRAGMA foreign_keys = ON")
+        with self._lock: self._conexiones.append(conexion)
+        return conexion
+
+    @contextmanager
+    def conexion(self):
+        """Conexión del hilo actual en modo autocommit: `with db.conexion() as c:`"""
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            conexion = self._local.conexion = self._abrir()
+        with self._lock: self._en_uso += 1
+        try:
+            yield conexion
+        finally:
+            with self._lock: self._en_uso -= 1
+
+    @contextmanager
+    def transaccion(self):
+        """BEGIN IMMEDIATE toma el bloqueo de escritura al empezar: sin interbloqueos al pasar de leer a escribir"""
+        with self.conexion() as conexion:
+            conexion.execute("BEGIN IMMEDIATE")
+            try:
+                yield conexion
+                conexion.execute("COMMIT")
+            except BaseException:
+                if conexion.in_transaction: conexion.execute("ROLLBACK")
+                raise
+
+    def metricas_pool(self):
+        with self._lock:
+            return {"motor": "sqlite", "total": len(self._conexiones), "en_uso": self._en_uso, "ruta": self.ruta}
+
+    def cerrar(self):
+        with self._lock:
+            conexiones, self._conexiones = self._conexiones, []
+        for conexion in conexiones:
+            try: conexion.close()
+            except Exception: pass
+        self._local = threading.local()
+
+    def _version_esquema(self, conexion):
+        if not conexion.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'esquema_version'").fetchone():
+            return 0
+        fila = conexion.execute("SELECT version FROM esquema_version").fetchone()
+        return fila[0] if fila else 0
+
+    def inicializar_base_datos(self):
+        """Crea o actualiza el esquema solo si su versión no es la actual; el bloqueo de escritura serializa procesos"""
+        with self.conexion() as conexion:
+            if self._version_esquema(conexion) >= VERSION_ESQUEMA:
+                print(f"✅ Esquema SQLite al día (versión {VERSION_ESQUEMA})")
+                return False
+        with self.transaccion() as conexion:
+            if self._version_esquema(conexion) >= VERSION_ESQUEMA:
+                print(f"✅ Esquema SQLite al día (versión {VERSION_ESQUEMA})")
+                return False
+            self._crear_esquema(conexion)
+            conexion.execute('''
+                INSERT INTO usuarios (nombre_usuario, contrasena, fecha_creacion) VALUES (?, ?, ?)
+                ON CONFLICT (nombre_usuario) DO NOTHING
+            ''', (ADMIN_USUARIO, self.encriptar_contrasena(ADMIN_CONTRASENA), datetime.now()))
+            conexion.execute('''
+                INSERT INTO esquema_version (id, version, fecha_actualizacion) VALUES (1, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET version = excluded.version, fecha_actualizacion = excluded.fecha_actualizacion
+            ''', (VERSION_ESQUEMA, datetime.now()))
+        print(f"✅ Base de datos SQLite inicializada correctamente (versión {VERSION_ESQUEMA})")
+        return True
+
+    def _crear_esquema(self, conexion):
+        """Mismo modelo que PostgreSQL; los índices compuestos cubren también las búsquedas por una sola columna"""
+        conexion.execute('''
+            CREATE TABLE IF NOT EXISTS usuarios (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nombre_usuario TEXT UNIQUE NOT NULL,
+                contrasena TEXT NOT NULL,
+                fecha_creacion TIMESTAMP NOT NULL
+            )
+        ''')
+        conexion.execute('''
+            CREATE TABLE IF NOT EXISTS historial_escaneos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+                nombre_usuario TEXT NOT NULL,
+                ruta_imagen TEXT,
+                resultado TEXT NOT NULL,
+                confianza REAL NOT NULL,
+                fecha_escaneo TIMESTAMP NOT NULL
+            )
+        ''')
+        conexion.execute('''
+            CREATE INDEX IF NOT EXISTS idx_historial_usuario_fecha_id
+            ON historial_escaneos (usuario_id, fecha_escaneo DESC, id DESC)
+        ''')
+        conexion.execute('''
+            CREATE INDEX IF NOT EXISTS idx_historial_fecha_id
+            ON historial_escaneos (fecha_escaneo DESC, id DESC)
+        ''')
+        conexion.execute('''
+            CREATE TABLE IF NOT EXISTS cache_analisis (
+                hash_imagen TEXT PRIMARY KEY,
+                predicciones TEXT NOT NULL,
+                analisis_colores TEXT NOT NULL,
+                fecha_creacion TIMESTAMP NOT NULL
+            )
+        ''')
+        conexion.execute('''
+            CREATE TABLE IF NOT EXISTS estadisticas_usuario (
+                usuario_id INTEGER PRIMARY KEY REFERENCES usuarios (id) ON DELETE CASCADE,
+                total_escaneos INTEGER NOT NULL DEFAULT 0,
+                plantas_enfermas INTEGER NOT NULL DEFAULT 0,
+                suma_confianza REAL NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        if not any(c["name"] == "version" for c in conexion.execute("PRAGMA table_info(estadisticas_usuario)")):
+            conexion.execute("ALTER TABLE estadisticas_usuario ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        conexion.execute('''
+            CREATE TABLE IF NOT EXISTS trabajos_analisis (
+                id TEXT PRIMARY KEY,
+                usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+                nombre_usuario TEXT NOT NULL,
+                ruta_imagen TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                resultado TEXT,
+                mensaje TEXT,
+                fecha_creacion TIMESTAMP NOT NULL,
+                fecha_actualizacion TIMESTAMP NOT NULL
+            )
+        ''')
+        conexion.execute('''
+            CREATE INDEX IF NOT EXISTS idx_trabajos_pendientes
+            ON trabajos_analisis (fecha_creacion) WHERE estado = 'pendiente'
+        ''')
+        conexion.execute('''
+            CREATE TABLE IF NOT EXISTS sesiones_revocadas (
+                clave TEXT PRIMARY KEY,
+                fecha_revocacion TIMESTAMP NOT NULL,
+                expira TIMESTAMP NOT NULL
+            )
+        ''')
+        conexion.execute('''
+            CREATE TABLE IF NOT EXISTS esquema_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL,
+                fecha_actualizacion TIMESTAMP NOT NULL
+            )
+        ''')
+
+    def crear_usuario(self, nombre_usuario, contrasena):
+        if self.nombre_reservado(nombre_usuario):
+            return {"exito": False, "mensaje": "El usuario ya existe"}
+        try:
+            with self.transaccion() as conexion:
+                cursor = conexion.execute('''
+                    INSERT INTO usuarios (nombre_usuario, contrasena, fecha_creacion) VALUES (?, ?, ?)
+                ''', (nombre_usuario, self.encriptar_contrasena(contrasena), datetime.now()))
+            return {"exito": True, "mensaje": "Usuario creado exitosamente", "usuario_id": cursor.lastrowid}
+        except sqlite3.IntegrityError:
+            return {"exito": False, "mensaje": "El usuario ya existe"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al crear usuario: {str(e)}"}
+
+    def verificar_usuario(self, nombre_usuario, contrasena):
+        try:
+            with self.conexion() as conexion:
+                usuario = conexion.execute('''
+                    SELECT id, nombre_usuario FROM usuarios WHERE nombre_usuario = ? AND contrasena = ?
+                ''', (nombre_usuario, self.encriptar_contrasena(contrasena))).fetchone()
+            if usuario:
+                return {
+                    "exito": True,
+                    "mensaje": "Inicio de sesión exitoso",
+                    "usuario": {"id": usuario["id"], "nombre_usuario": usuario["nombre_usuario"]}
+                }
+            return {"exito": False, "mensaje": "Usuario o contraseña incorrectos"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al verificar usuario: {str(e)}"}
+
+    def listar_usuarios(self):
+        try:
+            with self.conexion() as conexion:
+                usuarios = conexion.execute('''
+                    SELECT u.id, u.nombre_usuario, u.fecha_creacion, COALESCE(e.total_escaneos, 0) AS total_escaneos
+                    FROM usuarios u
+                    LEFT JOIN estadisticas_usuario e ON e.usuario_id = u.id
+                    ORDER BY u.fecha_creacion DESC
+                ''').fetchall()
+            return {"exito": True, "usuarios": [self._formatear_usuario(u) for u in usuarios]}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al listar usuarios: {str(e)}"}
+
+    def eliminar_usuario(self, usuario_id):
+        """Como en PostgreSQL, el historial se borra antes por lotes y no en una sola transacción por la cascada"""
+        try:
+            with self.conexion() as conexion:
+                fila = conexion.execute("SELECT lower(nombre_usuario) = lower(?) FROM usuarios WHERE id = ?", (ADMIN_USUARIO, usuario_id)).fetchone()
+            if fila and fila[0]:
+                return {"exito": False, "mensaje": "No eliminar admin", "protegido": True}
+            if fila:
+                r = self.purgar_historial(usuario_id=usuario_id)
+                if not r["exito"]: return {"exito": False, "mensaje": f"Error al eliminar usuario: {r['mensaje']}"}
+            with self.transaccion() as conexion:
+                eliminados = conexion.execute('''
+                    DELETE FROM usuarios WHERE id = ? AND lower(nombre_usuario) <> lower(?)
+                ''', (usuario_id, ADMIN_USUARIO)).rowcount
+                protegido = not eliminados and conexion.execute("SELECT 1 FROM usuarios WHERE id = ?", (usuario_id,)).fetchone()
+            if protegido:
+                return {"exito": False, "mensaje": "No eliminar admin", "protegido": True}
+            return {"exito": True, "mensaje": "Eliminado", "eliminados": eliminados}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al eliminar usuario: {str(e)}"}
+
+    def cambiar_contrasena(self, usuario_id, contrasena):
+        try:
+            with self.transaccion() as conexion:
+                conexion.execute("UPDATE usuarios SET contrasena = ? WHERE id = ?", (self.encriptar_contrasena(contrasena), usuario_id))
+            return {"exito": True, "mensaje": "Actualizada"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al cambiar contraseña: {str(e)}"}
+
+    def guardar_escaneo(self, usuario_id, nombre_usuario, ruta_imagen, resultado, confianza):
+        r = self.guardar_escaneos_lote([(usuario_id, nombre_usuario, ruta_imagen, resultado, confianza)])
+        if not r["exito"]: return {"exito": False, "mensaje": r["mensaje"].replace("escaneos", "escaneo")}
+        return {"exito": True, "mensaje": "Escaneo guardado exitosamente", "escaneo_id": r["escaneo_ids"][0]}
+
+    def guardar_escaneos_lote(self, registros):
+        """Todos los INSERT en una transacción: SQLite no paga ida y vuelta de red por sentencia"""
+        try:
+            fecha_actual = datetime.now()
+            ids = []
+            with self.transaccion() as conexion:
+                for registro in registros:
+                    cursor = conexion.execute('''
+                        INSERT INTO historial_escaneos
+                        (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', tuple(registro[:5]) + (registro[5] if len(registro) > 5 else fecha_actual,))
+                    ids.append(cursor.lastrowid)
+                self._sumar_estadisticas(conexion, [(r[0], r[3], r[4]) for r in registros])
+            return {"exito": True, "mensaje": f"{len(ids)} escaneos guardados", "escaneo_ids": ids}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al guardar escaneos: {str(e)}"}
+
+    def _sumar_estadisticas(self, conexion, escaneos, signo=1):
+        """Suma (o resta, con signo=-1) escaneos (usuario_id, resultado, confianza) a los contadores"""
+        por_usuario = {}
+        for usuario_id, resultado, confianza in escaneos:
+            total, enfermas, suma = por_usuario.get(usuario_id, (0, 0, 0.0))
+            por_usuario[usuario_id] = (total + signo, enfermas + signo * (resultado == "Enferma"), suma + signo * confianza)
+        conexion.executemany('''
+            INSERT INTO estadisticas_usuario (usuario_id, total_escaneos, plantas_enfermas, suma_confianza, version)
+            VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (usuario_id) DO UPDATE SET
+                total_escaneos = total_escaneos + excluded.total_escaneos,
+                plantas_enfermas = plantas_enfermas + excluded.plantas_enfermas,
+                suma_confianza = suma_confianza + excluded.suma_confianza,
+                version = version + 1
+        ''', [(usuario_id,) + valores for usuario_id, valores in por_usuario.items()])
+
+    def eliminar_escaneo(self, escaneo_id):
+        try:
+            with self.transaccion() as conexion:
+                borrados = conexion.execute('''
+                    DELETE FROM historial_escaneos WHERE id = ? RETURNING usuario_id, resultado, confianza
+                ''', (escaneo_id,)).fetchall()
+                if borrados: self._sumar_estadisticas(conexion, [tuple(b) for b in borrados], signo=-1)
+            return {"exito": True, "mensaje": "Registro eliminado", "eliminados": len(borrados)}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al eliminar escaneo: {str(e)}"}
+
+    def eliminar_historial_completo(self):
+        """DELETE sin WHERE: SQLite lo resuelve vaciando la tabla entera, sin borrar fila a fila"""
+        try:
+            with self.transaccion() as conexion:
+                eliminados = conexion.execute("DELETE FROM historial_escaneos").rowcount
+                conexion.execute('''
+                    UPDATE estadisticas_usuario
+                    SET total_escaneos = 0, plantas_enfermas = 0, suma_confianza = 0, version = version + 1
+                ''')
+            return {"exito": True, "mensaje": f"Se eliminaron {eliminados} registros", "eliminados": eliminados}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al eliminar historial: {str(e)}"}
+
+    def purgar_historial(self, antes_de=None, usuario_id=None, lote=HISTORIAL_PURGA_LOTE):
+        """Sin particiones: borra en lotes de `lote` filas, con una transacción por lote para no retener el bloqueo de escritura"""
+        if antes_de is None and usuario_id is None: return self.eliminar_historial_completo()
+        try:
+            condiciones, parametros = [], []
+            if usuario_id is not None:
+                condiciones.append("usuario_id = ?")
+                parametros.append(usuario_id)
+            if antes_de is not None:
+                condiciones.append("fecha_escaneo < ?")
+                parametros.append(antes_de)
+            eliminados, lotes = 0, 0
+            while True:
+                with self.transaccion() as conexion:
+                    borrados = conexion.execute(f'''
+                        DELETE FROM historial_escaneos
+                        WHERE id IN (SELECT id FROM historial_escaneos WHERE {' AND '.join(condiciones)} LIMIT ?)
+                        RETURNING usuario_id, resultado, confianza
+                    ''', parametros + [lote]).fetchall()
+                    if borrados: self._sumar_estadisticas(conexion, [tuple(b) for b in borrados], signo=-1)
+                eliminados += len(borrados)
+                lotes += 1
+                if len(borrados) < lote: break
+            return {"exito": True, "mensaje": f"Se eliminaron {eliminados} registros", "eliminados": eliminados,
+                    "lotes": lotes, "particiones_retiradas": []}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al purgar historial: {str(e)}"}
+
+    def mantener_historial(self, retencion_meses=HISTORIAL_RETENCION_MESES, desacoplar=HISTORIAL_RETENCION_DESACOPLAR):
+        """Retención por purga en lotes de lo anterior al corte; `desacoplar` no aplica sin particiones"""
+        if retencion_meses <= 0:
+            return {"exito": True, "mensaje": "Retención desactivada", "eliminados": 0, "particiones_retiradas": []}
+        r = self.purgar_historial(antes_de=sumar_meses(mes_de(datetime.now()), -retencion_meses))
+        if not r["exito"]: return {"exito": False, "mensaje": f"Error en el mantenimiento del historial: {r['mensaje']}"}
+        if r["eliminados"]: print(f"🗑️ Retención del historial: {r['eliminados']} escaneos eliminados")
+        return {"exito": True, "mensaje": r["mensaje"], "eliminados": r["eliminados"], "particiones_retiradas": []}
+
+    def obtener_estadisticas(self, usuario_id):
+        try:
+            with self.conexion() as conexion:
+                fila = conexion.execute('''
+                    SELECT total_escaneos, plantas_enfermas, suma_confianza FROM estadisticas_usuario WHERE usuario_id = ?
+                ''', (usuario_id,)).fetchone()
+            if not fila: return {"exito": True, "estadisticas": self._formatear_estadisticas(0, 0, 0.0)}
+            return {"exito": True, "estadisticas": self._formatear_estadisticas(fila["total_escaneos"], fila["plantas_enfermas"], fila["suma_confianza"])}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener estadísticas: {str(e)}"}
+
+    def obtener_version_historial(self, usuario_id):
+        try:
+            with self.conexion() as conexion:
+                fila = conexion.execute("SELECT version FROM estadisticas_usuario WHERE usuario_id = ?", (usuario_id,)).fetchone()
+            return {"exito": True, "version": fila["version"] if fila else 0}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener versión del historial: {str(e)}"}
+
+    def obtener_estadisticas_periodo(self, usuario_id, agrupar="dia", desde=None):
+        """Semanas de lunes a domingo, como date_trunc('week') en PostgreSQL"""
+        periodo = PERIODOS[agrupar]
+        try:
+            with self.conexion() as conexion:
+                filas = conexion.execute(f'''
+                    SELECT {periodo} AS periodo,
+                           COUNT(*) AS total_escaneos,
+                           SUM(resultado = 'Enferma') AS plantas_enfermas,
+                           AVG(confianza) AS confianza_promedio
+                    FROM historial_escaneos
+                    WHERE usuario_id = ? AND (? IS NULL OR fecha_escaneo >= ?)
+                    GROUP BY periodo
+                    ORDER BY periodo DESC
+                ''', (usuario_id, desde, desde)).fetchall()
+            return {"exito": True, "series": [{
+                "periodo": fila["periodo"],
+                "total_escaneos": fila["total_escaneos"],
+                "plantas_enfermas": fila["plantas_enfermas"],
+                "plantas_sanas": fila["total_escaneos"] - fila["plantas_enfermas"],
+                "confianza_promedio": round(fila["confianza_promedio"], 2)
+            } for fila in filas]}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener estadísticas: {str(e)}"}
+
+    def _consulta_historial(self, usuario_id=None, despues_de=None):
+        condiciones, parametros = [], []
+        if usuario_id is not None:
+            condiciones.append("usuario_id = ?")
+            parametros.append(usuario_id)
+        if despues_de is not None:
+            condiciones.append("(fecha_escaneo, id) < (?, ?)")
+            parametros.extend(despues_de)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        sql = f'''
+            SELECT id, usuario_id, nombre_usuario, resultado, confianza, fecha_escaneo
+            FROM historial_escaneos {where}
+            ORDER BY fecha_escaneo DESC, id DESC
+        '''
+        return sql, parametros
+
+    def obtener_historial(self, usuario_id, limite=None, despues_de=None):
+        try:
+            sql, parametros = self._consulta_historial(usuario_id, despues_de)
+            if limite is not None:
+                sql += " LIMIT ?"
+                parametros.append(limite + 1)
+            with self.conexion() as conexion:
+                escaneos = conexion.execute(sql, parametros).fetchall()
+            return self._pagina_historial(escaneos, limite, usuario_id is None)
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener historial: {str(e)}"}
+
+    def iterar_historial(self, usuario_id=None, filas_por_lote=HISTORIAL_FILAS_POR_LOTE):
+        """Conexión propia: el generador se consume desde distintos hilos mientras se transmite la respuesta"""
+        sql, parametros = self._consulta_historial(usuario_id)
+        conexion = self._abrir()
+        try:
+            cursor = conexion.execute(sql, parametros)
+            while True:
+                escaneos = cursor.fetchmany(filas_por_lote)
+                if not escaneos: return
+                for escaneo in escaneos:
+                    yield self._formatear_escaneo(escaneo, usuario_id is None)
+        finally:
+            with self._lock:
+                if conexion in self._conexiones: self._conexiones.remove(conexion)
+            conexion.close()
+
+    def _consulta_exportacion(self, usuario_id=None, desde=None, hasta=None):
+        condiciones, parametros = [], []
+        if usuario_id is not None:
+            condiciones.append("usuario_id = ?")
+            parametros.append(usuario_id)
+        if desde is not None:
+            condiciones.append("fecha_escaneo >= ?")
+            parametros.append(desde)
+        if hasta is not None:
+            condiciones.append("fecha_escaneo < ?")
+            parametros.append(hasta)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        return f"SELECT {', '.join(COLUMNAS_HISTORIAL)} FROM historial_escaneos {where} ORDER BY fecha_escaneo, id", parametros
+
+    def lotes_historial(self, usuario_id=None, desde=None, hasta=None, filas_por_lote=HISTORIAL_FILAS_POR_LOTE):
+        """Conexión propia, como iterar_historial: el generador se consume desde distintos hilos"""
+        sql, parametros = self._consulta_exportacion(usuario_id, desde, hasta)
+        conexion = self._abrir()
+        conexion.row_factory = None  # tuplas simples: la exportación no necesita acceso por nombre
+        try:
+            cursor = conexion.execute(sql, parametros)
+            while lote := cursor.fetchmany(filas_por_lote):
+                yield lote
+        finally:
+            with self._lock:
+                if conexion in self._conexiones: self._conexiones.remove(conexion)
+            conexion.close()
+
+    def exportar_historial_csv(self, usuario_id=None, desde=None, hasta=None):
+        """Sin COPY: cada lote del cursor se escribe con el módulo csv y sale como un bloque de bytes"""
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer, lineterminator="\n")
+        escritor.writerow(COLUMNAS_HISTORIAL)
+        for lote in self.lotes_historial(usuario_id, desde, hasta):
+            escritor.writerows(lote)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell(): yield buffer.getvalue().encode()
+
+    def importar_historial_csv(self, archivo):
+        """Misma semántica que en PostgreSQL (asignación por nombre_usuario, todo o nada), con INSERT por lotes"""
+        try:
+            verificar_cabecera_csv(archivo.readline())
+            lector = csv.reader(io.TextIOWrapper(archivo, encoding="utf-8", newline=""))
+            leidos = importados = 0
+            with self.transaccion() as conexion:
+                usuarios = {nombre: usuario_id for usuario_id, nombre in conexion.execute("SELECT id, nombre_usuario FROM usuarios")}
+                while bloque := list(itertools.islice(lector, HISTORIAL_FILAS_POR_LOTE)):
+                    leidos += len(bloque)
+                    filas = [(usuarios[f[2]], f[2], f[3] or None, f[4], float(f[5]), datetime.fromisoformat(f[6]))
+                             for f in bloque if f[2] in usuarios]
+                    conexion.executemany('''
+                        INSERT INTO historial_escaneos
+                        (usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha_escaneo)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', filas)
+                    if filas: self._sumar_estadisticas(conexion, [(f[0], f[3], f[4]) for f in filas])
+                    importados += len(filas)
+            return {"exito": True, "mensaje": f"{importados} escaneos importados", "importados": importados, "omitidos": leidos - importados}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al importar historial: {str(e)}"}
+
+    def crear_trabajo(self, usuario_id, nombre_usuario, ruta_imagen, trabajo_id=None):
+        try:
+            trabajo_id = trabajo_id or str(uuid.uuid4())
+            fecha_actual = datetime.now()
+            with self.transaccion() as conexion:
+                conexion.execute('''
+                    INSERT INTO trabajos_analisis
+                    (id, usuario_id, nombre_usuario, ruta_imagen, fecha_creacion, fecha_actualizacion)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (trabajo_id, usuario_id, nombre_usuario, ruta_imagen, fecha_actual, fecha_actual))
+            return {"exito": True, "mensaje": "Análisis encolado", "trabajo_id": trabajo_id}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al encolar análisis: {str(e)}"}
+
+    def tomar_trabajo(self):
+        """BEGIN IMMEDIATE deja un solo escritor: dos procesos nunca toman el mismo trabajo"""
+        with self.transaccion() as conexion:
+            trabajo = conexion.execute('''
+                UPDATE trabajos_analisis
+                SET estado = 'procesando', intentos = intentos + 1, fecha_actualizacion = ?
+                WHERE id = (
+                    SELECT id FROM trabajos_analisis WHERE estado = 'pendiente' ORDER BY fecha_creacion LIMIT 1
+                )
+                RETURNING id, usuario_id, nombre_usuario, ruta_imagen, intentos
+            ''', (datetime.now(),)).fetchone()
+        return dict(trabajo) if trabajo else None
+
+    def _actualizar_trabajo(self, sql, parametros):
+        with self.transaccion() as conexion:
+            return conexion.execute(sql, parametros).rowcount
+
+    def completar_trabajo(self, trabajo_id, resultado):
+        return self._actualizar_trabajo('''
+            UPDATE trabajos_analisis SET estado = 'completado', resultado = ?, mensaje = NULL, fecha_actualizacion = ?
+            WHERE id = ?
+        ''', (json.dumps(resultado), datetime.now(), trabajo_id))
+
+    def fallar_trabajo(self, trabajo_id, mensaje, definitivo):
+        return self._actualizar_trabajo('''
+            UPDATE trabajos_analisis SET estado = ?, mensaje = ?, fecha_actualizacion = ? WHERE id = ?
+        ''', ("error" if definitivo else "pendiente", mensaje, datetime.now(), trabajo_id))
+
+    def liberar_trabajo(self, trabajo_id):
+        return self._actualizar_trabajo('''
+            UPDATE trabajos_analisis SET estado = 'pendiente', intentos = MAX(intentos - 1, 0), fecha_actualizacion = ?
+            WHERE id = ? AND estado = 'procesando'
+        ''', (datetime.now(), trabajo_id))
+
+    def reencolar_trabajos_huerfanos(self, timeout_segundos):
+        try:
+            return self._actualizar_trabajo('''
+                UPDATE trabajos_analisis SET estado = 'pendiente', fecha_actualizacion = ?
+                WHERE estado = 'procesando' AND fecha_actualizacion < ?
+            ''', (datetime.now(), datetime.now() - timedelta(seconds=timeout_segundos)))
+        except Exception:
+            return 0
+
+    def obtener_trabajo(self, trabajo_id):
+        try:
+            with self.conexion() as conexion:
+                trabajo = conexion.execute('''
+                    SELECT id, usuario_id, estado, intentos, resultado, mensaje, fecha_creacion, fecha_actualizacion
+                    FROM trabajos_analisis WHERE id = ?
+                ''', (trabajo_id,)).fetchone()
+            if not trabajo:
+                return {"exito": False, "mensaje": "Trabajo no encontrado"}
+            trabajo = dict(trabajo)
+            if trabajo["resultado"] is not None: trabajo["resultado"] = json.loads(trabajo["resultado"])
+            return {"exito": True, "trabajo": self._formatear_trabajo(trabajo)}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al obtener trabajo: {str(e)}"}
+
+    def obtener_cache_analisis(self, hash_imagen, ttl_segundos):
+        try:
+            with self.conexion() as conexion:
+                fila = conexion.execute('''
+                    SELECT predicciones, analisis_colores FROM cache_analisis WHERE hash_imagen = ? AND fecha_creacion > ?
+                ''', (hash_imagen, datetime.now() - timedelta(seconds=ttl_segundos))).fetchone()
+            if fila:
+                return {"predicciones": json.loads(fila["predicciones"]), "analisis_colores": json.loads(fila["analisis_colores"])}
+            return None
+        except Exception:
+            return None
+
+    def guardar_cache_analisis(self, hash_imagen, predicciones, analisis_colores):
+        try:
+            with self.transaccion() as conexion:
+                conexion.execute('''
+                    INSERT INTO cache_analisis (hash_imagen, predicciones, analisis_colores, fecha_creacion)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (hash_imagen) DO UPDATE
+                    SET predicciones = excluded.predicciones,
+                        analisis_colores = excluded.analisis_colores,
+                        fecha_creacion = excluded.fecha_creacion
+                ''', (hash_imagen, json.dumps(predicciones), json.dumps(analisis_colores), datetime.now()))
+            return {"exito": True, "mensaje": "Análisis guardado en caché"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al guardar caché: {str(e)}"}
+
+    def revocar_sesion(self, clave, expira, fecha_revocacion=None):
+        try:
+            with self.transaccion() as conexion:
+                ahora = datetime.now()
+                conexion.execute("DELETE FROM sesiones_revocadas WHERE expira < ?", (ahora,))
+                conexion.execute('''
+                    INSERT INTO sesiones_revocadas (clave, fecha_revocacion, expira) VALUES (?, ?, ?)
+                    ON CONFLICT (clave) DO UPDATE
+                    SET fecha_revocacion = excluded.fecha_revocacion, expira = excluded.expira
+                ''', (clave, fecha_revocacion or ahora, expira))
+            return {"exito": True, "mensaje": "Sesión revocada"}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al revocar sesión: {str(e)}"}
+
+    def obtener_revocaciones(self):
+        try:
+            with self.conexion() as conexion:
+                filas = conexion.execute('''
+                    SELECT clave, fecha_revocacion, expira FROM sesiones_revocadas WHERE expira > ?
+                ''', (datetime.now(),)).fetchall()
+            return {"exito": True, "revocaciones": [dict(f) for f in filas]}
+        except Exception as e:
+            return {"exito": False, "mensaje": f"Error al leer sesiones revocadas: {str(e)}"}
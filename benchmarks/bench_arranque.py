@@ -0,0 +1,66 @@
+# Benchmark de arranque: tiempo de importación de main y tiempo hasta la primera respuesta
+# Uso: DATABASE_URL=... python benchmarks/bench_arranque.py [--repeticiones N] [--puerto P]
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def medir_importacion():
+    """Segundos que tarda `import main` en un intérprete nuevo (incluye la inicialización de la base de datos)"""
+    codigo = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    salida = subprocess.run([sys.executable, "-c", codigo], cwd=RAIZ, capture_output=True, text=True, check=True)
+    return float(salida.stdout.strip().splitlines()[-1])
+
+def medir_primera_respuesta(puerto, limite=60):
+    """Segundos desde que se lanza uvicorn hasta que GET / responde 200"""
+    inicio = time.perf_counter()
+    proceso = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(puerto), "--log-level", "warning"],
+                               cwd=RAIZ, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while time.perf_counter() - inicio < limite:
+            if proceso.poll() is not None:
+                raise RuntimeError(f"uvicorn terminó al arrancar: {proceso.stderr.read().decode()[-500:]}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/", timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - inicio
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"Sin respuesta tras {limite}s")
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--puerto", type=int, default=0)
+    args = parser.parse_args()
+    if not os.getenv("DATABASE_URL"):
+        sys.exit("❌ Define DATABASE_URL para medir el arranque")
+
+    importaciones, respuestas = [], []
+    for _ in range(args.repeticiones):
+        importaciones.append(medir_importacion())
+        respuestas.append(medir_primera_respuesta(args.puerto or puerto_libre()))
+    resumen = {
+        "repeticiones": args.repeticiones,
+        "importacion_s": {"mediana": round(statistics.median(importaciones), 4), "min": round(min(importaciones), 4), "max": round(max(importaciones), 4)},
+        "primera_respuesta_s": {"mediana": round(statistics.median(respuestas), 4), "min": round(min(respuestas), 4), "max": round(max(respuestas), 4)}
+    }
+    print(json.dumps(resumen, indent=2))
+
+if __name__ == "__main__":
+    main()
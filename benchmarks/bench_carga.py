@@ -0,0 +1,227 @@
+# Prueba de carga de punta a punta: la app real contra SQLite local y un servidor de inferencia falso
+# Uso: python benchmarks/bench_carga.py [--concurrencia N] [--duracion S] [--mezcla login=1,analizar=2,historial=4,estadisticas=3]
+#      [--latencia-hf S] [--trabajadores N] [--salida resultado.json] [--comparar linea_base.json --tolerancia 0.1]
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+from servidor_inferencia_falso import ServidorInferenciaFalso
+
+OPERACIONES = ("login", "analizar", "historial", "estadisticas")
+PERCENTILES = (50, 95, 99)
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def leer_mezcla(texto):
+    """"login=1,analizar=2" -> {"login": 1.0, "analizar": 2.0}"""
+    mezcla = {}
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition("=")
+        if nombre.strip() not in OPERACIONES:
+            raise argparse.ArgumentTypeError(f"Operación desconocida: {nombre}")
+        mezcla[nombre.strip()] = float(peso or 1)
+    return mezcla
+
+def imagenes_de_prueba(cantidad, lado, semilla=0):
+    """JPEGs de hojas con manchas; con pocas imágenes distintas se ejercita también la caché"""
+    from PIL import Image, ImageDraw
+    rng = random.Random(semilla)
+    imagenes = []
+    for _ in range(cantidad):
+        img = Image.new("RGB", (lado, lado * 3 // 4), (rng.randint(40, 80), rng.randint(120, 170), rng.randint(30, 60)))
+        dibujo = ImageDraw.Draw(img)
+        for _ in range(rng.randint(0, 12)):
+            x, y, r = rng.randrange(lado), rng.randrange(lado * 3 // 4), rng.randint(5, lado // 10)
+            dibujo.ellipse((x - r, y - r, x + r, y + r), fill=rng.choice([(110, 80, 40), (30, 30, 30), (200, 200, 90)]))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=88)
+        imagenes.append(buf.getvalue())
+    return imagenes
+
+def percentil(ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not ordenados: return None
+    return ordenados[min(len(ordenados) - 1, max(0, math.ceil(p / 100 * len(ordenados)) - 1))]
+
+def resumir(latencias, errores, duracion):
+    ordenadas = sorted(latencias)
+    total = len(ordenadas) + errores
+    resumen = {"peticiones": total, "errores": errores, "req_s": round(total / duracion, 2) if duracion else 0.0}
+    for p in PERCENTILES:
+        valor = percentil(ordenadas, p)
+        resumen[f"p{p}_ms"] = round(valor * 1000, 2) if valor is not None else None
+    resumen["max_ms"] = round(ordenadas[-1] * 1000, 2) if ordenadas else None
+    return resumen
+
+def arrancar_servidor(puerto, carpeta, url_hf, database_url, trabajadores=1, limite=60):
+    """
+    uvicorn con main:app en un proceso aparte, trabajando dentro de `carpeta` (base SQLite e imágenes)
+    trabajadores: más de 1 arranca el supervisor de servidor.py con ese número de procesos
+    """
+    entorno = dict(os.environ, PYTHONPATH=RAIZ, HUGGINGFACE_API_URL=url_hf, CLASIFICADOR_BACKEND="huggingface",
+                   DATABASE_URL=database_url or f"sqlite:///{os.path.join(carpeta, 'bench.db')}")
+    if trabajadores > 1:
+        comando = [sys.executable, "-c", f"from servidor import servir; servir(trabajadores={trabajadores}, host='127.0.0.1', puerto={puerto})"]
+    else:
+        comando = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(puerto), "--log-level", "warning"]
+    proceso = subprocess.Popen(comando, cwd=carpeta, env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError(f"uvicorn terminó al arrancar: {proceso.stderr.read().decode()[-500:]}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/", timeout=1) as r:
+                if r.status == 200: return proceso
+        except OSError:
+            time.sleep(0.05)
+    proceso.terminate()
+    raise TimeoutError(f"Sin respuesta tras {limite}s")
+
+def rss_pico_mb(proceso):
+    """RSS máximo del servidor (del mayor proceso si hay varios trabajadores): ru_maxrss de los hijos ya esperados (KB en Linux, bytes en macOS)"""
+    proceso.terminate()
+    proceso.wait()
+    maximo = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(maximo / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+async def generar_carga(base, args, imagenes):
+    import httpx
+    limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+    async with httpx.AsyncClient(base_url=base, limits=limites, timeout=120) as cliente:
+        # Usuarios de prueba, registrados y con sesión iniciada una vez antes de medir
+        usuarios = []
+        for i in range(args.usuarios):
+            nombre = f"bench_{i}"
+            await cliente.post("/api/registro", data={"nombre_usuario": nombre, "contrasena": "bench"})
+            r = await cliente.post("/api/login", data={"nombre_usuario": nombre, "contrasena": "bench"})
+            usuarios.append({**r.json()["usuario"], "cabeceras": {"Authorization": f"Bearer {r.json()['token']}"}})
+
+        operaciones = list(args.mezcla)
+        pesos = [args.mezcla[o] for o in operaciones]
+        muestras = {o: [] for o in operaciones}
+        errores = {o: 0 for o in operaciones}
+        rng = random.Random(args.semilla)
+
+        async def peticion(operacion):
+            u = rng.choice(usuarios)
+            if operacion == "login":
+                return await cliente.post("/api/login", data={"nombre_usuario": u["nombre_usuario"], "contrasena": "bench"})
+            if operacion == "analizar":
+                archivos = {"imagen": ("hoja.jpg", rng.choice(imagenes), "image/jpeg")}
+                return await cliente.post("/api/analizar", files=archivos, headers=u["cabeceras"])
+            if operacion == "historial":
+                return await cliente.get(f"/api/historial/{u['id']}", params={"limite": 50}, headers=u["cabeceras"])
+            return await cliente.get(f"/api/estadisticas/{u['id']}", headers=u["cabeceras"])
+
+        inicio_medicion = time.perf_counter() + args.calentamiento
+        fin = inicio_medicion + args.duracion
+
+        async def trabajador():
+            while (ahora := time.perf_counter()) < fin:
+                operacion = rng.choices(operaciones, pesos)[0]
+                try:
+                    r = await peticion(operacion)
+                    ok = r.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                if ahora < inicio_medicion: continue
+                if ok: muestras[operacion].append(time.perf_counter() - ahora)
+                else: errores[operacion] += 1
+
+        await asyncio.gather(*[trabajador() for _ in range(args.concurrencia)])
+        duracion = time.perf_counter() - inicio_medicion
+
+    todas = [x for o in operaciones for x in muestras[o]]
+    resultado = {
+        "total": resumir(todas, sum(errores.values()), duracion),
+        "por_operacion": {o: resumir(muestras[o], errores[o], duracion) for o in operaciones},
+        "duracion_s": round(duracion, 2)
+    }
+    return resultado
+
+def comparar(actual, base, tolerancia):
+    """Diferencias relativas frente a la línea base; retorna las métricas que empeoraron más que `tolerancia`"""
+    regresiones = []
+    print(f"{'métrica':<32}{'base':>12}{'actual':>12}{'cambio':>10}")
+    for ambito in ["total"] + sorted(actual["por_operacion"]):
+        a = actual["total"] if ambito == "total" else actual["por_operacion"][ambito]
+        b = base["total"] if ambito == "total" else base.get("por_operacion", {}).get(ambito)
+        if not b: continue
+        for clave in ["req_s"] + [f"p{p}_ms" for p in PERCENTILES]:
+            if not a.get(clave) or not b.get(clave): continue
+            cambio = (a[clave] - b[clave]) / b[clave]
+            peor = cambio < -tolerancia if clave == "req_s" else cambio > tolerancia
+            print(f"{ambito + '.' + clave:<32}{b[clave]:>12}{a[clave]:>12}{cambio:>+10.1%}{'  ⚠️' if peor else ''}")
+            if peor: regresiones.append(f"{ambito}.{clave}")
+    if base.get("rss_pico_mb") and actual.get("rss_pico_mb"):
+        cambio = (actual["rss_pico_mb"] - base["rss_pico_mb"]) / base["rss_pico_mb"]
+        print(f"{'rss_pico_mb':<32}{base['rss_pico_mb']:>12}{actual['rss_pico_mb']:>12}{cambio:>+10.1%}{'  ⚠️' if cambio > tolerancia else ''}")
+        if cambio > tolerancia: regresiones.append("rss_pico_mb")
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API con dependencias locales")
+    parser.add_argument("--concurrencia", type=int, default=16, help="clientes simultáneos")
+    parser.add_argument("--duracion", type=float, default=20, help="segundos medidos")
+    parser.add_argument("--calentamiento", type=float, default=3, help="segundos iniciales que no se miden")
+    parser.add_argument("--mezcla", type=leer_mezcla, default=leer_mezcla("login=1,analizar=2,historial=4,estadisticas=3"))
+    parser.add_argument("--latencia-hf", type=float, default=0.15, help="latencia del servidor de inferencia falso (s)")
+    parser.add_argument("--usuarios", type=int, default=20)
+    parser.add_argument("--imagenes", type=int, default=40, help="imágenes distintas (menos imágenes = más aciertos de caché)")
+    parser.add_argument("--lado-imagen", type=int, default=1600, help="ancho en píxeles de las imágenes generadas")
+    parser.add_argument("--database-url", default=None, help="por defecto, SQLite en una carpeta temporal")
+    parser.add_argument("--trabajadores", type=int, default=1, help="procesos del servidor (servidor.py si es más de 1)")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", help="archivo JSON donde guardar el resultado")
+    parser.add_argument("--comparar", help="resultado JSON previo usado como línea base")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="empeoramiento relativo admitido al comparar")
+    args = parser.parse_args()
+
+    imagenes = imagenes_de_prueba(args.imagenes, args.lado_imagen, args.semilla)
+    with tempfile.TemporaryDirectory(prefix="bench_carga_") as carpeta, \
+            ServidorInferenciaFalso(retardo=args.latencia_hf) as hf:
+        puerto = puerto_libre()
+        servidor = arrancar_servidor(puerto, carpeta, hf.url, args.database_url, args.trabajadores)
+        try:
+            resultado = asyncio.run(generar_carga(f"http://127.0.0.1:{puerto}", args, imagenes))
+        finally:
+            rss = rss_pico_mb(servidor)
+
+    resultado["rss_pico_mb"] = rss
+    resultado["configuracion"] = {
+        "concurrencia": args.concurrencia, "duracion_s": args.duracion, "mezcla": args.mezcla,
+        "latencia_hf_s": args.latencia_hf, "usuarios": args.usuarios, "imagenes": args.imagenes,
+        "lado_imagen": args.lado_imagen, "motor": "postgres" if args.database_url else "sqlite",
+        "trabajadores": args.trabajadores
+    }
+    resultado["llamadas_hf"] = hf.peticiones
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w") as f: f.write(texto + "\n")
+    print(texto)
+
+    if args.comparar:
+        with open(args.comparar) as f: base = json.load(f)
+        regresiones = comparar(resultado, base, args.tolerancia)
+        if regresiones:
+            sys.exit(f"❌ Regresiones frente a {args.comparar}: {', '.join(regresiones)}")
+        print("✅ Sin regresiones frente a la línea base")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Micro-benchmark de analizar_colores_hongos y del análisis por zonas: tiempo, memoria pico y precisión
+# Uso: python benchmarks/bench_colores.py [--repeticiones N]
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from procesamiento_imagen import analizar_colores_hongos, analizar_colores_por_zonas, TablasIntegrales, REJILLA_ZONAS
+from configuracion import TAMANO_ANALISIS_COLORES
+
+TAMANOS = [(640, 480), (1600, 1200), (2592, 1944), (4000, 3000)]
+
+def analizar_colores_referencia(img_array):
+    """Implementación original en float64, usada como referencia de precisión"""
+    r, g, b = img_array[:,:,0].astype(float), img_array[:,:,1].astype(float), img_array[:,:,2].astype(float)
+    lum = 0.299*r + 0.587*g + 0.114*b
+    osc = np.sum(lum < 60) / lum.size * 100
+    mar = np.sum((r>80)&(r<150)&(g>50)&(g<120)&(b<80)) / lum.size * 100
+    ama = np.sum((r>180)&(g>180)&(b<120)) / lum.size * 100
+    score = (35 if osc>10 else 0) + (40 if mar>3 else 0) + (25 if ama>2 else 0)
+    return {"score": score, "detalles": {"oscuras": osc, "marrones": mar, "amarillas": ama}}
+
+def hoja_sintetica(ancho, alto, semilla=0):
+    """Hoja verde con ruido y manchas marrones, oscuras y amarillas"""
+    rng = np.random.default_rng(semilla)
+    base = np.clip(rng.normal((60, 140, 50), 12, (alto, ancho, 3)), 0, 255).astype(np.uint8)
+    img = Image.fromarray(base)
+    dibujo = ImageDraw.Draw(img)
+    for color, n in (((120, 80, 40), 40), ((25, 20, 15), 25), ((210, 200, 60), 20)):
+        for _ in range(n):
+            x, y = rng.integers(0, ancho), rng.integers(0, alto)
+            radio = int(rng.integers(ancho // 80, ancho // 25))
+            dibujo.ellipse((x - radio, y - radio, x + radio, y + radio), fill=color)
+    return np.asarray(img)
+
+def medir(funcion, img_array, repeticiones):
+    """Retorna (resultado, ms por llamada, memoria pico en MB)"""
+    funcion(img_array)
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        resultado = funcion(img_array)
+    ms = (time.perf_counter() - inicio) / repeticiones * 1000
+    tracemalloc.start()
+    funcion(img_array)
+    pico = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return resultado, ms, pico
+
+def error_maximo(a, b):
+    return max(abs(a["detalles"][k] - b["detalles"][k]) for k in ("oscuras", "marrones", "amarillas"))
+
+def consultas_por_segundo(img_array, consultas=100_000):
+    """Rectángulos aleatorios contados sobre las tablas ya construidas (el coste no depende del tamaño)"""
+    tablas = TablasIntegrales(img_array)
+    rng = np.random.default_rng(0)
+    ys, xs = np.sort(rng.integers(0, tablas.alto + 1, (consultas, 2))), np.sort(rng.integers(0, tablas.ancho + 1, (consultas, 2)))
+    inicio = time.perf_counter()
+    for (y0, y1), (x0, x1) in zip(ys.tolist(), xs.tolist()): tablas.contar(y0, x0, y1, x1)
+    return consultas / (time.perf_counter() - inicio)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'tamaño':>11} {'variante':<22} {'ms':>9} {'pico MB':>9} {'err máx %':>10} {'score':>6}")
+    for ancho, alto in TAMANOS:
+        img = hoja_sintetica(ancho, alto)
+        reducida = Image.fromarray(img)
+        reducida.thumbnail((TAMANO_ANALISIS_COLORES, TAMANO_ANALISIS_COLORES), Image.Resampling.NEAREST)
+        reducida = np.asarray(reducida)
+        referencia, ms, pico = medir(analizar_colores_referencia, img, args.repeticiones)
+        variantes = [
+            ("float64 (referencia)", referencia, ms, pico),
+            ("uint16 completa", *medir(analizar_colores_hongos, img, args.repeticiones)),
+            ("uint16 paso=2", *medir(lambda a: analizar_colores_hongos(a, paso=2), img, args.repeticiones)),
+            (f"uint16 reducida {TAMANO_ANALISIS_COLORES}px", *medir(analizar_colores_hongos, reducida, args.repeticiones)),
+            (f"zonas {REJILLA_ZONAS}x{REJILLA_ZONAS} completa", *medir(analizar_colores_por_zonas, img, args.repeticiones)),
+            (f"zonas reducida {TAMANO_ANALISIS_COLORES}px", *medir(analizar_colores_por_zonas, reducida, args.repeticiones)),
+        ]
+        for nombre, resultado, ms, pico in variantes:
+            coincide = "ok" if resultado["score"] == referencia["score"] else "DIF"
+            print(f"{ancho:>5}x{alto:<5} {nombre:<22} {ms:>9.2f} {pico:>9.2f} {error_maximo(resultado, referencia):>10.3f} {coincide:>6}")
+        print(f"{ancho:>5}x{alto:<5} consultas de región en O(1): {consultas_por_segundo(img):,.0f}/s")
+
+if __name__ == "__main__":
+    main()
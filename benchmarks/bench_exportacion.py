@@ -0,0 +1,77 @@
+# Rendimiento de la importación y exportación masiva del historial frente a guardar escaneo por escaneo
+# Uso: python benchmarks/bench_exportacion.py [--filas 1000000] [--usuarios 100] [--fila-a-fila 2000]
+#      [--database-url postgresql://... (base desechable: se crean y borran usuarios bench_exp_*)]
+import argparse
+import csv
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from base_datos import crear_base_datos, COLUMNAS_HISTORIAL
+from exportacion import parquet_por_lotes
+from configuracion import EXPORTACION_FILAS_POR_GRUPO
+
+def escribir_csv(ruta, filas, usuarios, rng):
+    """CSV con el formato de la exportación, repartido en los últimos 12 meses"""
+    inicio = datetime.now() - timedelta(days=365)
+    with open(ruta, "w", newline="", encoding="utf-8") as f:
+        escritor = csv.writer(f, lineterminator="\n")
+        escritor.writerow(COLUMNAS_HISTORIAL)
+        for i in range(filas):
+            nombre = rng.choice(usuarios)
+            escritor.writerow((i, 0, nombre, f"imagenes_escaneos/{i:08x}.jpg", rng.choice(("Sana", "Enferma")),
+                               round(rng.uniform(50, 99), 2), inicio + timedelta(seconds=i * 31_536_000 // filas)))
+
+def medir(nombre, filas, funcion):
+    inicio = time.perf_counter()
+    resultado = funcion()
+    segundos = time.perf_counter() - inicio
+    print(f"{nombre:<28}{filas:>12}{segundos:>10.2f}{filas / segundos * 60 / 1e6:>16.2f}")
+    return resultado
+
+def rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Importación y exportación masiva del historial")
+    parser.add_argument("--filas", type=int, default=1_000_000)
+    parser.add_argument("--usuarios", type=int, default=100)
+    parser.add_argument("--fila-a-fila", type=int, default=2000, help="escaneos guardados uno a uno como referencia")
+    parser.add_argument("--database-url", default=None, help="por defecto, SQLite en una carpeta temporal")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.semilla)
+
+    with tempfile.TemporaryDirectory(prefix="bench_exportacion_") as carpeta:
+        db = crear_base_datos(args.database_url or f"sqlite:///{os.path.join(carpeta, 'bench.db')}")
+        nombres = [f"bench_exp_{i}" for i in range(args.usuarios)]
+        ids = [db.crear_usuario(nombre, "bench")["usuario_id"] for nombre in nombres]
+        ruta_csv = os.path.join(carpeta, "historial.csv")
+        escribir_csv(ruta_csv, args.filas, nombres, rng)
+        print(f"CSV de entrada: {os.path.getsize(ruta_csv) / 1e6:.1f} MB, RSS tras generarlo: {rss_mb()} MB")
+        try:
+            print(f"{'operación':<28}{'filas':>12}{'segundos':>10}{'M filas/min':>16}")
+            medir("guardar_escaneo (1 a 1)", args.fila_a_fila,
+                  lambda: [db.guardar_escaneo(ids[0], nombres[0], "x.jpg", "Sana", 90.0) for _ in range(args.fila_a_fila)])
+            with open(ruta_csv, "rb") as f:
+                r = medir("importar CSV", args.filas, lambda: db.importar_historial_csv(f))
+            if not r["exito"]: sys.exit(f"❌ {r['mensaje']}")
+            total = args.filas + args.fila_a_fila
+            medir("exportar CSV", total, lambda: sum(len(b) for b in db.exportar_historial_csv()))
+            try:
+                medir("exportar Parquet", total, lambda: sum(len(b) for b in parquet_por_lotes(
+                    db.lotes_historial(filas_por_lote=EXPORTACION_FILAS_POR_GRUPO))))
+            except RuntimeError as e:
+                print(f"{'exportar Parquet':<28}{'-':>12}  ({e})")
+            print(f"RSS máximo del proceso: {rss_mb()} MB ({db.nombre})")
+        finally:
+            for usuario_id in ids: db.eliminar_usuario(usuario_id)
+            db.cerrar()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Micro-benchmark del índice perceptual: tiempo de búsqueda frente al tamaño del índice, contra una búsqueda exhaustiva
+# Uso: python benchmarks/bench_indice_perceptual.py [--tamanos 1000,10000,100000] [--consultas N] [--distancia D]
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from indice_perceptual import IndicePerceptual
+
+def consultas_de(hashes, cantidad, distancia, rng):
+    """Mitad fotos casi idénticas a una indexada (hasta `distancia` bits distintos), mitad fotos nuevas"""
+    consultas = []
+    for i in range(cantidad):
+        if i % 2:
+            consultas.append(rng.getrandbits(64))
+            continue
+        h = rng.choice(hashes)
+        for bit in rng.sample(range(64), rng.randint(0, distancia)): h ^= 1 << bit
+        consultas.append(h)
+    return consultas
+
+def exhaustiva(hashes, h, distancia):
+    mejor = min(hashes, key=lambda otro: (h ^ otro).bit_count())
+    return mejor if (h ^ mejor).bit_count() <= distancia else None
+
+def medir(funcion, consultas):
+    """Microsegundos por búsqueda"""
+    inicio = time.perf_counter()
+    for h in consultas: funcion(h)
+    return (time.perf_counter() - inicio) / len(consultas) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Búsqueda en el índice perceptual según su tamaño")
+    parser.add_argument("--tamanos", default="1000,10000,100000", help="entradas del índice, separadas por comas")
+    parser.add_argument("--consultas", type=int, default=2000)
+    parser.add_argument("--distancia", type=int, default=6, help="distancia de Hamming admitida")
+    parser.add_argument("--max-exhaustiva", type=int, default=20000, help="tamaño máximo para medir la búsqueda exhaustiva")
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    print(f"{'entradas':>10}{'índice µs':>12}{'comparaciones':>15}{'exhaustiva µs':>16}{'aciertos':>10}{'memoria MB':>12}")
+    for tamano in [int(t) for t in args.tamanos.split(",")]:
+        hashes = [rng.getrandbits(64) for _ in range(tamano)]
+        tracemalloc.start()
+        indice = IndicePerceptual(distancia_usuario=args.distancia, distancia_global=-1, max_entradas=tamano, ttl=float("inf"))
+        for h in hashes: indice.agregar(h, 1, None)
+        memoria = tracemalloc.get_traced_memory()[0] / 1e6
+        tracemalloc.stop()
+        consultas = consultas_de(hashes, args.consultas, args.distancia, rng)
+        us_indice = medir(lambda h: indice.buscar(h, 1), consultas)
+        m = indice.metricas()
+        aciertos = m["aciertos_usuario"] / (m["aciertos_usuario"] + m["fallos"])
+        if tamano <= args.max_exhaustiva:
+            muestra = consultas[:max(10, args.consultas * 1000 // tamano)]
+            us_exhaustiva = f"{medir(lambda h: exhaustiva(hashes, h, args.distancia), muestra):>16.1f}"
+        else:
+            us_exhaustiva = f"{'-':>16}"
+        print(f"{tamano:>10}{us_indice:>12.1f}{m['comparaciones_por_busqueda']:>15}{us_exhaustiva}{aciertos:>10.2f}{memoria:>12.1f}")
+
+if __name__ == "__main__":
+    main()
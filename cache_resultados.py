@@ -0,0 +1,146 @@
+# Caché de resultados de análisis direccionada por contenido
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from configuracion import CACHE_MAX_ENTRADAS, CACHE_TTL_SEGUNDOS, CACHE_RESPUESTAS_MAX_ENTRADAS
+
+class CacheResultados:
+    def __init__(self, max_entradas=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL_SEGUNDOS, db=None):
+        """
+        Caché LRU en memoria con TTL y un nivel persistente opcional
+        max_entradas: tamaño máximo del nivel en memoria
+        ttl: segundos que un resultado sigue siendo válido
+        db: BaseDatos para el nivel persistente (tabla cache_analisis), o None
+        """
+        self.max_entradas = max(1, max_entradas)
+        self.ttl = ttl
+        self.db = db
+        self._entradas = OrderedDict()  # clave -> (momento de guardado, valor)
+        self._lock = threading.Lock()
+        self._aciertos_memoria = 0
+        self._aciertos_persistente = 0
+        self._fallos = 0
+        self._expulsiones = 0
+
+    def _guardar_en_memoria(self, clave, valor, momento):
+        self._entradas[clave] = (momento, valor)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+            self._expulsiones += 1
+
+    def obtener(self, clave):
+        """Retorna {"predicciones", "analisis_colores"} o None si no hay resultado vigente"""
+        ahora = time.time()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None:
+                if ahora - entrada[0] < self.ttl:
+                    self._entradas.move_to_end(clave)
+                    self._aciertos_memoria += 1
+                    return entrada[1]
+                del self._entradas[clave]
+        if self.db is not None:
+            valor = self.db.obtener_cache_analisis(clave, self.ttl)
+            if valor is not None:
+                with self._lock:
+                    self._guardar_en_memoria(clave, valor, ahora)
+                    self._aciertos_persistente += 1
+                return valor
+        with self._lock:
+            self._fallos += 1
+        return None
+
+    def guardar(self, clave, predicciones, analisis_colores):
+        """Guarda el resultado en memoria y, si está configurado, en la base de datos"""
+        valor = {"predicciones": predicciones, "analisis_colores": analisis_colores}
+        with self._lock:
+            self._guardar_en_memoria(clave, valor, time.time())
+        if self.db is not None:
+            self.db.guardar_cache_analisis(clave, predicciones, analisis_colores)
+
+    def metricas(self):
+        """Contadores de aciertos y fallos"""
+        with self._lock:
+            aciertos = self._aciertos_memoria + self._aciertos_persistente
+            consultas = aciertos + self._fallos
+            return {
+                "entradas": len(self._entradas),
+                "max_entradas": self.max_entradas,
+                "aciertos_memoria": self._aciertos_memoria,
+                "aciertos_persistente": self._aciertos_persistente,
+                "fallos": self._fallos,
+                "expulsiones": self._expulsiones,
+                "tasa_aciertos": round(aciertos / consultas, 4) if consultas else 0.0,
+                "persistente": self.db is not None
+            }
+
+def etag_coincide(if_none_match, etag):
+    """Comparación débil de If-None-Match: lista separada por comas, W/ opcional o *"""
+    if not if_none_match: return False
+    etiquetas = [e.strip().removeprefix("W/") for e in if_none_match.split(",")]
+    return "*" in etiquetas or etag.removeprefix("W/") in etiquetas
+
+class CacheRespuestas:
+    def __init__(self, max_entradas=CACHE_RESPUESTAS_MAX_ENTRADAS):
+        """
+        Caché LRU de cuerpos JSON ya serializados, por usuario y variante (ruta + query)
+        Cada entrada guarda la versión del historial con la que se generó y solo se sirve si coincide con la
+        actual, así otra instancia que haya escrito no deja respuestas viejas; invalidar solo libera memoria antes.
+        """
+        self.max_entradas = max(1, max_entradas)
+        self._entradas = OrderedDict()  # (usuario_id, variante) -> (version, cuerpo)
+        self._lock = threading.Lock()
+        self._aciertos = 0
+        self._fallos = 0
+        self._no_modificados = 0
+        self._invalidaciones = 0
+
+    @staticmethod
+    def etag(usuario_id, variante, version):
+        return '"%s.%s.%s"' % (usuario_id, version, hashlib.sha1(variante.encode()).hexdigest()[:12])
+
+    def obtener(self, usuario_id, variante, version):
+        with self._lock:
+            entrada = self._entradas.get((usuario_id, variante))
+            if entrada is not None and entrada[0] == version:
+                self._entradas.move_to_end((usuario_id, variante))
+                self._aciertos += 1
+                return entrada[1]
+            self._fallos += 1
+            return None
+
+    def guardar(self, usuario_id, variante, version, cuerpo):
+        with self._lock:
+            self._entradas[(usuario_id, variante)] = (version, cuerpo)
+            self._entradas.move_to_end((usuario_id, variante))
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def no_modificado(self):
+        with self._lock: self._no_modificados += 1
+
+    def invalidar(self, usuario_ids=None):
+        """Descarta las respuestas de esos usuarios (None = todas)"""
+        with self._lock:
+            self._invalidaciones += 1
+            if usuario_ids is None:
+                self._entradas.clear()
+                return
+            usuario_ids = set(usuario_ids)
+            for clave in [c for c in self._entradas if c[0] in usuario_ids]:
+                del self._entradas[clave]
+
+    def metricas(self):
+        with self._lock:
+            consultas = self._aciertos + self._fallos
+            return {
+                "entradas": len(self._entradas),
+                "max_entradas": self.max_entradas,
+                "aciertos": self._aciertos,
+                "fallos": self._fallos,
+                "no_modificados": self._no_modificados,
+                "invalidaciones": self._invalidaciones,
+                "tasa_aciertos": round(self._aciertos / consultas, 4) if consultas else 0.0
+            }
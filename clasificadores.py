@@ -0,0 +1,152 @@
+# Backends de clasificación de imágenes
+# Todos retornan {"exito": True, "predicciones": [{"label", "score"}, ...]} con el formato
+# de la API de Hugging Face, para que interpretar_resultado no dependa del backend.
+import asyncio
+import hashlib
+import io
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from cliente_inferencia import analizar_con_huggingface, cerrar_cliente, metricas_inferencia
+from configuracion import (CLASIFICADOR_BACKEND, MODELO_LOCAL, LOCAL_TAMANO_LOTE, LOCAL_ESPERA_LOTE_MS,
+                           LOCAL_HILOS, FALSO_LATENCIA)
+
+class Clasificador(ABC):
+    """Interfaz común de los backends de clasificación; un backend sin clasificar() falla al crearse"""
+    nombre = "base"
+
+    @abstractmethod
+    async def clasificar(self, datos, plazo=None):
+        """
+        Clasifica un JPEG ya preprocesado
+        plazo: instante límite (time.monotonic()) que los backends remotos respetan en sus reintentos
+        """
+
+    async def cerrar(self):
+        """Libera los recursos del backend"""
+
+    def metricas(self):
+        """Contadores propios del backend"""
+        return {"backend": self.nombre}
+
+class ClasificadorHuggingFace(Clasificador):
+    """API de inferencia remota de Hugging Face"""
+    nombre = "huggingface"
+
+    async def clasificar(self, datos, plazo=None):
+        return await analizar_con_huggingface(datos, plazo)
+
+    async def cerrar(self):
+        await cerrar_cliente()
+
+    def metricas(self):
+        return {"backend": self.nombre, **metricas_inferencia()}
+
+class ClasificadorLocal(Clasificador):
+    """Modelo cargado una sola vez en proceso; agrupa peticiones concurrentes en lotes en CPU"""
+    nombre = "local"
+
+    def __init__(self, modelo=MODELO_LOCAL, tamano_lote=LOCAL_TAMANO_LOTE, espera_lote_ms=LOCAL_ESPERA_LOTE_MS, hilos=LOCAL_HILOS):
+        try:
+            import torch
+            from transformers import pipeline
+        except ImportError as e:
+            raise RuntimeError("❌ El clasificador local necesita 'torch' y 'transformers' instalados") from e
+        if hilos > 0: torch.set_num_threads(hilos)
+        self.modelo = modelo
+        self.tamano_lote = max(1, tamano_lote)
+        self.espera_lote = espera_lote_ms / 1000
+        self._pipeline = pipeline("image-classification", model=modelo, device=-1)
+        # Un solo hilo de inferencia: torch ya paraleliza cada lote entre los núcleos
+        self._ejecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clasificador-local")
+        self._cola = None
+        self._despachador = None
+        print(f"✅ Modelo local cargado: {modelo}")
+
+    def _inferir(self, lista_datos):
+        """Decodifica y clasifica un lote completo (se ejecuta en el hilo de inferencia)"""
+        from PIL import Image
+        resultados = [None] * len(lista_datos)
+        imagenes, indices = [], []
+        for i, datos in enumerate(lista_datos):
+            try:
+                imagenes.append(Image.open(io.BytesIO(datos)).convert("RGB"))
+                indices.append(i)
+            except Exception as e:
+                resultados[i] = {"exito": False, "mensaje": str(e)}
+        if imagenes:
+            salidas = self._pipeline(imagenes, batch_size=len(imagenes), top_k=5)
+            for i, salida in zip(indices, salidas):
+                resultados[i] = {"exito": True, "predicciones": [{"label": p["label"], "score": float(p["score"])} for p in salida]}
+        return resultados
+
+    async def _despachar(self):
+        """Junta peticiones hasta llenar un lote o agotar la espera y las clasifica juntas"""
+        loop = asyncio.get_running_loop()
+        while True:
+            lote = [await self._cola.get()]
+            limite = loop.time() + self.espera_lote
+            while len(lote) < self.tamano_lote:
+                restante = limite - loop.time()
+                if restante <= 0: break
+                try: lote.append(await asyncio.wait_for(self._cola.get(), restante))
+                except asyncio.TimeoutError: break
+            try:
+                resultados = await loop.run_in_executor(self._ejecutor, self._inferir, [datos for datos, _ in lote])
+            except Exception as e:
+                resultados = [{"exito": False, "mensaje": str(e)}] * len(lote)
+            for (_, futuro), resultado in zip(lote, resultados):
+                if not futuro.done(): futuro.set_result(resultado)
+
+    async def clasificar(self, datos, plazo=None):
+        if self._despachador is None or self._despachador.done():
+            self._cola = asyncio.Queue()
+            self._despachador = asyncio.create_task(self._despachar())
+        futuro = asyncio.get_running_loop().create_future()
+        await self._cola.put((datos, futuro))
+        return await futuro
+
+    async def cerrar(self):
+        if self._despachador is not None:
+            self._despachador.cancel()
+            self._despachador = None
+        self._ejecutor.shutdown(wait=False)
+
+class ClasificadorFalso(Clasificador):
+    """Backend determinista para pruebas: la misma imagen produce siempre las mismas predicciones"""
+    nombre = "falso"
+    ETIQUETAS = ["leaf", "plant", "tree", "fungus", "mushroom", "leaf spot"]
+
+    def __init__(self, predicciones=None, latencia=FALSO_LATENCIA):
+        """
+        predicciones: lista fija a retornar; si es None se derivan del hash de la imagen
+        latencia: segundos de espera simulada por llamada
+        """
+        self.predicciones = predicciones
+        self.latencia = latencia
+        self.llamadas = 0
+
+    async def clasificar(self, datos, plazo=None):
+        self.llamadas += 1
+        if self.latencia: await asyncio.sleep(self.latencia)
+        if self.predicciones is not None:
+            return {"exito": True, "predicciones": [dict(p) for p in self.predicciones]}
+        h = hashlib.sha256(datos).digest()
+        principal = h[0] % len(self.ETIQUETAS)
+        score = round(0.5 + h[1] / 510, 4)
+        secundaria = (principal + 1) % len(self.ETIQUETAS)
+        return {"exito": True, "predicciones": [
+            {"label": self.ETIQUETAS[principal], "score": score},
+            {"label": self.ETIQUETAS[secundaria], "score": round(1 - score, 4)}
+        ]}
+
+BACKENDS = {
+    "huggingface": ClasificadorHuggingFace,
+    "local": ClasificadorLocal,
+    "falso": ClasificadorFalso
+}
+
+def crear_clasificador(nombre=CLASIFICADOR_BACKEND):
+    """Crea el backend configurado en CLASIFICADOR_BACKEND"""
+    if nombre not in BACKENDS:
+        raise ValueError(f"❌ CLASIFICADOR_BACKEND desconocido: {nombre} (opciones: {', '.join(BACKENDS)})")
+    return BACKENDS[nombre]()
@@ -0,0 +1,182 @@
+# Cliente asíncrono de inferencia para Hugging Face
+import asyncio
+import random
+import time
+from metricas import intentos_inferencia
+from configuracion import (HUGGINGFACE_API_KEY, HUGGINGFACE_API_URL, HF_TIMEOUT, HF_PLAZO_TOTAL,
+                           HF_MAX_REINTENTOS, HF_BACKOFF_BASE, HF_BACKOFF_MAXIMO,
+                           HF_INTERRUPTOR_UMBRAL, HF_INTERRUPTOR_ESPERA, HF_MAX_CONEXIONES, HF_MAX_KEEPALIVE)
+
+# Respuestas que indican un problema pasajero del servicio (modelo cargando, saturación, gateway)
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+_cliente = None
+_contadores = {"peticiones": 0, "exitosas": 0, "fallidas": 0, "reintentos": 0, "rechazadas_interruptor": 0, "plazos_agotados": 0}
+
+class Interruptor:
+    """Circuit breaker: tras `umbral` fallos seguidos deja de llamar al servicio durante `espera` segundos"""
+    def __init__(self, umbral=HF_INTERRUPTOR_UMBRAL, espera=HF_INTERRUPTOR_ESPERA):
+        self.umbral = umbral
+        self.espera = espera
+        self.estado = "cerrado"
+        self.aperturas = 0
+        self._fallos_seguidos = 0
+        self._abierto_desde = 0.0
+        self._sonda_en_curso = False
+
+    def permitir(self):
+        """True si se puede llamar al servicio; en semiabierto solo deja pasar una petición de prueba"""
+        if self.estado == "cerrado":
+            return True
+        if self.estado == "abierto":
+            if time.monotonic() - self._abierto_desde < self.espera:
+                return False
+            self.estado = "semiabierto"
+            self._sonda_en_curso = False
+        if self._sonda_en_curso:
+            return False
+        self._sonda_en_curso = True
+        return True
+
+    def segundos_para_reintentar(self):
+        if self.estado != "abierto": return 0.0
+        return max(0.0, self.espera - (time.monotonic() - self._abierto_desde))
+
+    def liberar_sonda(self):
+        """La petición de prueba terminó sin resultado (cancelada): la siguiente puede volver a probar"""
+        self._sonda_en_curso = False
+
+    def registrar_exito(self):
+        self.estado = "cerrado"
+        self._fallos_seguidos = 0
+        self._sonda_en_curso = False
+
+    def registrar_fallo(self):
+        self._fallos_seguidos += 1
+        self._sonda_en_curso = False
+        if self.estado == "semiabierto" or self._fallos_seguidos >= self.umbral:
+            if self.estado != "abierto": self.aperturas += 1
+            self.estado = "abierto"
+            self._abierto_desde = time.monotonic()
+
+    def metricas(self):
+        return {
+            "estado": self.estado,
+            "fallos_seguidos": self._fallos_seguidos,
+            "aperturas": self.aperturas,
+            "segundos_para_reintentar": round(self.segundos_para_reintentar(), 3)
+        }
+
+interruptor = Interruptor()
+
+def obtener_cliente():
+    """Retorna el cliente HTTP compartido (pool de conexiones con keep-alive)"""
+    global _cliente
+    if _cliente is None or _cliente.is_closed:
+        import httpx
+        headers = {"Content-Type": "application/octet-stream"}
+        if HUGGINGFACE_API_KEY: headers["Authorization"] = f"Bearer {HUGGINGFACE_API_KEY}"
+        _cliente = httpx.AsyncClient(
+            headers=headers,
+            timeout=HF_TIMEOUT,
+            limits=httpx.Limits(max_connections=HF_MAX_CONEXIONES, max_keepalive_connections=HF_MAX_KEEPALIVE)
+        )
+    return _cliente
+
+async def cerrar_cliente():
+    """Cierra el cliente compartido y sus conexiones abiertas"""
+    global _cliente
+    if _cliente is not None:
+        await _cliente.aclose()
+        _cliente = None
+
+def espera_backoff(intento):
+    """Backoff exponencial con jitter: entre la mitad y el total de base * 2^intento"""
+    tope = min(HF_BACKOFF_MAXIMO, HF_BACKOFF_BASE * 2 ** intento)
+    return tope / 2 + random.uniform(0, tope / 2)
+
+def espera_sugerida(respuesta):
+    """Segundos que pide el servicio (Retry-After o estimated_time de Hugging Face), o None"""
+    try:
+        if "retry-after" in respuesta.headers:
+            return float(respuesta.headers["retry-after"])
+        return float(respuesta.json().get("estimated_time"))
+    except Exception:
+        return None
+
+async def analizar_con_huggingface(datos, plazo=None):
+    """
+    Envía la imagen al modelo sin bloquear el event loop, reintentando los fallos pasajeros
+    datos: JPEG ya reducido al tamaño del modelo (ver procesamiento_imagen.preprocesar_imagen)
+    plazo: instante límite (time.monotonic()) para todos los intentos; por defecto ahora + HF_PLAZO_TOTAL
+    """
+    import httpx
+    plazo = plazo if plazo is not None else time.monotonic() + HF_PLAZO_TOTAL
+    _contadores["peticiones"] += 1
+    mensaje = "Sin respuesta del servicio de inferencia"
+    intento = 0
+    while True:
+        # El plazo antes que el interruptor: en semiabierto permitir() reserva la única sonda
+        restante = plazo - time.monotonic()
+        if restante <= 0:
+            _contadores["plazos_agotados"] += 1
+            break
+        if not interruptor.permitir():
+            _contadores["rechazadas_interruptor"] += 1
+            return {"exito": False, "mensaje": "Servicio de inferencia no disponible", "interruptor_abierto": True,
+                    "reintentar_en": round(interruptor.segundos_para_reintentar(), 1)}
+        sonda = interruptor.estado == "semiabierto"
+        sugerida = None
+        inicio = time.perf_counter()
+        try:
+            r = await obtener_cliente().post(HUGGINGFACE_API_URL, content=datos, timeout=min(HF_TIMEOUT, restante))
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            intentos_inferencia.observar(time.perf_counter() - inicio, "timeout" if isinstance(e, httpx.TimeoutException) else "conexion")
+            interruptor.registrar_fallo()
+            mensaje = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        except Exception as e:
+            intentos_inferencia.observar(time.perf_counter() - inicio, "error")
+            interruptor.registrar_fallo()
+            _contadores["fallidas"] += 1
+            return {"exito": False, "mensaje": str(e)}
+        else:
+            intentos_inferencia.observar(time.perf_counter() - inicio, str(r.status_code))
+            if r.status_code == 200:
+                # Un 200 que no es JSON (la página HTML de un proxy, p. ej.) es un fallo del servicio y se reintenta
+                try: predicciones = r.json()
+                except ValueError:
+                    interruptor.registrar_fallo()
+                    mensaje = "Respuesta no válida del servicio de inferencia"
+                else:
+                    interruptor.registrar_exito()
+                    _contadores["exitosas"] += 1
+                    return {"exito": True, "predicciones": predicciones}
+            elif r.status_code not in ESTADOS_REINTENTABLES:
+                # El servicio respondió: el error es de la petición, no de su salud
+                interruptor.registrar_exito()
+                _contadores["fallidas"] += 1
+                return {"exito": False, "mensaje": f"Error {r.status_code}"}
+            else:
+                interruptor.registrar_fallo()
+                mensaje = f"Error {r.status_code}"
+                sugerida = espera_sugerida(r)
+        finally:
+            # Con éxito o fallo ya se liberó; esto cubre la cancelación mientras se esperaba la respuesta
+            if sonda: interruptor.liberar_sonda()
+        if intento >= HF_MAX_REINTENTOS:
+            break
+        espera = espera_backoff(intento)
+        if sugerida is not None: espera = max(espera, min(sugerida, HF_BACKOFF_MAXIMO))
+        if time.monotonic() + espera >= plazo:
+            _contadores["plazos_agotados"] += 1
+            mensaje += " (plazo agotado)"
+            break
+        await asyncio.sleep(espera)
+        intento += 1
+        _contadores["reintentos"] += 1
+    _contadores["fallidas"] += 1
+    return {"exito": False, "mensaje": mensaje}
+
+def metricas_inferencia():
+    """Contadores de peticiones y reintentos, y estado del interruptor"""
+    return {**_contadores, "interruptor": interruptor.metricas()}
@@ -0,0 +1,95 @@
+# Cola de análisis asíncronos respaldada por la tabla trabajos_analisis
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from configuracion import (TRABAJOS_TRABAJADORES, TRABAJOS_INTERVALO_SONDEO, TRABAJOS_TIMEOUT_PROCESANDO,
+                           TRABAJOS_MAX_INTENTOS)
+
+ESTADOS_FINALES = ("completado", "error")
+
+class ColaTrabajos:
+    def __init__(self, db, procesar, trabajadores=TRABAJOS_TRABAJADORES, intervalo_sondeo=TRABAJOS_INTERVALO_SONDEO):
+        """
+        Pool acotado de trabajadores que consumen la cola persistente
+        db: BaseDatos con la tabla trabajos_analisis
+        procesar: corrutina procesar(trabajo) -> dict con el resultado; si lanza una excepción el trabajo se reintenta
+        """
+        self.db = db
+        self.procesar = procesar
+        self.trabajadores = max(1, trabajadores)
+        self.intervalo_sondeo = intervalo_sondeo
+        self._tareas = []
+        self._hay_trabajo = None
+        self._cambios = {}  # trabajo_id -> asyncio.Event para avisar a quien espera el resultado
+        self._detenido = False
+        self._procesados = 0
+        self._fallidos = 0
+
+    def iniciar(self):
+        """Arranca los trabajadores en el event loop actual y reencola los trabajos huérfanos"""
+        self._hay_trabajo = asyncio.Event()
+        self._detenido = False
+        reencolados = self.db.reencolar_trabajos_huerfanos(TRABAJOS_TIMEOUT_PROCESANDO)
+        if reencolados:
+            print(f"ℹ️ {reencolados} trabajos reencolados tras el reinicio")
+        self._tareas = [asyncio.create_task(self._trabajador()) for _ in range(self.trabajadores)]
+
+    async def detener(self, espera=10.0):
+        """Deja de tomar trabajos; los que están en curso tienen `espera` segundos para terminar"""
+        self._detenido = True
+        if self._hay_trabajo is not None: self._hay_trabajo.set()
+        tareas, self._tareas = self._tareas, []
+        if not tareas: return
+        _, pendientes = await asyncio.wait(tareas, timeout=espera)
+        for tarea in pendientes: tarea.cancel()
+        if pendientes: await asyncio.wait(pendientes)
+
+    def despertar(self):
+        """Avisa a los trabajadores de que hay un trabajo nuevo en la cola"""
+        if self._hay_trabajo is not None: self._hay_trabajo.set()
+
+    def _avisar(self, trabajo_id):
+        evento = self._cambios.pop(trabajo_id, None)
+        if evento is not None: evento.set()
+
+    async def esperar_cambio(self, trabajo_id, timeout):
+        """Espera hasta que el trabajo cambie de estado en este proceso o pase `timeout` segundos"""
+        evento = self._cambios.setdefault(trabajo_id, asyncio.Event())
+        try: await asyncio.wait_for(evento.wait(), timeout)
+        except asyncio.TimeoutError: pass
+        finally:
+            if self._cambios.get(trabajo_id) is evento: del self._cambios[trabajo_id]
+
+    async def _trabajador(self):
+        while not self._detenido:
+            try: trabajo = await run_in_threadpool(self.db.tomar_trabajo)
+            except Exception as e:
+                print(f"❌ Error al leer la cola de trabajos: {e}")
+                trabajo = None
+            if trabajo is None:
+                self._hay_trabajo.clear()
+                # El sondeo periódico recoge trabajos encolados por otras instancias
+                try: await asyncio.wait_for(self._hay_trabajo.wait(), self.intervalo_sondeo)
+                except asyncio.TimeoutError: pass
+                continue
+            self._avisar(trabajo["id"])
+            try:
+                resultado = await self.procesar(trabajo)
+            except asyncio.CancelledError:
+                await run_in_threadpool(self.db.liberar_trabajo, trabajo["id"])
+                raise
+            except Exception as e:
+                self._fallidos += 1
+                definitivo = trabajo["intentos"] >= TRABAJOS_MAX_INTENTOS
+                await run_in_threadpool(self.db.fallar_trabajo, trabajo["id"], str(e), definitivo)
+            else:
+                self._procesados += 1
+                await run_in_threadpool(self.db.completar_trabajo, trabajo["id"], resultado)
+            self._avisar(trabajo["id"])
+
+    def metricas(self):
+        return {
+            "trabajadores": len(self._tareas),
+            "procesados": self._procesados,
+            "fallidos": self._fallidos,
+            "esperando_resultado": len(self._cambios)
+        }
@@ -1,18 +1,23 @@
 # Configuración de Mayaflora Detector de Orquídeas
+import os
+from dotenv import load_dotenv
+
+# .env antes del primer os.getenv: todo lo de abajo se lee al importar este módulo, que es lo primero que importa
+# cualquier otro (las variables ya definidas en el entorno tienen prioridad)
+load_dotenv()
 
 # API de Hugging Face
-import os
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY", "")
 
 # Modelo de Hugging Face - Usamos Vision Transformer que funciona
 HUGGINGFACE_MODEL = "google/vit-base-patch16-224"
 
 # URL de la API de Hugging Face
-HUGGINGFACE_API_URL = f"https://api-inference.huggingface.co/models/{HUGGINGFACE_MODEL}"
+HUGGINGFACE_API_URL = os.getenv("HUGGINGFACE_API_URL", f"https://api-inference.huggingface.co/models/{HUGGINGFACE_MODEL}")
 
 # Configuración del servidor
-HOST = "0.0.0.0"
-PORT = 8000
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
 
 # Umbrales de confianza
 UMBRAL_CONFIANZA_MINIMO = 0.5  # 50% de confianza mínima
@@ -35,8 +40,116 @@ PALABRAS_CLAVE_SANA = [
     "alive", "growing", "vibrant", "lush"
 ]
 
+# Servidor multiproceso (python servidor.py): un supervisor y SERVIDOR_TRABAJADORES procesos uvicorn
+SERVIDOR_TRABAJADORES = int(os.getenv("SERVIDOR_TRABAJADORES", "1"))  # 1 = un solo proceso; pool, admisión y cachés son por trabajador
+SERVIDOR_ESPERA_CIERRE = float(os.getenv("SERVIDOR_ESPERA_CIERRE", "30"))  # segundos para terminar las peticiones en curso al apagar
+SERVIDOR_METRICAS_DIR = os.getenv("SERVIDOR_METRICAS_DIR", "")  # instantáneas de métricas de cada trabajador; vacío = carpeta temporal
+SERVIDOR_METRICAS_INTERVALO = float(os.getenv("SERVIDOR_METRICAS_INTERVALO", "5"))  # segundos entre publicaciones de cada trabajador
+SERVIDOR_ARRANQUE_HECHO = os.getenv("SERVIDOR_ARRANQUE_HECHO", "false").lower() in ("1", "true", "si", "sí")  # lo fija el supervisor: esquema y mantenimiento son suyos
+
 # Configuración de base de datos
 NOMBRE_BASE_DATOS = "mayaflora.db"
 
 # Carpeta para guardar imágenes
-CARPETA_IMAGENES = "imagenes_escaneos"
\ No newline at end of file
+CARPETA_IMAGENES = "imagenes_escaneos"
+
+# Pool de conexiones PostgreSQL
+POOL_MIN_CONEXIONES = int(os.getenv("POOL_MIN_CONEXIONES", "1"))
+POOL_MAX_CONEXIONES = int(os.getenv("POOL_MAX_CONEXIONES", "10"))
+POOL_TIMEOUT_ESPERA = float(os.getenv("POOL_TIMEOUT_ESPERA", "30"))  # segundos esperando una conexión libre
+POOL_MAX_INACTIVIDAD = float(os.getenv("POOL_MAX_INACTIVIDAD", "300"))  # segundos antes de validar con SELECT 1
+
+# Cliente HTTP asíncrono para la inferencia en Hugging Face
+HF_TIMEOUT = float(os.getenv("HF_TIMEOUT", "60"))  # segundos por intento
+HF_PLAZO_TOTAL = float(os.getenv("HF_PLAZO_TOTAL", "30"))  # segundos por análisis, sumando todos los intentos
+HF_MAX_REINTENTOS = int(os.getenv("HF_MAX_REINTENTOS", "3"))
+HF_BACKOFF_BASE = float(os.getenv("HF_BACKOFF_BASE", "0.5"))  # espera antes del primer reintento; se duplica en cada uno
+HF_BACKOFF_MAXIMO = float(os.getenv("HF_BACKOFF_MAXIMO", "10"))
+HF_INTERRUPTOR_UMBRAL = int(os.getenv("HF_INTERRUPTOR_UMBRAL", "5"))  # fallos seguidos que abren el interruptor
+HF_INTERRUPTOR_ESPERA = float(os.getenv("HF_INTERRUPTOR_ESPERA", "30"))  # segundos abierto antes de probar de nuevo
+HF_RESPALDO_COLORES = os.getenv("HF_RESPALDO_COLORES", "false").lower() in ("1", "true", "si", "sí")  # veredicto solo por colores si falla la inferencia
+HF_MAX_CONEXIONES = int(os.getenv("HF_MAX_CONEXIONES", "20"))
+HF_MAX_KEEPALIVE = int(os.getenv("HF_MAX_KEEPALIVE", "10"))
+
+# Caché de resultados de análisis (clave: SHA256 de la imagen)
+CACHE_MAX_ENTRADAS = int(os.getenv("CACHE_MAX_ENTRADAS", "1000"))
+CACHE_TTL_SEGUNDOS = float(os.getenv("CACHE_TTL_SEGUNDOS", "86400"))
+CACHE_PERSISTENTE = os.getenv("CACHE_PERSISTENTE", "false").lower() in ("1", "true", "si", "sí")
+CACHE_RESPUESTAS_MAX_ENTRADAS = int(os.getenv("CACHE_RESPUESTAS_MAX_ENTRADAS", "2000"))  # respuestas de historial y estadísticas
+
+# Preprocesamiento de imágenes (una sola decodificación por escaneo)
+TAMANO_MODELO = int(os.getenv("TAMANO_MODELO", "224"))  # lado corto de la imagen enviada al modelo
+CALIDAD_JPEG_MODELO = int(os.getenv("CALIDAD_JPEG_MODELO", "90"))
+TAMANO_ANALISIS_COLORES = int(os.getenv("TAMANO_ANALISIS_COLORES", "512"))  # lado largo para el análisis de colores
+# Mapa de manchas por zonas (p. ej. 8 zonas por lado); 0 = solo porcentajes globales. Activarlo cambia veredictos:
+# interpretar_resultado también cuenta la peor zona, así que manchas localizadas pasan a dar "Enferma"
+COLORES_ZONAS_REJILLA = int(os.getenv("COLORES_ZONAS_REJILLA", "0"))
+COLORES_ZONAS_PESO = float(os.getenv("COLORES_ZONAS_PESO", "0.6"))  # peso del score de la peor zona frente al global
+
+# Análisis por lotes (/api/analizar/lote)
+LOTE_MAX_IMAGENES = int(os.getenv("LOTE_MAX_IMAGENES", "10"))
+LOTE_MAX_CONCURRENCIA = int(os.getenv("LOTE_MAX_CONCURRENCIA", "4"))  # inferencias simultáneas por lote
+
+# Backend de clasificación: "huggingface" (API remota), "local" (CPU en proceso) o "falso" (pruebas)
+CLASIFICADOR_BACKEND = os.getenv("CLASIFICADOR_BACKEND", "huggingface").lower()
+MODELO_LOCAL = os.getenv("MODELO_LOCAL", HUGGINGFACE_MODEL)  # nombre en el Hub o ruta local
+LOCAL_TAMANO_LOTE = int(os.getenv("LOCAL_TAMANO_LOTE", "8"))
+LOCAL_ESPERA_LOTE_MS = float(os.getenv("LOCAL_ESPERA_LOTE_MS", "10"))  # espera máxima para completar un lote
+LOCAL_HILOS = int(os.getenv("LOCAL_HILOS", "0"))  # hilos de torch; 0 = valor por defecto
+FALSO_LATENCIA = float(os.getenv("FALSO_LATENCIA", "0"))  # segundos de latencia simulada
+
+# Paginación del historial
+HISTORIAL_LIMITE_MAXIMO = int(os.getenv("HISTORIAL_LIMITE_MAXIMO", "500"))
+HISTORIAL_FILAS_POR_LOTE = int(os.getenv("HISTORIAL_FILAS_POR_LOTE", "2000"))  # filas por viaje del cursor de servidor
+
+# Retención y purga del historial (en PostgreSQL, particionado por mes de fecha_escaneo)
+HISTORIAL_RETENCION_MESES = int(os.getenv("HISTORIAL_RETENCION_MESES", "0"))  # meses que se conservan; 0 = todo
+HISTORIAL_RETENCION_DESACOPLAR = os.getenv("HISTORIAL_RETENCION_DESACOPLAR", "false").lower() in ("1", "true", "si", "sí")  # desacoplar en vez de borrar, para archivar
+HISTORIAL_PURGA_LOTE = int(os.getenv("HISTORIAL_PURGA_LOTE", "5000"))  # filas por transacción en las purgas por fecha o usuario
+HISTORIAL_MANTENIMIENTO_INTERVALO = float(os.getenv("HISTORIAL_MANTENIMIENTO_INTERVALO", "3600"))  # segundos entre pasadas de mantenimiento
+
+# Exportación e importación masiva del historial (/api/admin/historial/exportar e importar)
+EXPORTACION_FILAS_POR_GRUPO = int(os.getenv("EXPORTACION_FILAS_POR_GRUPO", "65536"))  # filas por grupo Parquet y por lectura del cursor
+
+# Usuario administrador creado al inicializar el esquema
+ADMIN_USUARIO = os.getenv("ADMIN_USUARIO", "admin")
+ADMIN_CONTRASENA = os.getenv("ADMIN_CONTRASENA", "admin123")
+
+# Cola de análisis asíncronos (tabla trabajos_analisis)
+TRABAJOS_TRABAJADORES = int(os.getenv("TRABAJOS_TRABAJADORES", "2"))
+TRABAJOS_INTERVALO_SONDEO = float(os.getenv("TRABAJOS_INTERVALO_SONDEO", "2"))  # segundos entre consultas a la cola
+TRABAJOS_TIMEOUT_PROCESANDO = float(os.getenv("TRABAJOS_TIMEOUT_PROCESANDO", "300"))  # tras esto un trabajo huérfano se reencola
+TRABAJOS_MAX_INTENTOS = int(os.getenv("TRABAJOS_MAX_INTENTOS", "3"))
+
+# Control de admisión de /api/analizar y /api/analizar/lote
+ADMISION_MAX_CONCURRENCIA = int(os.getenv("ADMISION_MAX_CONCURRENCIA", "8"))   # análisis en curso a la vez
+ADMISION_MAX_COLA = int(os.getenv("ADMISION_MAX_COLA", "32"))                  # peticiones esperando turno; más allá, 503
+ADMISION_MAX_POR_USUARIO = int(os.getenv("ADMISION_MAX_POR_USUARIO", "4"))     # en curso + en cola por usuario; más allá, 429
+ADMISION_ESPERA_MAXIMA = float(os.getenv("ADMISION_ESPERA_MAXIMA", "10"))      # segundos en cola antes de responder 503
+ADMISION_POR_DIRECCION = os.getenv("ADMISION_POR_DIRECCION", "false").lower() in ("1", "true", "si", "sí")  # límite por usuario también por IP sin token (no tras NAT/proxy)
+
+# Almacenamiento de imágenes subidas
+SUBIDA_MAX_BYTES = int(os.getenv("SUBIDA_MAX_BYTES", str(10 * 1024 * 1024)))  # tamaño máximo por imagen
+SUBIDA_TAMANO_BLOQUE = int(os.getenv("SUBIDA_TAMANO_BLOQUE", str(256 * 1024)))  # bytes copiados a disco por lectura
+
+# SQLite (cuando DATABASE_URL no está definida o es sqlite:///ruta.db)
+SQLITE_TIMEOUT = float(os.getenv("SQLITE_TIMEOUT", "30"))  # segundos esperando el bloqueo de escritura
+
+# Sesiones: tokens firmados con HMAC que el middleware verifica en memoria, sin consultar la base de datos
+SESION_SECRETO = os.getenv("SESION_SECRETO", "")  # si falta, se genera uno al arrancar (los tokens no sobreviven al reinicio)
+SESION_DURACION = float(os.getenv("SESION_DURACION", str(12 * 3600)))  # segundos de validez de cada token
+SESION_OBLIGATORIA = os.getenv("SESION_OBLIGATORIA", "false").lower() in ("1", "true", "si", "sí")  # sin token: 401
+SESION_REFRESCO_REVOCADAS = float(os.getenv("SESION_REFRESCO_REVOCADAS", "30"))  # segundos entre lecturas de la lista de revocados
+
+# Escritura diferida del historial: los escaneos se acumulan y se guardan en lotes, fuera de la petición
+ESCRITURA_DIFERIDA = os.getenv("ESCRITURA_DIFERIDA", "false").lower() in ("1", "true", "si", "sí")
+ESCRITURA_MAX_LOTE = int(os.getenv("ESCRITURA_MAX_LOTE", "200"))  # al llegar a tantos escaneos se vacía sin esperar
+ESCRITURA_INTERVALO = float(os.getenv("ESCRITURA_INTERVALO", "1"))  # segundos máximos que un escaneo espera en memoria
+ESCRITURA_SPOOL = os.getenv("ESCRITURA_SPOOL", "historial_pendiente.jsonl")  # respaldo local si la base no responde
+
+# Índice perceptual (dHash de 64 bits) para reutilizar el análisis de fotos casi idénticas recientes
+PHASH_DISTANCIA_USUARIO = int(os.getenv("PHASH_DISTANCIA_USUARIO", "6"))  # bits distintos admitidos entre fotos del mismo usuario; -1 desactiva
+PHASH_DISTANCIA_GLOBAL = int(os.getenv("PHASH_DISTANCIA_GLOBAL", "3"))    # entre fotos de distintos usuarios, más estricto; -1 desactiva
+PHASH_MAX_ENTRADAS = int(os.getenv("PHASH_MAX_ENTRADAS", "10000"))
+PHASH_TTL_SEGUNDOS = float(os.getenv("PHASH_TTL_SEGUNDOS", "3600"))  # solo se comparan análisis recientes
+PHASH_MIN_BITS = int(os.getenv("PHASH_MIN_BITS", "8"))  # fotos lisas u oscuras: su hash es casi todo ceros (o unos) y no se compara
@@ -0,0 +1,152 @@
+# Control de admisión: limita los análisis simultáneos, global y por usuario, con una cola de espera acotada
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from fastapi.responses import JSONResponse
+from configuracion import (ADMISION_MAX_CONCURRENCIA, ADMISION_MAX_COLA, ADMISION_MAX_POR_USUARIO, ADMISION_ESPERA_MAXIMA,
+                           ADMISION_POR_DIRECCION)
+
+class AdmisionRechazadaError(Exception):
+    """La petición no se admite; estado es 429 (límite del usuario) o 503 (servidor saturado)"""
+    def __init__(self, estado, mensaje, reintentar_en):
+        super().__init__(mensaje)
+        self.estado = estado
+        self.mensaje = mensaje
+        self.reintentar_en = reintentar_en
+
+class ControlAdmision:
+    def __init__(self, max_concurrencia=ADMISION_MAX_CONCURRENCIA, max_cola=ADMISION_MAX_COLA,
+                 max_por_usuario=ADMISION_MAX_POR_USUARIO, espera_maxima=ADMISION_ESPERA_MAXIMA):
+        """Pensado para un solo event loop: el estado solo se toca desde corrutinas, sin locks"""
+        self.max_concurrencia = max(1, max_concurrencia)
+        self.max_cola = max(0, max_cola)
+        self.max_por_usuario = max(1, max_por_usuario)
+        self.espera_maxima = espera_maxima
+        self._activos = 0
+        self._cola = deque()        # futures de las peticiones en espera, en orden de llegada
+        self._por_usuario = {}      # usuario_id -> peticiones en curso o en cola
+        self._duracion_media = 1.0  # media móvil de lo que dura un análisis, para estimar Retry-After
+        self._admitidas = 0
+        self._encoladas = 0
+        self._rechazadas = {"usuario": 0, "cola_llena": 0, "espera_agotada": 0}
+        self._cola_maxima = 0
+        self._espera_total = 0.0
+
+    def reintentar_en(self):
+        """Segundos estimados hasta que se libere un turno para una petición nueva"""
+        turnos = (len(self._cola) + 1) / self.max_concurrencia
+        return max(1, math.ceil(turnos * self._duracion_media))
+
+    def _rechazar(self, motivo, estado, mensaje):
+        self._rechazadas[motivo] += 1
+        raise AdmisionRechazadaError(estado, mensaje, self.reintentar_en())
+
+    def _liberar_turno(self):
+        """Cede el turno a la siguiente petición en espera o lo devuelve"""
+        while self._cola:
+            futuro = self._cola.popleft()
+            if not futuro.done():
+                futuro.set_result(None)
+                return
+        self._activos -= 1
+
+    async def _esperar_turno(self):
+        if self._activos < self.max_concurrencia and not self._cola:
+            self._activos += 1
+            return
+        if len(self._cola) >= self.max_cola:
+            self._rechazar("cola_llena", 503, "Servidor saturado, intente más tarde")
+        futuro = asyncio.get_running_loop().create_future()
+        self._cola.append(futuro)
+        self._encoladas += 1
+        self._cola_maxima = max(self._cola_maxima, len(self._cola))
+        inicio = time.monotonic()
+        try:
+            await asyncio.wait((futuro,), timeout=self.espera_maxima)
+        except asyncio.CancelledError:
+            # El cliente se fue: si ya nos habían cedido el turno, pasa al siguiente
+            if futuro.done(): self._liberar_turno()
+            else:
+                futuro.cancel()
+                self._cola.remove(futuro)
+            raise
+        finally:
+            self._espera_total += time.monotonic() - inicio
+        if not futuro.done():
+            futuro.cancel()
+            self._cola.remove(futuro)
+            self._rechazar("espera_agotada", 503, "Servidor saturado, intente más tarde")
+
+    @asynccontextmanager
+    async def admitir(self, usuario_id):
+        """
+        Ocupa un turno de análisis durante el bloque; lanza AdmisionRechazadaError si no hay sitio
+        usuario_id: None para una petición anónima, que solo pasa por la cola global
+        """
+        if usuario_id is not None:
+            if self._por_usuario.get(usuario_id, 0) >= self.max_por_usuario:
+                self._rechazar("usuario", 429, "Demasiados análisis en curso para este usuario")
+            self._por_usuario[usuario_id] = self._por_usuario.get(usuario_id, 0) + 1
+        try:
+            await self._esperar_turno()
+            self._admitidas += 1
+            inicio = time.monotonic()
+            try:
+                yield
+            finally:
+                self._duracion_media = 0.9 * self._duracion_media + 0.1 * (time.monotonic() - inicio)
+                self._liberar_turno()
+        finally:
+            if usuario_id is not None:
+                restantes = self._por_usuario[usuario_id] - 1
+                if restantes: self._por_usuario[usuario_id] = restantes
+                else: del self._por_usuario[usuario_id]
+
+    def metricas(self):
+        return {
+            "activos": self._activos,
+            "en_cola": len(self._cola),
+            "cola_maxima": self._cola_maxima,
+            "usuarios_activos": len(self._por_usuario),
+            "admitidas": self._admitidas,
+            "encoladas": self._encoladas,
+            "rechazadas": dict(self._rechazadas),
+            "espera_promedio_ms": round(self._espera_total / self._encoladas * 1000, 3) if self._encoladas else 0.0,
+            "duracion_media_s": round(self._duracion_media, 3),
+            "limites": {"concurrencia": self.max_concurrencia, "cola": self.max_cola, "por_usuario": self.max_por_usuario}
+        }
+
+RUTAS_ADMITIDAS = ("/api/analizar", "/api/analizar/lote")
+
+class MiddlewareAdmision:
+    """
+    Middleware ASGI: toma el turno de análisis antes de que se lea el cuerpo de la subida
+    Una petición rechazada (429/503 con Retry-After) no llega a transferir la imagen ni a ocupar memoria o disco;
+    mientras espera en la cola, el cliente tampoco envía el cuerpo. Va por dentro de MiddlewareSesiones: el límite
+    por usuario usa el del token (el usuario_id del formulario aún no se leyó). Sin token solo cuenta la cola global:
+    tras un NAT o un proxy muchos usuarios comparten dirección; por_direccion la usa igualmente como usuario.
+    """
+    def __init__(self, app, admision, por_direccion=ADMISION_POR_DIRECCION):
+        self.app = app
+        self.admision = admision
+        self.por_direccion = por_direccion
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in RUTAS_ADMITIDAS:
+            return await self.app(scope, receive, send)
+        sesion = scope.get("state", {}).get("sesion")
+        if sesion: clave = sesion["uid"]
+        elif self.por_direccion: clave = ("cliente", (scope.get("client") or ("desconocido",))[0])
+        else: clave = None
+        admitida = False
+        try:
+            async with self.admision.admitir(clave):
+                admitida = True
+                await self.app(scope, receive, send)
+        except AdmisionRechazadaError as e:
+            if admitida: raise
+            respuesta = JSONResponse(content={"exito": False, "mensaje": e.mensaje}, status_code=e.estado,
+                                     headers={"Retry-After": str(e.reintentar_en)})
+            await respuesta(scope, receive, send)
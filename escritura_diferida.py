@@ -0,0 +1,139 @@
+# Escritura diferida del historial: acumula escaneos en memoria y los guarda en lotes con un solo INSERT multi-fila
+import asyncio
+import glob
+import json
+import os
+import time
+from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
+from configuracion import ESCRITURA_MAX_LOTE, ESCRITURA_INTERVALO, ESCRITURA_SPOOL
+
+def proceso_vivo(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: return True
+    return True
+
+class EscrituraDiferida:
+    def __init__(self, db, max_lote=ESCRITURA_MAX_LOTE, intervalo=ESCRITURA_INTERVALO, spool=ESCRITURA_SPOOL, al_guardar=None):
+        """
+        Buffer de escaneos que se vacía al llegar a `max_lote` o cada `intervalo` segundos
+        db: BaseDatos; los lotes van por guardar_escaneos_lote
+        spool: archivo JSONL donde quedan los lotes que la base no aceptó; se reintentan en cada vaciado
+        al_guardar: función opcional llamada con cada lote ya guardado
+        Entrega al menos una vez: si el proceso muere justo tras guardar un lote del spool, ese lote se repite.
+        Pensado para un solo event loop: el buffer solo se toca desde corrutinas, sin locks.
+        """
+        self.db = db
+        self.max_lote = max(1, max_lote)
+        self.intervalo = intervalo
+        self.spool = spool
+        self.al_guardar = al_guardar
+        self._pendientes = []
+        self._lleno = None
+        self._tarea = None
+        self._detenido = False
+        self._escaneos_guardados = 0
+        self._lotes = 0
+        self._fallos = 0
+        self._enviados_spool = 0
+        self._recuperados_spool = 0
+
+    def agregar(self, usuario_id, nombre_usuario, ruta_imagen, resultado, confianza):
+        """Encola un escaneo con la fecha de ahora; retorna sin esperar a la base de datos"""
+        self._pendientes.append((usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, datetime.now()))
+        if len(self._pendientes) >= self.max_lote and self._lleno is not None:
+            self._lleno.set()
+
+    def iniciar(self):
+        """Arranca el vaciado periódico en el event loop actual"""
+        self._lleno = asyncio.Event()
+        self._detenido = False
+        self._tarea = asyncio.create_task(self._vaciar_periodicamente())
+
+    async def detener(self):
+        """Deja de vaciar por tiempo y guarda (o manda al spool) todo lo pendiente"""
+        self._detenido = True
+        if self._tarea is not None:
+            self._lleno.set()
+            await self._tarea
+            self._tarea = None
+        await self.vaciar()
+
+    async def _vaciar_periodicamente(self):
+        while not self._detenido:
+            try: await asyncio.wait_for(self._lleno.wait(), self.intervalo)
+            except asyncio.TimeoutError: pass
+            self._lleno.clear()
+            try: await self.vaciar()
+            except Exception as e: print(f"❌ Error al vaciar el historial pendiente: {e}")
+
+    async def vaciar(self):
+        """Guarda lo pendiente en lotes de hasta max_lote y, si la base responde, reintenta el spool"""
+        while self._pendientes:
+            # Se toma la lista entera antes de cualquier await: lo que se agregue mientras tanto queda para la vuelta siguiente
+            pendientes, self._pendientes = self._pendientes, []
+            for i in range(0, len(pendientes), self.max_lote):
+                if not await run_in_threadpool(self._guardar_lote, pendientes[i:i + self.max_lote]):
+                    await run_in_threadpool(self._al_spool, pendientes[i:])
+                    return
+        await run_in_threadpool(self._reintentar_spool)
+
+    def _guardar_lote(self, lote):
+        r = self.db.guardar_escaneos_lote(lote)
+        if not r["exito"]:
+            self._fallos += 1
+            print(f"⚠️ Historial diferido: {r['mensaje']}")
+            return False
+        self._lotes += 1
+        self._escaneos_guardados += len(lote)
+        if self.al_guardar is not None: self.al_guardar(lote)
+        return True
+
+    def _al_spool(self, registros):
+        """Añade los registros al spool y fuerza su escritura a disco"""
+        with open(self.spool, "a", encoding="utf-8") as f:
+            for usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha in registros:
+                f.write(json.dumps([usuario_id, nombre_usuario, ruta_imagen, resultado, confianza, fecha.isoformat()], ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._enviados_spool += len(registros)
+
+    def _reintentar_spool(self):
+        """Reclama el spool con un rename atómico (y lo que dejó a medias un proceso caído) y lo guarda por lotes"""
+        archivos = glob.glob(f"{glob.escape(self.spool)}.*.reintento")
+        if os.path.exists(self.spool): archivos.append(self.spool)
+        for ruta in sorted(archivos):
+            if ruta != self.spool:
+                pid = int(ruta.rsplit(".", 3)[-3])
+                if pid != os.getpid() and proceso_vivo(pid): continue
+            propio = f"{self.spool}.{os.getpid()}.{time.time_ns()}.reintento"
+            try: os.replace(ruta, propio)
+            except FileNotFoundError: continue  # otro proceso lo reclamó antes
+            if not self._guardar_archivo(propio): return
+
+    def _guardar_archivo(self, ruta):
+        with open(ruta, encoding="utf-8") as f:
+            registros = [tuple(r[:5]) + (datetime.fromisoformat(r[5]),) for r in (json.loads(l) for l in f if l.strip())]
+        for i in range(0, len(registros), self.max_lote):
+            lote = registros[i:i + self.max_lote]
+            if not self._guardar_lote(lote):
+                # Se conserva solo lo que falta, para no repetir los lotes ya guardados
+                with open(f"{ruta}.tmp", "w", encoding="utf-8") as f:
+                    for r in registros[i:]: f.write(json.dumps(list(r[:5]) + [r[5].isoformat()], ensure_ascii=False) + "\n")
+                os.replace(f"{ruta}.tmp", ruta)
+                return False
+            self._recuperados_spool += len(lote)
+        os.remove(ruta)
+        return True
+
+    def metricas(self):
+        return {
+            "pendientes": len(self._pendientes),
+            "escaneos_guardados": self._escaneos_guardados,
+            "lotes": self._lotes,
+            "fallos": self._fallos,
+            "enviados_spool": self._enviados_spool,
+            "recuperados_spool": self._recuperados_spool,
+            "archivos_spool": len(glob.glob(f"{glob.escape(self.spool)}*"))
+        }
@@ -0,0 +1,54 @@
+# Exportación columnar del historial: Parquet escrito por lotes, sin armar el archivo en memoria
+from base_datos import COLUMNAS_HISTORIAL
+
+class _Sumidero:
+    """Archivo de solo escritura para ParquetWriter: guarda lo escrito hasta que se retira"""
+    closed = False
+
+    def __init__(self):
+        self._partes = []
+        self._posicion = 0
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self._posicion
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def retirar(self):
+        datos = b"".join(self._partes)
+        self._partes = []
+        return datos
+
+def parquet_por_lotes(lotes):
+    """
+    Generador de bytes de un archivo Parquet con un grupo de filas por lote
+    lotes: iterable de listas de tuplas en el orden de COLUMNAS_HISTORIAL (BaseDatos.lotes_historial)
+    Necesita 'pyarrow' (opcional); sin él lanza RuntimeError antes de empezar a transmitir.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("❌ La exportación Parquet necesita 'pyarrow' instalado") from e
+    tipos = {"id": pa.int64(), "usuario_id": pa.int32(), "nombre_usuario": pa.string(), "ruta_imagen": pa.string(),
+             "resultado": pa.string(), "confianza": pa.float32(), "fecha_escaneo": pa.timestamp("us")}
+    esquema = pa.schema([(columna, tipos[columna]) for columna in COLUMNAS_HISTORIAL])
+
+    def generar():
+        sumidero = _Sumidero()
+        with pq.ParquetWriter(sumidero, esquema, compression="zstd") as escritor:
+            for lote in lotes:
+                columnas = [pa.array(valores, type=campo.type) for valores, campo in zip(zip(*lote), esquema)]
+                escritor.write_batch(pa.record_batch(columnas, schema=esquema))
+                yield sumidero.retirar()
+        yield sumidero.retirar()  # pie del archivo con los metadatos
+    return generar()
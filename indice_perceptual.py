@@ -0,0 +1,131 @@
+# Índice de hashes perceptuales: encuentra análisis recientes de fotos casi idénticas por distancia de Hamming
+import threading
+import time
+from collections import OrderedDict
+from configuracion import PHASH_DISTANCIA_USUARIO, PHASH_DISTANCIA_GLOBAL, PHASH_MAX_ENTRADAS, PHASH_TTL_SEGUNDOS, PHASH_MIN_BITS
+
+BITS = 64
+
+def segmentos_de(bits, partes):
+    """Divide `bits` en `partes` tramos contiguos casi iguales: [(desplazamiento, máscara), ...]"""
+    tramos, inicio = [], 0
+    for i in range(partes):
+        ancho = bits // partes + (i < bits % partes)
+        tramos.append((inicio, (1 << ancho) - 1))
+        inicio += ancho
+    return tramos
+
+class IndicePerceptual:
+    def __init__(self, distancia_usuario=PHASH_DISTANCIA_USUARIO, distancia_global=PHASH_DISTANCIA_GLOBAL,
+                 max_entradas=PHASH_MAX_ENTRADAS, ttl=PHASH_TTL_SEGUNDOS, min_bits=PHASH_MIN_BITS):
+        """
+        Tabla hash multi-índice sobre hashes de 64 bits, con expulsión LRU y TTL
+        Con distancia máxima d el hash se parte en d + 1 tramos: por el principio del palomar, dos hashes a
+        distancia <= d coinciden en al menos un tramo, así que basta mirar los cubos de esos tramos.
+        distancia_usuario: distancia admitida con fotos del mismo usuario (-1 = no buscar)
+        distancia_global: distancia admitida con fotos de cualquier usuario (-1 = no buscar)
+        min_bits: hashes con menos bits a 1 (o a 0) no se buscan ni se guardan: las fotos lisas, oscuras o
+        quemadas dan un hash casi constante, parecido al de cualquier otra foto lisa sea cual sea su color
+        """
+        self.distancia_usuario = distancia_usuario
+        self.distancia_global = distancia_global
+        self.max_entradas = max(1, max_entradas)
+        self.ttl = ttl
+        self.min_bits = min_bits
+        partes = min(BITS, max(distancia_usuario, distancia_global, 0) + 1)
+        self._segmentos = segmentos_de(BITS, partes)
+        self._tablas = [{} for _ in self._segmentos]  # por tramo: valor del tramo -> set de ids de entrada
+        self._entradas = OrderedDict()  # id -> (momento, hash, usuario_id, valor), de la más antigua a la más reciente
+        self._siguiente_id = 0
+        self._lock = threading.Lock()
+        self._aciertos_usuario = 0
+        self._aciertos_global = 0
+        self._fallos = 0
+        self._expulsiones = 0
+        self._comparaciones = 0
+
+    @property
+    def activo(self):
+        return self.distancia_usuario >= 0 or self.distancia_global >= 0
+
+    def _informativo(self, h):
+        unos = h.bit_count()
+        return min(unos, BITS - unos) >= self.min_bits
+
+    def _claves(self, h):
+        return [(h >> desplazamiento) & mascara for desplazamiento, mascara in self._segmentos]
+
+    def _quitar(self, id_entrada):
+        _, h, _, _ = self._entradas.pop(id_entrada)
+        for tabla, clave in zip(self._tablas, self._claves(h)):
+            cubo = tabla[clave]
+            cubo.discard(id_entrada)
+            if not cubo: del tabla[clave]
+
+    def _expulsar(self, ahora):
+        """Quita las entradas vencidas y, si sobra alguna, las menos usadas"""
+        while self._entradas:
+            id_entrada, (momento, _, _, _) = next(iter(self._entradas.items()))
+            if len(self._entradas) <= self.max_entradas and ahora - momento < self.ttl: break
+            self._quitar(id_entrada)
+            self._expulsiones += 1
+
+    def buscar(self, h, usuario_id):
+        """
+        Valor guardado de la foto más parecida dentro de la distancia de su ámbito, o None
+        Prefiere una foto del mismo usuario; retorna (valor, distancia, ambito) con ambito "usuario" o "global"
+        """
+        if not self.activo: return None
+        ahora = time.time()
+        with self._lock:
+            if not self._informativo(h):
+                self._fallos += 1
+                return None
+            self._expulsar(ahora)
+            candidatos = set()
+            for tabla, clave in zip(self._tablas, self._claves(h)):
+                candidatos.update(tabla.get(clave, ()))
+            self._comparaciones += len(candidatos)
+            mejor = None  # (prioridad, distancia, id)
+            for id_entrada in candidatos:
+                momento, otro, dueno, _ = self._entradas[id_entrada]
+                if ahora - momento >= self.ttl: continue  # usada hace poco pero analizada hace demasiado
+                distancia = (h ^ otro).bit_count()
+                if dueno == usuario_id and distancia <= self.distancia_usuario: prioridad = 0
+                elif distancia <= self.distancia_global: prioridad = 1
+                else: continue
+                if mejor is None or (prioridad, distancia) < mejor[:2]: mejor = (prioridad, distancia, id_entrada)
+            if mejor is None:
+                self._fallos += 1
+                return None
+            prioridad, distancia, id_entrada = mejor
+            self._entradas.move_to_end(id_entrada)
+            if prioridad == 0: self._aciertos_usuario += 1
+            else: self._aciertos_global += 1
+            return self._entradas[id_entrada][3], distancia, "usuario" if prioridad == 0 else "global"
+
+    def agregar(self, h, usuario_id, valor):
+        """Registra el análisis de una foto recién procesada"""
+        if not self.activo or not self._informativo(h): return
+        ahora = time.time()
+        with self._lock:
+            id_entrada = self._siguiente_id
+            self._siguiente_id += 1
+            self._entradas[id_entrada] = (ahora, h, usuario_id, valor)
+            for tabla, clave in zip(self._tablas, self._claves(h)):
+                tabla.setdefault(clave, set()).add(id_entrada)
+            self._expulsar(ahora)
+
+    def metricas(self):
+        with self._lock:
+            busquedas = self._aciertos_usuario + self._aciertos_global + self._fallos
+            return {
+                "entradas": len(self._entradas),
+                "max_entradas": self.max_entradas,
+                "tramos": len(self._segmentos),
+                "aciertos_usuario": self._aciertos_usuario,
+                "aciertos_global": self._aciertos_global,
+                "fallos": self._fallos,
+                "expulsiones": self._expulsiones,
+                "comparaciones_por_busqueda": round(self._comparaciones / busquedas, 1) if busquedas else 0.0
+            }
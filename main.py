@@ -1,219 +1,559 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import uvicorn
-from PIL import Image
-import io
-import requests
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import contextlib
+import importlib
+import json
 import os
-from datetime import datetime
-import numpy as np
-from base_datos import BaseDatos
+import threading
+import time
+from typing import List, Optional
+from uuid import UUID
+from datetime import date, datetime, timedelta
+from base_datos import crear_base_datos, decodificar_cursor
+from clasificadores import crear_clasificador
+from cache_resultados import CacheResultados, CacheRespuestas, etag_coincide
+from indice_perceptual import IndicePerceptual
+from almacen_imagenes import AlmacenImagenes, ImagenDemasiadoGrandeError, ImagenInvalidaError
+from cola_trabajos import ColaTrabajos, ESTADOS_FINALES
+from metricas import registro, medir_etapa, MiddlewareMetricas, MetricasCompartidas
+from control_admision import ControlAdmision, MiddlewareAdmision
+from sesiones import Sesiones, MiddlewareSesiones
+from escritura_diferida import EscrituraDiferida
+from exportacion import parquet_por_lotes
 from configuracion import *
-from psycopg2.extras import RealDictCursor
-from dotenv import load_dotenv
 
-# Cargar variables de entorno
-load_dotenv()
+# Varios trabajadores solo con python servidor.py: lanzados desde aquí, main se cargaría entero en el supervisor
+# y dos veces en cada trabajador (como __mp_main__ de spawn y como main:app)
+if __name__ == "__main__" and SERVIDOR_TRABAJADORES > 1:
+    raise SystemExit("❌ Con SERVIDOR_TRABAJADORES > 1 el servidor se arranca con: python servidor.py")
 
 app = FastAPI(title="Mayaflora API")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
-# Inicializar base de datos con la URL de Supabase
+# PostgreSQL (Supabase) si DATABASE_URL está definida; si no, o con sqlite:///ruta.db, SQLite local
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
-    raise ValueError("❌ DATABASE_URL no está configurada en las variables de entorno")
+    print(f"ℹ️ DATABASE_URL no está configurada: se usa SQLite ({NOMBRE_BASE_DATOS})")
+
+# Con servidor.py el supervisor ya preparó el esquema: los trabajadores solo abren su pool
+db = crear_base_datos(DATABASE_URL, inicializar=not SERVIDOR_ARRANQUE_HECHO)
+
+clasificador = crear_clasificador()
+cache = CacheResultados(db=db if CACHE_PERSISTENTE else None)
+respuestas = CacheRespuestas()
+indice = IndicePerceptual()
+admision = ControlAdmision()
+almacen = AlmacenImagenes()
+sesiones = Sesiones(db)
+escritura = EscrituraDiferida(db, al_guardar=lambda lote: respuestas.invalidar({r[0] for r in lote})) if ESCRITURA_DIFERIDA else None
+compartidas = MetricasCompartidas(SERVIDOR_METRICAS_DIR) if SERVIDOR_METRICAS_DIR else None
+
+# Admisión por dentro de las sesiones (usa el usuario del token) y antes de que se lea la subida;
+# CORS por fuera de las sesiones para que también los 401/403 lleven sus cabeceras
+app.add_middleware(MiddlewareAdmision, admision=admision)
+app.add_middleware(MiddlewareSesiones, sesiones=sesiones)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+
+os.makedirs(CARPETA_IMAGENES, exist_ok=True)
+
+@app.on_event("startup")
+def precargar_modulos():
+    """Carga numpy/PIL en segundo plano: el servidor atiende peticiones mientras tanto"""
+    threading.Thread(target=importlib.import_module, args=("procesamiento_imagen",), daemon=True).start()
+
+@app.on_event("startup")
+def iniciar_cola(): cola.iniciar()
+
+@app.on_event("startup")
+def iniciar_sesiones(): sesiones.iniciar()
 
-db = BaseDatos(DATABASE_URL)
+@app.on_event("startup")
+def iniciar_escritura():
+    if escritura is not None: escritura.iniciar()
 
-try:
-    resultado = db.crear_usuario("admin", "admin123")
-    print("✅ Admin creado" if resultado["exito"] else "ℹ️ Admin existe")
-except: pass
+async def mantener_historial():
+    """Particiones del mes siguiente y retención del historial, cada HISTORIAL_MANTENIMIENTO_INTERVALO segundos"""
+    while True:
+        r = await run_in_threadpool(db.mantener_historial)
+        if not r["exito"]: print(f"❌ {r['mensaje']}")
+        elif r["eliminados"]: respuestas.invalidar()
+        await asyncio.sleep(HISTORIAL_MANTENIMIENTO_INTERVALO)
 
-if not os.path.exists(CARPETA_IMAGENES): os.makedirs(CARPETA_IMAGENES)
+mantenimiento = None
+
+@app.on_event("startup")
+def iniciar_mantenimiento():
+    global mantenimiento
+    if not SERVIDOR_ARRANQUE_HECHO:  # con varios trabajadores lo hace el supervisor, una sola vez
+        mantenimiento = asyncio.create_task(mantener_historial())
+
+@app.on_event("startup")
+def iniciar_metricas_compartidas():
+    if compartidas is not None: compartidas.iniciar()
+
+@app.on_event("shutdown")
+async def cerrar_recursos():
+    if mantenimiento is not None:
+        mantenimiento.cancel()
+        with contextlib.suppress(asyncio.CancelledError): await mantenimiento
+    await cola.detener()
+    if escritura is not None: await escritura.detener()  # antes de cerrar la base: lo pendiente se guarda o va al spool
+    await sesiones.detener()
+    await clasificador.cerrar()
+    db.cerrar()
+    if compartidas is not None: compartidas.detener()
+
+@app.middleware("http")
+async def limitar_tamano_subida(request, call_next):
+    """Rechaza por Content-Length las subidas que no caben, antes de que se lea el cuerpo"""
+    if request.url.path.startswith("/api/analizar"):
+        imagenes = LOTE_MAX_IMAGENES if request.url.path.endswith("/lote") else 1
+        longitud = request.headers.get("content-length", "")
+        # Margen para los campos del formulario y las cabeceras multipart
+        if longitud.isdigit() and int(longitud) > imagenes * SUBIDA_MAX_BYTES + 64 * 1024:
+            return JSONResponse(content={"exito": False, "mensaje": f"La imagen supera el máximo de {SUBIDA_MAX_BYTES // 1024} KB"}, status_code=413)
+    return await call_next(request)
+
+# Se añade después del límite de tamaño para quedar por fuera y medir también sus 413
+app.add_middleware(MiddlewareMetricas)
+
+registro.calibre("mayaflora_trabajadores", "Procesos que atienden peticiones (cada uno suma 1)", lambda: 1)
+registro.calibre("mayaflora_db_conexiones_en_uso", "Conexiones del pool prestadas", lambda: db.metricas_pool()["en_uso"])
+registro.calibre("mayaflora_db_conexiones_abiertas", "Conexiones abiertas en el pool", lambda: db.metricas_pool()["total"])
+registro.calibre("mayaflora_admision_activos", "Análisis en curso", lambda: admision.metricas()["activos"])
+registro.calibre("mayaflora_admision_en_cola", "Análisis esperando turno", lambda: admision.metricas()["en_cola"])
+registro.calibre("mayaflora_historial_pendiente", "Escaneos en memoria esperando la escritura diferida",
+                 lambda: escritura.metricas()["pendientes"] if escritura is not None else 0)
+registro.calibre("mayaflora_interruptor_abierto", "1 si el circuit breaker de inferencia está abierto",
+                 lambda: clasificador.metricas().get("interruptor", {}).get("estado") == "abierto")
+
+@app.get("/metrics")
+def metricas_prometheus():
+    """Histogramas de latencia y estado actual en formato de exposición de Prometheus, sumando todos los trabajadores"""
+    texto = compartidas.exportar() if compartidas is not None else registro.exportar()
+    return PlainTextResponse(texto, media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 def raiz(): return {"mensaje": "Mayaflora API", "version": "2.0 - PostgreSQL", "estado": "activo"}
 
 @app.post("/api/registro")
-async def registrar_usuario(nombre_usuario: str = Form(...), contrasena: str = Form(...)):
+def registrar_usuario(nombre_usuario: str = Form(...), contrasena: str = Form(...)):
     r = db.crear_usuario(nombre_usuario, contrasena)
     return JSONResponse(content=r, status_code=201 if r["exito"] else 400)
 
 @app.post("/api/login")
-async def iniciar_sesion(nombre_usuario: str = Form(...), contrasena: str = Form(...)):
+def iniciar_sesion(nombre_usuario: str = Form(...), contrasena: str = Form(...)):
+    """Única ruta que consulta credenciales: el token emitido identifica al usuario en el resto de peticiones"""
     r = db.verificar_usuario(nombre_usuario, contrasena)
-    return JSONResponse(content=r, status_code=200 if r["exito"] else 401)
+    if not r["exito"]: return JSONResponse(content=r, status_code=401)
+    token, datos = sesiones.emitir(r["usuario"]["id"], r["usuario"]["nombre_usuario"])
+    return JSONResponse(content={**r, "token": token, "rol": datos["rol"], "expira": datos["exp"]})
 
-def analizar_colores_hongos(imagen_bytes):
-    try:
-        img = Image.open(io.BytesIO(imagen_bytes)).convert('RGB')
-        img_array = np.array(img)
-        r, g, b = img_array[:,:,0].astype(float), img_array[:,:,1].astype(float), img_array[:,:,2].astype(float)
-        lum = 0.299*r + 0.587*g + 0.114*b
-        osc = np.sum(lum < 60) / lum.size * 100
-        mar = np.sum((r>80)&(r<150)&(g>50)&(g<120)&(b<80)) / lum.size * 100
-        ama = np.sum((r>180)&(g>180)&(b<120)) / lum.size * 100
-        score = (35 if osc>10 else 0) + (40 if mar>3 else 0) + (25 if ama>2 else 0)
-        return {"score": score, "detalles": {"oscuras": osc, "marrones": mar, "amarillas": ama}}
-    except: return {"score": 0, "detalles": {}}
-
-def analizar_con_huggingface(imagen_bytes):
-    headers = {"Authorization": f"Bearer {HUGGINGFACE_API_KEY}", "Content-Type": "application/octet-stream"}
-    try:
-        img = Image.open(io.BytesIO(imagen_bytes))
-        img.verify()
-        img = Image.open(io.BytesIO(imagen_bytes)).convert('RGB')
-        buf = io.BytesIO()
-        img.save(buf, format='JPEG', quality=95)
-        r = requests.post(HUGGINGFACE_API_URL, headers=headers, data=buf.getvalue(), timeout=60)
-        if r.status_code == 200: return {"exito": True, "predicciones": r.json()}
-        if r.status_code == 503:
-            import time
-            time.sleep(10)
-            r = requests.post(HUGGINGFACE_API_URL, headers=headers, data=buf.getvalue(), timeout=60)
-            if r.status_code == 200: return {"exito": True, "predicciones": r.json()}
-        return {"exito": False, "mensaje": f"Error {r.status_code}"}
-    except Exception as e: return {"exito": False, "mensaje": str(e)}
+@app.post("/api/logout")
+def cerrar_sesion(request: Request):
+    """Revoca el token de la petición antes de que expire"""
+    if request.state.sesion is None:
+        return JSONResponse(content={"exito": False, "mensaje": "Sesión requerida"}, status_code=401)
+    r = sesiones.revocar(request.state.sesion)
+    return JSONResponse(content=r, status_code=200 if r["exito"] else 500)
+
+def usuario_de_sesion(request, usuario_id=None, nombre_usuario=None):
+    """
+    (usuario_id, nombre_usuario) efectivos: los del token si lo hay; sin token (SESION_OBLIGATORIA desactivada)
+    se confía en los que envía el cliente. Solo el admin puede actuar sobre otro usuario.
+    """
+    sesion = request.state.sesion
+    if sesion is None:
+        if usuario_id is None: raise HTTPException(status_code=401, detail="Sesión requerida")
+        return usuario_id, nombre_usuario
+    if usuario_id is None or usuario_id == sesion["uid"]:
+        return sesion["uid"], sesion["nombre"]
+    if sesion["rol"] != "admin": raise HTTPException(status_code=403, detail="No autorizado para este usuario")
+    return usuario_id, nombre_usuario or sesion["nombre"]
+
+def verificar_dueno_trabajo(request, r):
+    """Un trabajo ajeno se responde como inexistente"""
+    sesion = request.state.sesion
+    if r["exito"] and sesion is not None and sesion["rol"] != "admin" and r["trabajo"]["usuario_id"] != sesion["uid"]:
+        return {"exito": False, "mensaje": "Trabajo no encontrado"}
+    return r
 
 def interpretar_resultado(preds, ac):
     if not preds: return {"resultado": "Error", "confianza": 0.0, "mensaje": "Error"}
     mp = max(preds, key=lambda x: x['score'])
     et, chf, sc = mp['label'].lower(), mp['score']*100, ac.get("score", 0)
+    # Una mancha densa en una hoja grande apenas mueve el score global: cuenta también la peor zona
+    local = round(ac.get("zonas", {}).get("peor", {}).get("score", 0) * COLORES_ZONAS_PESO)
+    sc = max(sc, local)
     enf = any(p in et for p in PALABRAS_CLAVE_ENFERMEDAD)
     if sc>60: return {"resultado": "Enferma", "confianza": round(min(sc+10,95),2), "mensaje": f"Manchas detectadas", "detalle": f"Score:{sc}"}
     if enf and chf>30: return {"resultado": "Enferma", "confianza": round((chf+sc)/2,2), "mensaje": "Posible hongo", "detalle": et}
-    if sc>40: return {"resultado": "Enferma", "confianza": round(max(sc,60),2), "mensaje": "Anomalías", "detalle": "Manchas"}
+    if sc>40: return {"resultado": "Enferma", "confianza": round(max(sc,60),2), "mensaje": "Anomalías", "detalle": "Manchas localizadas" if local > ac.get("score", 0) else "Manchas"}
     return {"resultado": "Sana", "confianza": round(max(100-sc,70),2), "mensaje": "Sana", "detalle": "Sin anomalías"}
 
-@app.post("/api/analizar")
-async def analizar_imagen(imagen: UploadFile = File(...), usuario_id: int = Form(...), nombre_usuario: str = Form(...)):
+async def guardar_subida(imagen):
+    """Copia la subida al almacén por bloques en un hilo; 413 si supera SUBIDA_MAX_BYTES, 400 si no es una imagen"""
+    from procesamiento_imagen import verificar_imagen
     try:
-        cont = await imagen.read()
-        Image.open(io.BytesIO(cont)).verify()
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        ruta = os.path.join(CARPETA_IMAGENES, f"escaneo_{usuario_id}_{ts}.jpg")
-        with open(ruta, "wb") as f: f.write(cont)
-        rhf = analizar_con_huggingface(cont)
-        if not rhf["exito"]: raise HTTPException(status_code=500, detail=rhf["mensaje"])
-        ac = analizar_colores_hongos(cont)
-        an = interpretar_resultado(rhf["predicciones"], ac)
-        db.guardar_escaneo(usuario_id, nombre_usuario, ruta, an["resultado"], an["confianza"])
-        return JSONResponse(content={"exito": True, "resultado": an["resultado"], "confianza": an["confianza"], "mensaje": an["mensaje"], "detalle": an.get("detalle","")})
+        with medir_etapa("almacenamiento"): return await run_in_threadpool(almacen.guardar, imagen.file, verificar_imagen)
+    except ImagenDemasiadoGrandeError as e: raise HTTPException(status_code=413, detail=str(e))
+    except ImagenInvalidaError as e: raise HTTPException(status_code=400, detail=str(e))
+
+def interpretar(preds, ac):
+    with medir_etapa("interpretacion"): an = interpretar_resultado(preds, ac)
+    if "zonas" in ac: an["zonas"] = ac["zonas"]
+    return an
+
+async def analizar_contenido(ruta, clave, limite=None, usuario_id=None):
+    """Caché, preprocesamiento, fotos casi idénticas, inferencia, colores e interpretación; retorna (analisis, en_cache)"""
+    from procesamiento_imagen import preprocesar_imagen, analizar_colores_hongos, analizar_colores_por_zonas
+    plazo = time.monotonic() + HF_PLAZO_TOTAL
+    with medir_etapa("cache"): cacheado = await run_in_threadpool(cache.obtener, clave)
+    if cacheado is not None:
+        return interpretar(cacheado["predicciones"], cacheado["analisis_colores"]), True
+    try:
+        with medir_etapa("decodificacion"): prep = await run_in_threadpool(preprocesar_imagen, ruta)
+    except (OSError, SyntaxError):
+        # UnidentifiedImageError y los archivos truncados son OSError; el mensaje de PIL lleva la ruta en el servidor
+        raise HTTPException(status_code=400, detail="El archivo no es una imagen válida")
+    with medir_etapa("casi_duplicados"): similar = indice.buscar(prep["dhash"], usuario_id)
+    if similar is None:
+        async with limite or contextlib.nullcontext():
+            with medir_etapa("inferencia"): rhf = await clasificador.clasificar(prep["jpeg_modelo"], plazo)
+    if COLORES_ZONAS_REJILLA > 0: colores = (analizar_colores_por_zonas, prep["pixeles"], COLORES_ZONAS_REJILLA)
+    else: colores = (analizar_colores_hongos, prep["pixeles"])
+    with medir_etapa("colores"): ac = await run_in_threadpool(*colores)
+    if similar is not None:
+        # Ráfaga de la misma hoja: se reutilizan las predicciones de la foto reciente más parecida, pero los
+        # colores se miden siempre (el dHash solo ve brillo) y el resultado no pasa a la caché por contenido
+        an = interpretar(similar[0]["predicciones"], ac)
+        an["casi_duplicado"] = True
+        return an, True
+    if not rhf["exito"]:
+        if HF_RESPALDO_COLORES:
+            # Veredicto solo por colores mientras el clasificador no responde; no se guarda en caché
+            an = interpretar([{"label": "", "score": 0.0}], ac)
+            an["respaldo_colores"] = True
+            return an, False
+        if rhf.get("interruptor_abierto"):
+            raise HTTPException(status_code=503, detail=rhf["mensaje"], headers={"Retry-After": str(max(1, round(rhf["reintentar_en"])))})
+        raise HTTPException(status_code=500, detail=rhf["mensaje"])
+    await run_in_threadpool(cache.guardar, clave, rhf["predicciones"], ac)
+    indice.agregar(prep["dhash"], usuario_id, {"predicciones": rhf["predicciones"]})
+    return interpretar(rhf["predicciones"], ac), False
+
+def respuesta_analisis(an, en_cache):
+    """Campos de un análisis que se devuelven al cliente"""
+    return {"resultado": an["resultado"], "confianza": an["confianza"], "mensaje": an["mensaje"], "detalle": an.get("detalle",""), "en_cache": en_cache, "casi_duplicado": an.get("casi_duplicado", False), "respaldo_colores": an.get("respaldo_colores", False), "zonas": an.get("zonas")}
+
+async def procesar_subida(imagen, usuario_id, limite=None):
+    """Guarda una imagen subida en el almacén y la analiza; retorna (ruta, analisis, en_cache)"""
+    guardada = await guardar_subida(imagen)
+    an, en_cache = await analizar_contenido(guardada["ruta"], guardada["clave"], limite, usuario_id)
+    return guardada["ruta"], an, en_cache
+
+async def procesar_trabajo(trabajo):
+    """Ejecuta un análisis encolado: la misma cadena que /api/analizar, leyendo la imagen ya guardada"""
+    ruta = trabajo["ruta_imagen"]
+    clave = await run_in_threadpool(almacen.clave_de, ruta)
+    try: an, en_cache = await analizar_contenido(ruta, clave, usuario_id=trabajo["usuario_id"])
+    except HTTPException as e: raise RuntimeError(e.detail)
+    with medir_etapa("guardado"):
+        r = await run_in_threadpool(db.guardar_escaneo, trabajo["usuario_id"], trabajo["nombre_usuario"], trabajo["ruta_imagen"], an["resultado"], an["confianza"])
+    if not r["exito"]: raise RuntimeError(r["mensaje"])
+    respuestas.invalidar([trabajo["usuario_id"]])
+    return {**respuesta_analisis(an, en_cache), "escaneo_id": r["escaneo_id"]}
+
+cola = ColaTrabajos(db, procesar_trabajo)
+
+async def analizar_subida(imagen, usuario_id, nombre_usuario, asincrono):
+    """Guarda la imagen y la analiza (o la encola); se ejecuta con un turno de admisión ya concedido"""
+    if asincrono:
+        # Guarda la imagen, encola y responde de inmediato; el resultado se consulta en /api/trabajos/{id}
+        guardada = await guardar_subida(imagen)
+        r = await run_in_threadpool(db.crear_trabajo, usuario_id, nombre_usuario, guardada["ruta"])
+        if r["exito"]: cola.despertar()
+        return JSONResponse(content=r, status_code=202 if r["exito"] else 500)
+    ruta, an, en_cache = await procesar_subida(imagen, usuario_id)
+    if escritura is not None:
+        # La respuesta no espera al commit: el escaneo se guarda en el siguiente lote
+        escritura.agregar(usuario_id, nombre_usuario, ruta, an["resultado"], an["confianza"])
+    else:
+        with medir_etapa("guardado"): await run_in_threadpool(db.guardar_escaneo, usuario_id, nombre_usuario, ruta, an["resultado"], an["confianza"])
+        respuestas.invalidar([usuario_id])
+    return JSONResponse(content={"exito": True, **respuesta_analisis(an, en_cache)})
+
+@app.post("/api/analizar")
+async def analizar_imagen(request: Request, imagen: UploadFile = File(...), usuario_id: Optional[int] = Form(None), nombre_usuario: Optional[str] = Form(None), asincrono: bool = Form(False)):
+    usuario_id, nombre_usuario = usuario_de_sesion(request, usuario_id, nombre_usuario)
+    try: return await analizar_subida(imagen, usuario_id, nombre_usuario, asincrono)
+    except HTTPException: raise
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/historial/{usuario_id}")
-async def obtener_historial(usuario_id: int):
-    r = db.obtener_historial(usuario_id)
+@app.get("/api/trabajos/{trabajo_id}")
+def obtener_trabajo(request: Request, trabajo_id: UUID):
+    """Estado de un análisis asíncrono (pendiente, procesando, completado o error)"""
+    r = verificar_dueno_trabajo(request, db.obtener_trabajo(str(trabajo_id)))
+    return JSONResponse(content=r, status_code=200 if r["exito"] else 404)
+
+@app.get("/api/trabajos/{trabajo_id}/eventos")
+async def eventos_trabajo(request: Request, trabajo_id: UUID):
+    """Server-sent events con cada cambio de estado del trabajo, hasta que termina"""
+    async def eventos():
+        ultimo = None
+        while True:
+            r = verificar_dueno_trabajo(request, await run_in_threadpool(db.obtener_trabajo, str(trabajo_id)))
+            if not r["exito"]:
+                yield f"event: error\ndata: {json.dumps(r, ensure_ascii=False)}\n\n"
+                return
+            estado = r["trabajo"]["estado"]
+            if estado != ultimo:
+                yield f"event: estado\ndata: {json.dumps(r['trabajo'], ensure_ascii=False)}\n\n"
+                ultimo = estado
+            if estado in ESTADOS_FINALES: return
+            await cola.esperar_cambio(str(trabajo_id), TRABAJOS_INTERVALO_SONDEO)
+    return StreamingResponse(eventos(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/api/analizar/lote")
+async def analizar_lote(request: Request, imagenes: List[UploadFile] = File(...), usuario_id: Optional[int] = Form(None), nombre_usuario: Optional[str] = Form(None)):
+    """Analiza varias imágenes en una petición y guarda todo el historial con un solo INSERT"""
+    usuario_id, nombre_usuario = usuario_de_sesion(request, usuario_id, nombre_usuario)
+    if len(imagenes) > LOTE_MAX_IMAGENES:
+        return JSONResponse(content={"exito": False, "mensaje": f"Máximo {LOTE_MAX_IMAGENES} imágenes por lote"}, status_code=400)
+    # Un lote ocupa un solo turno de admisión (MiddlewareAdmision); LOTE_MAX_CONCURRENCIA limita sus inferencias internas
+    return await analizar_imagenes(imagenes, usuario_id, nombre_usuario)
+
+async def analizar_imagenes(imagenes, usuario_id, nombre_usuario):
+    limite = asyncio.Semaphore(LOTE_MAX_CONCURRENCIA)
+
+    async def procesar(imagen):
+        try:
+            return await procesar_subida(imagen, usuario_id, limite=limite)
+        except HTTPException as e: return e.detail
+        except Exception as e: return str(e)
+
+    salidas = await asyncio.gather(*[procesar(im) for im in imagenes])
+    resultados, registros = [], []
+    for i, (imagen, salida) in enumerate(zip(imagenes, salidas)):
+        if isinstance(salida, str):
+            resultados.append({"indice": i, "archivo": imagen.filename, "exito": False, "mensaje": salida})
+            continue
+        ruta, an, en_cache = salida
+        registros.append((usuario_id, nombre_usuario, ruta, an["resultado"], an["confianza"]))
+        resultados.append({"indice": i, "archivo": imagen.filename, "exito": True, **respuesta_analisis(an, en_cache)})
+    if registros:
+        with medir_etapa("guardado"): r = await run_in_threadpool(db.guardar_escaneos_lote, registros)
+        if not r["exito"]: return JSONResponse(content=r, status_code=500)
+        respuestas.invalidar([usuario_id])
+        for res, escaneo_id in zip((x for x in resultados if x["exito"]), r["escaneo_ids"]): res["escaneo_id"] = escaneo_id
+    exitosos = len(registros)
+    return JSONResponse(content={"exito": exitosos > 0, "total": len(imagenes), "exitosos": exitosos, "fallidos": len(imagenes) - exitosos, "resultados": resultados}, status_code=200 if exitosos else 500)
+
+def respuesta_ndjson(filas):
+    """Transmite filas como NDJSON (una línea JSON por fila) sin armar la lista en memoria"""
+    return StreamingResponse((json.dumps(f, ensure_ascii=False) + "\n" for f in filas), media_type="application/x-ndjson")
+
+def inicio_del_dia(dia):
+    return datetime(dia.year, dia.month, dia.day) if dia is not None else None
+
+def pagina_historial(usuario_id, limite, cursor):
+    try: despues_de = decodificar_cursor(cursor) if cursor else None
+    except ValueError as e: return JSONResponse(content={"exito": False, "mensaje": str(e)}, status_code=400)
+    r = db.obtener_historial(usuario_id, limite, despues_de)
     return JSONResponse(content=r, status_code=200 if r["exito"] else 500)
 
+CACHE_CONTROL_PRIVADO = "private, no-cache"  # el cliente guarda la respuesta pero revalida siempre con If-None-Match
+
+def respuesta_versionada(request, usuario_id, generar, variante=None, transmitir=False):
+    """
+    Respuesta condicional por la versión del historial del usuario (una lectura por clave primaria):
+    304 si el cliente ya tiene esa versión; si no, el cuerpo JSON de la caché o el que arme `generar()`
+    transmitir: la respuesta de `generar()` se envía en streaming, sin pasar por la caché
+    """
+    v = db.obtener_version_historial(usuario_id)
+    if not v["exito"]: return generar()
+    variante = variante or f"{request.url.path}?{request.url.query}"
+    etag = respuestas.etag(usuario_id, variante, v["version"])
+    cabeceras = {"ETag": etag, "Cache-Control": CACHE_CONTROL_PRIVADO}
+    if etag_coincide(request.headers.get("if-none-match"), etag):
+        respuestas.no_modificado()
+        return Response(status_code=304, headers=cabeceras)
+    if transmitir:
+        respuesta = generar()
+        respuesta.headers.update(cabeceras)
+        return respuesta
+    cuerpo = respuestas.obtener(usuario_id, variante, v["version"])
+    if cuerpo is None:
+        respuesta = generar()
+        if respuesta.status_code != 200: return respuesta
+        cuerpo = respuesta.body
+        respuestas.guardar(usuario_id, variante, v["version"], cuerpo)
+    return Response(content=cuerpo, media_type="application/json", headers=cabeceras)
+
+@app.get("/api/historial/{usuario_id}")
+def obtener_historial(request: Request, usuario_id: int, limite: Optional[int] = Query(None, ge=1, le=HISTORIAL_LIMITE_MAXIMO), cursor: Optional[str] = None, formato: str = "json"):
+    """Historial del usuario; con `limite` pagina por cursor y con formato=ndjson lo transmite completo"""
+    usuario_de_sesion(request, usuario_id)
+    if formato == "ndjson":
+        return respuesta_versionada(request, usuario_id, lambda: respuesta_ndjson(db.iterar_historial(usuario_id)), transmitir=True)
+    return respuesta_versionada(request, usuario_id, lambda: pagina_historial(usuario_id, limite, cursor))
+
 @app.get("/api/estadisticas/{usuario_id}")
-async def obtener_estadisticas(usuario_id: int):
-    h = db.obtener_historial(usuario_id)
-    if not h["exito"]: return JSONResponse(content={"exito": False}, status_code=500)
-    t = len(h["historial"])
-    e = sum(1 for x in h["historial"] if x["resultado"]=="Enferma")
-    return JSONResponse(content={"exito": True, "estadisticas": {"total_escaneos": t, "plantas_enfermas": e, "plantas_sanas": t-e}})
+def obtener_estadisticas(request: Request, usuario_id: int, agrupar: Optional[str] = Query(None, pattern="^(dia|semana)$"), dias: int = Query(30, ge=1, le=366)):
+    """Totales del usuario; con agrupar=dia|semana agrega la serie de los últimos `dias` días"""
+    usuario_de_sesion(request, usuario_id)
+    if not agrupar: return respuesta_versionada(request, usuario_id, lambda: estadisticas_usuario(usuario_id))
+    # La serie empieza a medianoche: solo cambia con el historial o con el día
+    desde = datetime.combine(datetime.now().date() - timedelta(days=dias), datetime.min.time())
+    variante = f"{request.url.path}?agrupar={agrupar}&desde={desde.date().isoformat()}"
+    return respuesta_versionada(request, usuario_id, lambda: estadisticas_usuario(usuario_id, agrupar, desde), variante)
+
+def estadisticas_usuario(usuario_id, agrupar=None, desde=None):
+    r = db.obtener_estadisticas(usuario_id)
+    if not r["exito"]: return JSONResponse(content={"exito": False}, status_code=500)
+    if agrupar:
+        s = db.obtener_estadisticas_periodo(usuario_id, agrupar, desde)
+        if not s["exito"]: return JSONResponse(content={"exito": False}, status_code=500)
+        r["series"] = s["series"]
+    return JSONResponse(content=r)
 
 @app.get("/api/admin/usuarios")
-async def listar_todos_usuarios():
-    try:
-        c = db.obtener_conexion()
-        cu = c.cursor(cursor_factory=RealDictCursor)
-        cu.execute("""
-            SELECT u.id, u.nombre_usuario, u.fecha_creacion, 
-                   COUNT(h.id) as total_escaneos 
-            FROM usuarios u
-            LEFT JOIN historial_escaneos h ON u.id = h.usuario_id
-            GROUP BY u.id, u.nombre_usuario, u.fecha_creacion
-            ORDER BY u.fecha_creacion DESC
-        """)
-        us = cu.fetchall()
-        cu.close()
-        c.close()
-        return JSONResponse(content={"exito": True, "usuarios": [{"id": u["id"], "nombre_usuario": u["nombre_usuario"], "fecha_creacion": u["fecha_creacion"].isoformat(), "total_escaneos": u["total_escaneos"]} for u in us]})
-    except Exception as e: return JSONResponse(content={"exito": False, "mensaje": str(e)}, status_code=500)
+def listar_todos_usuarios():
+    r = db.listar_usuarios()
+    return JSONResponse(content=r, status_code=200 if r["exito"] else 500)
 
 @app.delete("/api/admin/usuarios/{usuario_id}")
-async def eliminar_usuario(usuario_id: int):
-    try:
-        c = db.obtener_conexion()
-        cu = c.cursor(cursor_factory=RealDictCursor)
-        cu.execute("SELECT nombre_usuario FROM usuarios WHERE id=%s", (usuario_id,))
-        u = cu.fetchone()
-        if u and u["nombre_usuario"].lower()=="admin": 
-            cu.close()
-            c.close()
-            return JSONResponse(content={"exito": False, "mensaje": "No eliminar admin"}, status_code=400)
-        cu.execute("DELETE FROM usuarios WHERE id=%s", (usuario_id,))
-        c.commit()
-        cu.close()
-        c.close()
-        return JSONResponse(content={"exito": True, "mensaje": "Eliminado"})
-    except Exception as e: return JSONResponse(content={"exito": False, "mensaje": str(e)}, status_code=500)
+def eliminar_usuario(usuario_id: int):
+    r = db.eliminar_usuario(usuario_id)
+    if r["exito"]:
+        sesiones.revocar_usuario(usuario_id)
+        respuestas.invalidar([usuario_id])
+    return JSONResponse(content={"exito": r["exito"], "mensaje": r["mensaje"]}, status_code=200 if r["exito"] else 400 if r.get("protegido") else 500)
 
 @app.put("/api/admin/usuarios/{usuario_id}/contrasena")
-async def cambiar_contrasena_usuario(usuario_id: int, nueva_contrasena: str = Form(...)):
-    try:
-        c = db.obtener_conexion()
-        cu = c.cursor()
-        ce = db.encriptar_contrasena(nueva_contrasena)
-        cu.execute("UPDATE usuarios SET contrasena=%s WHERE id=%s", (ce, usuario_id))
-        c.commit()
-        cu.close()
-        c.close()
-        return JSONResponse(content={"exito": True, "mensaje": "Actualizada"})
-    except Exception as e: return JSONResponse(content={"exito": False, "mensaje": str(e)}, status_code=500)
+def cambiar_contrasena_usuario(usuario_id: int, nueva_contrasena: str = Form(...)):
+    r = db.cambiar_contrasena(usuario_id, nueva_contrasena)
+    if r["exito"]: sesiones.revocar_usuario(usuario_id)
+    return JSONResponse(content=r, status_code=200 if r["exito"] else 500)
 
 @app.get("/api/admin/historial-completo")
-async def obtener_historial_completo():
-    try:
-        c = db.obtener_conexion()
-        cu = c.cursor(cursor_factory=RealDictCursor)
-        cu.execute("SELECT * FROM historial_escaneos ORDER BY fecha_escaneo DESC")
-        es = cu.fetchall()
-        cu.close()
-        c.close()
-        return JSONResponse(content={"exito": True, "historial": [{"id": e["id"], "usuario_id": e["usuario_id"], "nombre_usuario": e["nombre_usuario"], "resultado": e["resultado"], "confianza": e["confianza"], "fecha_escaneo": e["fecha_escaneo"].isoformat()} for e in es]})
-    except Exception as e: return JSONResponse(content={"exito": False, "mensaje": str(e)}, status_code=500)
+def obtener_historial_completo(limite: Optional[int] = Query(None, ge=1, le=HISTORIAL_LIMITE_MAXIMO), cursor: Optional[str] = None, formato: str = "json"):
+    if formato == "ndjson": return respuesta_ndjson(db.iterar_historial())
+    if formato in EXPORTACIONES: return exportar_historial(formato)
+    return pagina_historial(None, limite, cursor)
+
+EXPORTACIONES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+@app.get("/api/admin/historial/exportar")
+def exportar_historial(formato: str = "csv", usuario_id: Optional[int] = None, desde: Optional[date] = None, hasta: Optional[date] = None):
+    """
+    Descarga del historial en CSV (COPY en PostgreSQL) o Parquet, transmitida en memoria constante (solo admin)
+    desde, hasta: días incluidos
+    """
+    filtros = {"usuario_id": usuario_id, "desde": inicio_del_dia(desde),
+               "hasta": inicio_del_dia(hasta + timedelta(days=1) if hasta is not None else None)}
+    if formato == "csv":
+        cuerpo = db.exportar_historial_csv(**filtros)
+    elif formato == "parquet":
+        try: cuerpo = parquet_por_lotes(db.lotes_historial(**filtros, filas_por_lote=EXPORTACION_FILAS_POR_GRUPO))
+        except RuntimeError as e: raise HTTPException(status_code=501, detail=str(e))
+    else:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado: use {' o '.join(EXPORTACIONES)}")
+    return StreamingResponse(cuerpo, media_type=EXPORTACIONES[formato],
+                             headers={"Content-Disposition": f'attachment; filename="historial.{formato}"'})
+
+@app.post("/api/admin/historial/importar")
+def importar_historial(archivo: UploadFile = File(...)):
+    """Carga masiva de un CSV con el formato de la exportación; los escaneos se asignan por nombre de usuario (solo admin)"""
+    r = db.importar_historial_csv(archivo.file)
+    if r["exito"]: respuestas.invalidar()
+    return JSONResponse(content=r, status_code=200 if r["exito"] else 400)
+
+@app.get("/api/admin/pool")
+def metricas_pool():
+    """Métricas del pool de conexiones: en uso, esperando y tiempos de espera"""
+    return JSONResponse(content={"exito": True, "pool": db.metricas_pool()})
+
+@app.get("/api/admin/cache")
+def metricas_cache():
+    """Aciertos y fallos de la caché de análisis"""
+    return JSONResponse(content={"exito": True, "cache": cache.metricas()})
+
+@app.get("/api/admin/trabajos")
+def metricas_trabajos():
+    """Trabajadores activos y trabajos procesados por esta instancia"""
+    return JSONResponse(content={"exito": True, "trabajos": cola.metricas()})
+
+@app.get("/api/admin/admision")
+def metricas_admision():
+    """Análisis en curso, profundidad de la cola y rechazos por motivo"""
+    return JSONResponse(content={"exito": True, "admision": admision.metricas()})
+
+@app.get("/api/admin/almacen")
+def metricas_almacen():
+    """Imágenes guardadas, duplicadas evitadas y subidas rechazadas por tamaño"""
+    return JSONResponse(content={"exito": True, "almacen": almacen.metricas()})
+
+@app.get("/api/admin/casi-duplicados")
+def metricas_indice():
+    """Tamaño del índice perceptual y análisis reutilizados por ámbito"""
+    return JSONResponse(content={"exito": True, "indice": indice.metricas()})
+
+@app.get("/api/admin/respuestas")
+def metricas_respuestas():
+    """Aciertos de la caché de historial/estadísticas y respuestas 304"""
+    return JSONResponse(content={"exito": True, "respuestas": respuestas.metricas()})
+
+@app.get("/api/admin/escritura")
+def metricas_escritura():
+    """Escaneos pendientes, lotes guardados y uso del spool de la escritura diferida"""
+    return JSONResponse(content={"exito": True, "escritura": escritura.metricas() if escritura is not None else None})
+
+@app.get("/api/admin/sesiones")
+def metricas_sesiones():
+    """Tokens emitidos, rechazados por motivo y tamaño de la lista de revocados"""
+    return JSONResponse(content={"exito": True, "sesiones": sesiones.metricas()})
+
+@app.get("/api/admin/trabajadores")
+def metricas_trabajadores():
+    """Proceso que atendió la petición y trabajadores que publican métricas (las demás rutas de /api/admin son por proceso)"""
+    return JSONResponse(content={"exito": True, "trabajadores": compartidas.metricas() if compartidas is not None else {"pid": os.getpid(), "trabajadores": [os.getpid()]}})
+
+@app.get("/api/admin/inferencia")
+def metricas_clasificador():
+    """Estado del interruptor, reintentos y fallos del backend de clasificación"""
+    return JSONResponse(content={"exito": True, "inferencia": clasificador.metricas()})
 
 @app.delete("/api/admin/historial/limpiar-todo")
-async def limpiar_historial_completo():
+def limpiar_historial_completo():
     """Elimina TODOS los registros del historial (solo admin)"""
-    try:
-        c = db.obtener_conexion()
-        cu = c.cursor()
-        cu.execute("DELETE FROM historial_escaneos")
-        filas_eliminadas = cu.rowcount
-        c.commit()
-        cu.close()
-        c.close()
-        return JSONResponse(
-            content={"exito": True, "mensaje": f"Se eliminaron {filas_eliminadas} registros"},
-            status_code=200
-        )
-    except Exception as e:
-        return JSONResponse(
-            content={"exito": False, "mensaje": str(e)},
-            status_code=500
-        )
+    r = db.eliminar_historial_completo()
+    respuestas.invalidar()
+    return JSONResponse(
+        content={"exito": r["exito"], "mensaje": r["mensaje"]},
+        status_code=200 if r["exito"] else 500
+    )
+
+@app.delete("/api/admin/historial/purgar")
+def purgar_historial(antes_de: Optional[date] = None, usuario_id: Optional[int] = None):
+    """Elimina los registros anteriores al día `antes_de` y/o de un usuario, por lotes (solo admin)"""
+    if antes_de is None and usuario_id is None:
+        raise HTTPException(status_code=400, detail="Indique antes_de o usuario_id; para vaciar todo use limpiar-todo")
+    r = db.purgar_historial(antes_de=inicio_del_dia(antes_de), usuario_id=usuario_id)
+    respuestas.invalidar([usuario_id] if usuario_id is not None else None)
+    return JSONResponse(content=r, status_code=200 if r["exito"] else 500)
 
 @app.delete("/api/admin/historial/{escaneo_id}")
-async def eliminar_registro_historial(escaneo_id: int):
+def eliminar_registro_historial(escaneo_id: int):
     """Elimina un registro específico del historial (solo admin)"""
-    try:
-        c = db.obtener_conexion()
-        cu = c.cursor()
-        cu.execute("DELETE FROM historial_escaneos WHERE id=%s", (escaneo_id,))
-        c.commit()
-        cu.close()
-        c.close()
-        return JSONResponse(content={"exito": True, "mensaje": "Registro eliminado"})
-    except Exception as e: 
-        return JSONResponse(content={"exito": False, "mensaje": str(e)}, status_code=500)
+    r = db.eliminar_escaneo(escaneo_id)
+    respuestas.invalidar()  # no se sabe de qué usuario era; la versión en la base ya cambió de todos modos
+    return JSONResponse(content={"exito": r["exito"], "mensaje": r["mensaje"]}, status_code=200 if r["exito"] else 500)
 
 if __name__ == "__main__":
+    from servidor import servir
     print("🌺 Mayaflora API - PostgreSQL")
     print(f"🔗 DATABASE_URL configurada: {'✅' if DATABASE_URL else '❌'}")
-    uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
+    servir(trabajadores=1, app=app)
\ No newline at end of file
@@ -0,0 +1,275 @@
+# Instrumentación siempre activa: histogramas de latencia, contadores y exportación en formato Prometheus
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from configuracion import SERVIDOR_METRICAS_INTERVALO
+
+# Límites superiores de los buckets en segundos (de 1 ms a 30 s)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Etapas medidas durante la petición en curso, para la cabecera Server-Timing
+_etapas_peticion = contextvars.ContextVar("etapas_peticion", default=None)
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self._series = {}  # valores de etiquetas -> [conteos por bucket (+Inf al final), suma]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *etiquetas):
+        indice = bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(etiquetas)
+            if serie is None:
+                serie = self._series[etiquetas] = [[0] * (len(self.buckets) + 1), 0.0]
+            serie[0][indice] += 1
+            serie[1] += valor
+
+    def instantanea(self):
+        with self._lock:
+            return {etiquetas: [list(conteos), suma] for etiquetas, (conteos, suma) in self._series.items()}
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, *etiquetas, cantidad=1):
+        with self._lock:
+            self._series[etiquetas] = self._series.get(etiquetas, 0) + cantidad
+
+    def instantanea(self):
+        with self._lock:
+            return dict(self._series)
+
+class RegistroMetricas:
+    def __init__(self):
+        self._metricas = []
+        self._calibres = []  # (nombre, ayuda, funcion que retorna el valor actual)
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS):
+        h = Histograma(nombre, ayuda, etiquetas, buckets)
+        self._metricas.append(h)
+        return h
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        c = Contador(nombre, ayuda, etiquetas)
+        self._metricas.append(c)
+        return c
+
+    def calibre(self, nombre, ayuda, funcion):
+        """Valor instantáneo que se consulta al exportar (p. ej. conexiones en uso)"""
+        self._calibres.append((nombre, ayuda, funcion))
+
+    def instantanea(self):
+        """Estado de todas las métricas serializable a JSON, para sumar las de varios procesos"""
+        metricas = []
+        for m in self._metricas:
+            histograma = isinstance(m, Histograma)
+            metricas.append({"nombre": m.nombre, "ayuda": m.ayuda, "tipo": "histogram" if histograma else "counter",
+                             "etiquetas": list(m.etiquetas), "buckets": list(m.buckets) if histograma else [],
+                             "series": [[list(etiquetas), valor] for etiquetas, valor in m.instantanea().items()]})
+        calibres = []
+        for nombre, ayuda, funcion in self._calibres:
+            try: calibres.append([nombre, ayuda, float(funcion())])
+            except Exception: continue
+        return {"metricas": metricas, "calibres": calibres}
+
+    def exportar(self, otras=()):
+        """Texto en formato de exposición de Prometheus (versión 0.0.4); otras: instantáneas de otros procesos a sumar"""
+        return formatear(combinar([self.instantanea(), *otras]))
+
+def combinar(instantaneas):
+    """Suma instantáneas: conteos de cada bucket, sumas y contadores por serie, y calibres por nombre"""
+    metricas, calibres = {}, {}
+    for instantanea in instantaneas:
+        for m in instantanea["metricas"]:
+            destino = metricas.setdefault(m["nombre"], {**m, "series": {}})
+            for etiquetas, valor in m["series"]:
+                clave = tuple(etiquetas)
+                previo = destino["series"].get(clave)
+                if previo is None:
+                    destino["series"][clave] = [list(valor[0]), valor[1]] if m["tipo"] == "histogram" else valor
+                elif m["tipo"] == "histogram":
+                    previo[0] = [a + b for a, b in zip(previo[0], valor[0])]
+                    previo[1] += valor[1]
+                else:
+                    destino["series"][clave] = previo + valor
+        for nombre, ayuda, valor in instantanea["calibres"]:
+            calibres[nombre] = [ayuda, calibres.get(nombre, [ayuda, 0.0])[1] + valor]
+    return {"metricas": list(metricas.values()), "calibres": [[n, a, v] for n, (a, v) in calibres.items()]}
+
+def formatear(instantanea):
+    """Texto de Prometheus a partir de una instantánea combinada"""
+    lineas = []
+    for m in instantanea["metricas"]:
+        nombres = tuple(m["etiquetas"])
+        lineas += [f"# HELP {m['nombre']} {m['ayuda']}", f"# TYPE {m['nombre']} {m['tipo']}"]
+        for etiquetas, valor in sorted(m["series"].items()):
+            if m["tipo"] == "histogram":
+                conteos, suma = valor
+                base = _etiquetas(nombres, etiquetas)
+                acumulado = 0
+                for limite, conteo in zip(tuple(m["buckets"]) + ("+Inf",), conteos):
+                    acumulado += conteo
+                    lineas.append(f"{m['nombre']}_bucket{_etiquetas(nombres + ('le',), etiquetas + (limite,))} {acumulado}")
+                lineas.append(f"{m['nombre']}_sum{base} {suma:.6f}")
+                lineas.append(f"{m['nombre']}_count{base} {acumulado}")
+            else:
+                lineas.append(f"{m['nombre']}{_etiquetas(nombres, etiquetas)} {valor}")
+    for nombre, ayuda, valor in instantanea["calibres"]:
+        lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} gauge", f"{nombre} {valor:g}"]
+    return "\n".join(lineas) + "\n"
+
+def _etiquetas(nombres, valores):
+    if not nombres: return ""
+    pares = (f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for n, v in zip(nombres, valores))
+    return "{" + ",".join(pares) + "}"
+
+registro = RegistroMetricas()
+
+peticiones_http = registro.histograma("mayaflora_http_peticion_segundos", "Duración de las peticiones HTTP por ruta", ("metodo", "ruta", "estado"))
+etapas_analisis = registro.histograma("mayaflora_etapa_segundos", "Duración de cada etapa del análisis", ("etapa",))
+espera_conexion = registro.histograma("mayaflora_db_espera_conexion_segundos", "Espera para obtener una conexión del pool")
+consultas_db = registro.histograma("mayaflora_db_consulta_segundos", "Duración de las consultas SQL por tipo de sentencia", ("operacion",))
+intentos_inferencia = registro.histograma("mayaflora_inferencia_intento_segundos", "Duración de cada intento HTTP al servicio de inferencia", ("resultado",))
+
+def acumular_en_peticion(nombre, segundos):
+    """Suma tiempo a una entrada de Server-Timing de la petición en curso (si la hay)"""
+    etapas = _etapas_peticion.get()
+    if etapas is not None:
+        etapas[nombre] = etapas.get(nombre, 0.0) + segundos
+
+def registrar_etapa(nombre, segundos):
+    etapas_analisis.observar(segundos, nombre)
+    acumular_en_peticion(nombre, segundos)
+
+@contextmanager
+def medir_etapa(nombre):
+    """`with medir_etapa("inferencia"):` registra la duración del bloque (también con await dentro)"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_etapa(nombre, time.perf_counter() - inicio)
+
+def iniciar_peticion():
+    """Empieza a acumular etapas para la petición actual; retorna el dict que se llenará"""
+    etapas = {}
+    _etapas_peticion.set(etapas)
+    return etapas
+
+def server_timing(etapas, total=None):
+    partes = [f"{nombre};dur={segundos * 1000:.1f}" for nombre, segundos in etapas.items()]
+    if total is not None: partes.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(partes)
+
+class MiddlewareMetricas:
+    """
+    Middleware ASGI: latencia y código de estado por ruta, y cabecera Server-Timing con las etapas medidas
+    Las rutas se etiquetan con su plantilla (/api/historial/{usuario_id}) para no multiplicar las series.
+    """
+    def __init__(self, app):
+        self.app = app
+        self._rutas = None
+
+    def _plantilla(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None: return "sin_ruta"
+        if self._rutas is None:
+            self._rutas = {getattr(r, "endpoint", None): r.path for r in scope["app"].routes}
+        return self._rutas.get(endpoint, "sin_ruta")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        inicio = time.perf_counter()
+        etapas = iniciar_peticion()
+        estado = 500
+
+        async def enviar(mensaje):
+            nonlocal estado
+            if mensaje["type"] == "http.response.start":
+                estado = mensaje["status"]
+                if etapas:
+                    cabeceras = list(mensaje.get("headers", []))
+                    cabeceras.append((b"server-timing", server_timing(etapas, time.perf_counter() - inicio).encode()))
+                    mensaje = {**mensaje, "headers": cabeceras}
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            peticiones_http.observar(time.perf_counter() - inicio, scope["method"], self._plantilla(scope), str(estado))
+
+class MetricasCompartidas:
+    """
+    Métricas de todos los trabajadores de un servidor multiproceso
+    Cada proceso publica su instantánea en `carpeta` (un JSON por pid) cada `intervalo` segundos; /metrics
+    suma la propia, recién tomada, con las de los demás. Los archivos que dejan de renovarse (un trabajador
+    caído) se ignoran pasados tres intervalos; sus contadores desaparecen como en cualquier reinicio.
+    """
+    def __init__(self, carpeta, registro=registro, intervalo=SERVIDOR_METRICAS_INTERVALO):
+        self.carpeta = carpeta
+        self.registro = registro
+        self.intervalo = intervalo
+        self._archivo = os.path.join(carpeta, f"{os.getpid()}.json")
+        self._parar = threading.Event()
+        self._hilo = None
+        self._publicaciones = 0
+
+    def publicar(self):
+        """Escribe la instantánea de este proceso con un rename atómico: quien lee nunca ve un JSON a medias"""
+        temporal = f"{self._archivo}.tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "momento": time.time(), **self.registro.instantanea()}, f)
+        os.replace(temporal, self._archivo)
+        self._publicaciones += 1
+
+    def _otras(self):
+        """Instantáneas vigentes de los demás trabajadores"""
+        vigentes = []
+        limite = time.time() - 3 * self.intervalo
+        for ruta in glob.glob(os.path.join(glob.escape(self.carpeta), "*.json")):
+            if ruta == self._archivo: continue
+            try:
+                if os.path.getmtime(ruta) < limite: continue
+                with open(ruta, encoding="utf-8") as f: vigentes.append(json.load(f))
+            except (OSError, ValueError): continue  # el trabajador terminó mientras se leía
+        return vigentes
+
+    def exportar(self):
+        return self.registro.exportar(self._otras())
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            try: self.publicar()
+            except OSError as e: print(f"❌ No se pudieron publicar las métricas: {e}")
+
+    def iniciar(self):
+        self.publicar()
+        self._hilo = threading.Thread(target=self._bucle, name="metricas-compartidas", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        """Deja de publicar y retira el archivo de este proceso"""
+        self._parar.set()
+        if self._hilo is not None: self._hilo.join()
+        try: os.remove(self._archivo)
+        except FileNotFoundError: pass
+
+    def metricas(self):
+        otras = self._otras()
+        return {"pid": os.getpid(), "carpeta": self.carpeta, "publicaciones": self._publicaciones,
+                "trabajadores": sorted([os.getpid()] + [o["pid"] for o in otras])}
@@ -0,0 +1,178 @@
+# Preprocesamiento de imágenes y análisis de colores
+import io
+import numpy as np
+from PIL import Image
+from configuracion import TAMANO_MODELO, CALIDAD_JPEG_MODELO, TAMANO_ANALISIS_COLORES
+
+def _lado_corto_a(img, lado):
+    """Escala la imagen para que su lado corto mida `lado`, conservando la proporción"""
+    ancho, alto = img.size
+    escala = lado / min(ancho, alto)
+    if escala >= 1: return img
+    return img.resize((max(1, round(ancho * escala)), max(1, round(alto * escala))), Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+def preprocesar_imagen(imagen, tamano_modelo=TAMANO_MODELO, tamano_colores=TAMANO_ANALISIS_COLORES):
+    """
+    Decodifica la imagen una sola vez y produce lo que necesita cada etapa
+    imagen: bytes o ruta del archivo (desde disco PIL solo lee lo que necesita la decodificación)
+    Retorna {"jpeg_modelo": bytes, "pixeles": ndarray uint8 (alto, ancho, 3), "tamano_original": (ancho, alto),
+             "dhash": entero de 64 bits para detectar fotos casi idénticas}
+    Lanza una excepción si la imagen no es válida o está truncada.
+    """
+    img = Image.open(imagen if isinstance(imagen, str) else io.BytesIO(imagen))
+    tamano_original = img.size
+    ancho, alto = tamano_original
+    # Lo más pequeño que se puede decodificar sin perder detalle para ninguna etapa
+    lado_corto = max(tamano_modelo, round(tamano_colores * min(ancho, alto) / max(ancho, alto)))
+    escala = min(1.0, lado_corto / min(ancho, alto))
+    # JPEG: decodifica directamente a 1/2, 1/4 u 1/8 escalando en el dominio DCT
+    img.draft("RGB", (max(1, round(ancho * escala)), max(1, round(alto * escala))))
+    img = img.convert("RGB")  # decodificación completa: falla con imágenes corruptas o truncadas
+    factor = min(img.width, img.height) // lado_corto
+    if factor >= 2:
+        img = img.reduce(factor)
+
+    colores = img.copy()
+    # NEAREST submuestrea sin mezclar colores: conserva la proporción de píxeles de cada máscara
+    colores.thumbnail((tamano_colores, tamano_colores), Image.Resampling.NEAREST)
+    modelo = _lado_corto_a(img, tamano_modelo)
+    buf = io.BytesIO()
+    modelo.save(buf, format="JPEG", quality=CALIDAD_JPEG_MODELO)
+    return {"jpeg_modelo": buf.getvalue(), "pixeles": np.asarray(colores), "tamano_original": tamano_original, "dhash": dhash(modelo)}
+
+def verificar_imagen(ruta):
+    """Lanza una excepción si PIL no reconoce el archivo o su estructura está dañada; no decodifica los píxeles"""
+    with Image.open(ruta) as img: img.verify()
+
+def dhash(img, lado=8):
+    """
+    Hash de diferencias: gris a (lado+1) x lado y un bit por par de píxeles vecinos (¿el izquierdo es más claro?)
+    Fotos casi iguales (otro encuadre mínimo, otra compresión, otro brillo) quedan a pocos bits de distancia.
+    """
+    gris = np.asarray(img.convert("L").resize((lado + 1, lado), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (gris[:, :-1] > gris[:, 1:]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+# Luminancia BT.601 en punto fijo: (77*r + 150*g + 29*b) / 256 cabe en uint16
+PESO_R, PESO_G, PESO_B = 77, 150, 29
+UMBRAL_OSCURO = 60 << 8
+BLOQUE_PIXELES = 1 << 18  # píxeles por bloque: acota la memoria temporal a unos pocos MB
+
+def _mascaras_bloque(bloque, lum, tmp):
+    """Máscaras de píxeles oscuros, marrones y amarillos de un bloque de filas (solo enteros)"""
+    r, g, b = bloque[:,:,0], bloque[:,:,1], bloque[:,:,2]
+    np.multiply(r, PESO_R, out=lum, dtype=np.uint16)
+    np.multiply(g, PESO_G, out=tmp, dtype=np.uint16)
+    lum += tmp
+    np.multiply(b, PESO_B, out=tmp, dtype=np.uint16)
+    lum += tmp
+    osc = lum < UMBRAL_OSCURO
+    # Rangos abiertos con resta en uint8: (r - 81) < 69  <=>  80 < r < 150
+    mar = ((r - np.uint8(81)) < 69) & ((g - np.uint8(51)) < 69) & (b < 80)
+    ama = (r > 180) & (g > 180) & (b < 120)
+    return osc, mar, ama
+
+def _contar_bloque(bloque, lum, tmp):
+    """Cuenta píxeles oscuros, marrones y amarillos de un bloque de filas"""
+    return tuple(np.count_nonzero(m) for m in _mascaras_bloque(bloque, lum, tmp))
+
+def _puntuar(osc, mar, ama):
+    """Score de manchas a partir de los porcentajes; acepta escalares o arrays (una puntuación por zona)"""
+    return 35 * (osc > 10) + 40 * (mar > 3) + 25 * (ama > 2)
+
+def analizar_colores_hongos(img_array, paso=1):
+    """
+    Porcentaje de píxeles oscuros, marrones y amarillos de un array RGB uint8
+    paso: submuestreo (1 = todos los píxeles, 2 = uno de cada 2x2, ...)
+    """
+    try:
+        if paso > 1: img_array = img_array[::paso, ::paso]
+        alto, ancho = img_array.shape[:2]
+        total = alto * ancho
+        filas = max(1, BLOQUE_PIXELES // max(1, ancho))
+        lum = np.empty((min(filas, alto), ancho), dtype=np.uint16)
+        tmp = np.empty_like(lum)
+        osc = mar = ama = 0
+        for inicio in range(0, alto, filas):
+            bloque = img_array[inicio:inicio + filas]
+            n = bloque.shape[0]
+            o, m, a = _contar_bloque(bloque, lum[:n], tmp[:n])
+            osc += o; mar += m; ama += a
+        osc, mar, ama = osc / total * 100, mar / total * 100, ama / total * 100
+        return {"score": int(_puntuar(osc, mar, ama)), "detalles": {"oscuras": osc, "marrones": mar, "amarillas": ama}}
+    except: return {"score": 0, "detalles": {}}
+
+MASCARAS = ("oscuras", "marrones", "amarillas")
+REJILLA_ZONAS = 8  # zonas por lado si no se indica otra (main usa COLORES_ZONAS_REJILLA)
+
+class TablasIntegrales:
+    """
+    Tablas de áreas sumadas de las máscaras oscura, marrón y amarilla de un array RGB uint8
+    Se construyen en una pasada por bloques de filas; después el conteo de cualquier rectángulo cuesta
+    cuatro lecturas por máscara, sin importar su tamaño.
+    """
+
+    def __init__(self, img_array, paso=1):
+        if paso > 1: img_array = img_array[::paso, ::paso]
+        self.alto, self.ancho = img_array.shape[:2]
+        # tabla[k, y, x] = píxeles de la máscara k en img_array[:y, :x]; fila y columna 0 a cero
+        self.tabla = np.zeros((len(MASCARAS), self.alto + 1, self.ancho + 1), dtype=np.int32)
+        filas = max(1, BLOQUE_PIXELES // max(1, self.ancho))
+        lum = np.empty((min(filas, self.alto), self.ancho), dtype=np.uint16)
+        tmp = np.empty_like(lum)
+        for inicio in range(0, self.alto, filas):
+            bloque = img_array[inicio:inicio + filas]
+            n = bloque.shape[0]
+            for k, mascara in enumerate(_mascaras_bloque(bloque, lum[:n], tmp[:n])):
+                destino = self.tabla[k, inicio + 1:inicio + n + 1, 1:]
+                np.cumsum(mascara, axis=1, dtype=np.int32, out=destino)
+                np.cumsum(destino, axis=0, out=destino)
+                destino += self.tabla[k, inicio, 1:]  # acumulado de los bloques anteriores
+
+    def contar(self, y0, x0, y1, x1):
+        """Píxeles de cada máscara en img_array[y0:y1, x0:x1], en O(1)"""
+        t = self.tabla
+        return t[:, y1, x1] - t[:, y0, x1] - t[:, y1, x0] + t[:, y0, x0]
+
+    def porcentajes(self, y0, x0, y1, x1):
+        """{"oscuras", "marrones", "amarillas"} en % del rectángulo"""
+        area = max(1, (y1 - y0) * (x1 - x0))
+        return dict(zip(MASCARAS, (self.contar(y0, x0, y1, x1) / area * 100).tolist()))
+
+    def ventanas(self, ys, xs, salto=1):
+        """
+        Conteos de todas las ventanas [ys[i], ys[i+salto]) x [xs[j], xs[j+salto]) con una sola lectura de esquinas
+        Retorna (conteos (3, len(ys)-salto, len(xs)-salto), áreas (len(ys)-salto, len(xs)-salto))
+        """
+        e = self.tabla[:, ys[:, None], xs[None, :]]
+        conteos = e[:, salto:, salto:] - e[:, :-salto, salto:] - e[:, salto:, :-salto] + e[:, :-salto, :-salto]
+        return conteos, (ys[salto:] - ys[:-salto])[:, None] * (xs[salto:] - xs[:-salto])[None, :]
+
+def analizar_colores_por_zonas(img_array, rejilla=REJILLA_ZONAS, paso=1):
+    """
+    analizar_colores_hongos más un mapa de manchas por zonas
+    Divide la imagen en una rejilla de rejilla x rejilla zonas (menos si es más pequeña) y retorna, además del
+    score global, "zonas": {"filas", "columnas", "mapa": score por zona, "densidades": % por máscara y zona,
+    "peor": la ventana del tamaño de una zona con más manchas, buscada a saltos de media zona para no partir
+    una mancha entre dos zonas, con "caja" [x0, y0, x1, y1] en fracciones del ancho y el alto}.
+    """
+    try:
+        tablas = TablasIntegrales(img_array, paso)
+        alto, ancho = tablas.alto, tablas.ancho
+        global_ = tablas.porcentajes(0, 0, alto, ancho)
+        filas, columnas = max(1, min(rejilla, alto)), max(1, min(rejilla, ancho))
+        # Bordes a media zona: las zonas de la rejilla son las ventanas que empiezan en los bordes pares
+        ys = np.linspace(0, alto, 2 * filas + 1).round().astype(np.intp)
+        xs = np.linspace(0, ancho, 2 * columnas + 1).round().astype(np.intp)
+        conteos, areas = tablas.ventanas(ys, xs, salto=2)
+        densidades = conteos / np.maximum(areas, 1) * 100
+        scores = _puntuar(*densidades)
+        zonas = densidades[:, ::2, ::2]
+        # La peor ventana: mayor score y, a igualdad, mayor densidad total de manchas
+        i, j = np.unravel_index(np.argmax(scores * 1000 + densidades.sum(axis=0)), scores.shape)
+        peor = {"caja": [round(xs[j] / ancho, 4), round(ys[i] / alto, 4), round(xs[j + 2] / ancho, 4), round(ys[i + 2] / alto, 4)],
+                "score": int(scores[i, j]), "detalles": dict(zip(MASCARAS, densidades[:, i, j].round(2).tolist()))}
+        return {"score": int(_puntuar(*global_.values())), "detalles": global_,
+                "zonas": {"filas": filas, "columnas": columnas, "mapa": scores[::2, ::2].tolist(),
+                          "densidades": dict(zip(MASCARAS, zonas.round(2).tolist())), "peor": peor}}
+    except: return {"score": 0, "detalles": {}}
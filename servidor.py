@@ -0,0 +1,108 @@
+# Arranque del servidor: un proceso, o un supervisor con SERVIDOR_TRABAJADORES trabajadores uvicorn
+# Uso: python servidor.py (o python main.py, solo con un proceso); SERVIDOR_TRABAJADORES=4 python servidor.py
+import glob
+import multiprocessing
+import os
+import secrets
+import shutil
+import signal
+import tempfile
+import threading
+from configuracion import (HOST, PORT, SERVIDOR_TRABAJADORES, SERVIDOR_ESPERA_CIERRE, SERVIDOR_METRICAS_DIR, SESION_SECRETO,
+                           HISTORIAL_MANTENIMIENTO_INTERVALO, CARPETA_IMAGENES)
+
+def preparar():
+    """
+    Lo que se hace una sola vez antes de lanzar los trabajadores, que lo reciben por variables de entorno:
+    esquema, usuario admin y particiones; carpeta de imágenes; secreto de sesión común (un token firmado
+    por un trabajador vale en todos) y carpeta donde cada trabajador publica sus métricas.
+    Retorna (base de datos del supervisor, carpeta temporal de métricas a borrar al terminar o None)
+    """
+    from base_datos import crear_base_datos
+    db = crear_base_datos(os.getenv("DATABASE_URL"))
+    os.makedirs(CARPETA_IMAGENES, exist_ok=True)
+    if not SESION_SECRETO:
+        os.environ["SESION_SECRETO"] = secrets.token_hex(32)
+        print("⚠️ SESION_SECRETO no está configurado: se generó uno temporal, común a los trabajadores, y las sesiones no sobreviven al reinicio")
+    temporal = None
+    carpeta = SERVIDOR_METRICAS_DIR
+    if not carpeta:
+        carpeta = temporal = tempfile.mkdtemp(prefix="mayaflora_metricas_")
+    os.makedirs(carpeta, exist_ok=True)
+    for viejo in glob.glob(os.path.join(glob.escape(carpeta), "*.json")): os.remove(viejo)  # de una ejecución anterior
+    os.environ["SERVIDOR_METRICAS_DIR"] = carpeta
+    os.environ["SERVIDOR_ARRANQUE_HECHO"] = "1"
+    return db, temporal
+
+def mantener(db, parar, intervalo=HISTORIAL_MANTENIMIENTO_INTERVALO):
+    """Particiones del mes siguiente y retención del historial desde el supervisor, no una vez por trabajador"""
+    while True:
+        r = db.mantener_historial()
+        if not r["exito"]: print(f"❌ {r['mensaje']}")
+        if parar.wait(intervalo): return
+
+def _trabajador(config, sockets):
+    """Proceso hijo: importa main:app una sola vez (al cargar config) y atiende en los sockets del supervisor"""
+    import uvicorn
+    config.configure_logging()
+    uvicorn.Server(config).run(sockets=sockets)
+
+class Supervisor:
+    """
+    Lanza config.workers trabajadores con spawn, relanza los que mueren y, al apagar, los detiene todos a la vez
+    Con multiprocessing directamente: el supervisor de uvicorn depende de su módulo privado _subprocess
+    """
+    def __init__(self, config, sockets):
+        self.config = config
+        self.sockets = sockets
+        self.procesos = []
+        self.parar = threading.Event()
+
+    def _lanzar(self):
+        proceso = multiprocessing.get_context("spawn").Process(target=_trabajador, args=(self.config, self.sockets))
+        proceso.start()
+        return proceso
+
+    def ejecutar(self):
+        for senal in (signal.SIGINT, signal.SIGTERM): signal.signal(senal, lambda *_: self.parar.set())
+        self.procesos = [self._lanzar() for _ in range(self.config.workers)]
+        while not self.parar.wait(1):
+            for i, proceso in enumerate(self.procesos):
+                if proceso.is_alive(): continue
+                print(f"⚠️ El trabajador {proceso.pid} terminó (código {proceso.exitcode}): se lanza otro")
+                self.procesos[i] = self._lanzar()
+        # SIGTERM a todos antes de esperar: cada uno deja de aceptar y termina lo que tiene en curso
+        # (hasta SERVIDOR_ESPERA_CIERRE) en paralelo, en vez de uno tras otro
+        for proceso in self.procesos: proceso.terminate()
+        for proceso in self.procesos: proceso.join()
+        print("👋 Trabajadores detenidos")
+
+def servir(trabajadores=SERVIDOR_TRABAJADORES, host=HOST, puerto=PORT, app=None):
+    """
+    Atiende peticiones hasta SIGINT/SIGTERM; al recibirla deja de aceptar conexiones y espera las peticiones
+    en curso hasta SERVIDOR_ESPERA_CIERRE segundos antes de cerrar colas, escritura diferida y pools
+    app: la aplicación ya importada, para un solo proceso (con varios, cada trabajador importa main:app)
+    Con varios trabajadores el proceso que llama no debe haber importado main: spawn vuelve a ejecutar su
+    módulo principal en cada hijo, así que main.py solo arranca un proceso y el supervisor es servidor.py
+    """
+    import uvicorn
+    if trabajadores <= 1:
+        uvicorn.run(app or "main:app", host=host, port=puerto, timeout_graceful_shutdown=SERVIDOR_ESPERA_CIERRE)
+        return
+    db, temporal = preparar()
+    parar = threading.Event()
+    hilo = threading.Thread(target=mantener, args=(db, parar), name="mantenimiento", daemon=True)
+    hilo.start()
+    try:
+        # Los trabajadores se crean con spawn: cada uno importa main y abre su propio pool y cliente HTTP
+        config = uvicorn.Config("main:app", host=host, port=puerto, workers=trabajadores, timeout_graceful_shutdown=SERVIDOR_ESPERA_CIERRE)
+        print(f"🌺 Mayaflora API: {trabajadores} trabajadores en {host}:{puerto}")
+        Supervisor(config, [config.bind_socket()]).ejecutar()
+    finally:
+        parar.set()
+        hilo.join()
+        db.cerrar()
+        if temporal: shutil.rmtree(temporal, ignore_errors=True)
+
+if __name__ == "__main__":
+    servir()
@@ -0,0 +1,73 @@
+# Servidor HTTP local que imita la API de inferencia de Hugging Face (pruebas y benchmarks)
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class ServidorHilos(ThreadingHTTPServer):
+    # La cola de listen por defecto (5) descarta conexiones en ráfagas y el cliente las reintenta al cabo de 1 s
+    request_queue_size = 128
+    daemon_threads = True
+
+class ServidorInferenciaFalso:
+    """
+    Responde a cada POST con predicciones fijas tras `retardo` segundos
+    estados: códigos HTTP a devolver en orden antes de pasar a 200 (p. ej. [503, 503] simula una tormenta de 503);
+    un par (código, cuerpo) responde con ese cuerpo, p. ej. (200, b"<html>") como la página de un proxy
+    """
+    def __init__(self, retardo=0.0, estados=None, predicciones=None):
+        self.retardo = retardo
+        self.estados = list(estados or [])
+        self.predicciones = predicciones or [{"label": "leaf", "score": 0.9}]
+        self.peticiones = 0
+        self._bloqueo = threading.Lock()
+        self._servidor = None
+
+    def _siguiente_estado(self):
+        with self._bloqueo:
+            self.peticiones += 1
+            return self.estados.pop(0) if self.estados else 200
+
+    def _manejador(self):
+        falso = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                estado, cuerpo = falso._siguiente_estado(), None
+                if isinstance(estado, tuple): estado, cuerpo = estado
+                time.sleep(falso.retardo)
+                if cuerpo is None:
+                    cuerpo = json.dumps(falso.predicciones if estado == 200 else {"error": "Model is currently loading"}).encode()
+                self.send_response(estado)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args): pass
+
+        return Manejador
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._servidor.server_port}/modelo"
+
+    def iniciar(self):
+        self._servidor = ServidorHilos(("127.0.0.1", 0), self._manejador())
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self):
+        if self._servidor is not None:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+            self._servidor = None
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *args):
+        self.detener()
@@ -0,0 +1,180 @@
+# Sesiones sin estado: tokens firmados con HMAC-SHA256 que se verifican en memoria, sin consultar la tabla usuarios
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from configuracion import SESION_SECRETO, SESION_DURACION, SESION_OBLIGATORIA, SESION_REFRESCO_REVOCADAS, ADMIN_USUARIO
+
+RUTAS_PUBLICAS = ("/api/registro", "/api/login")
+
+class TokenInvalidoError(Exception):
+    """Token mal formado, con firma incorrecta, expirado o revocado"""
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode()
+
+def _desde_b64(texto):
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+def rol_de(nombre_usuario):
+    """Solo el nombre exacto del admin creado al iniciar el esquema; sus variantes no se pueden registrar"""
+    return "admin" if nombre_usuario == ADMIN_USUARIO else "usuario"
+
+class Sesiones:
+    def __init__(self, db, secreto=SESION_SECRETO, duracion=SESION_DURACION, refresco=SESION_REFRESCO_REVOCADAS):
+        """
+        Emite y verifica tokens "<datos>.<firma>" con el usuario, su rol y la expiración
+        db: BaseDatos con la tabla sesiones_revocadas; solo se lee cada `refresco` segundos para la lista de revocados
+        """
+        if not secreto:
+            secreto = secrets.token_hex(32)
+            print("⚠️ SESION_SECRETO no está configurado: se generó uno temporal y las sesiones no sobreviven al reinicio")
+        self.db = db
+        self._clave = secreto.encode()
+        self.duracion = duracion
+        self.refresco = refresco
+        self._lock = threading.Lock()
+        self._tokens = {}    # jti revocado -> expiración (epoch)
+        self._usuarios = {}  # usuario_id -> (tokens emitidos hasta este instante quedan revocados, expiración)
+        self._tarea = None
+        self._emitidos = 0
+        self._rechazados = {"invalido": 0, "expirado": 0, "revocado": 0}
+
+    def _firma(self, cuerpo):
+        return _b64(hmac.new(self._clave, cuerpo.encode(), hashlib.sha256).digest())
+
+    def emitir(self, usuario_id, nombre_usuario):
+        """Retorna (token, datos); se llama tras verificar la contraseña"""
+        ahora = time.time()
+        datos = {"uid": usuario_id, "nombre": nombre_usuario, "rol": rol_de(nombre_usuario),
+                 "iat": ahora, "exp": int(ahora + self.duracion), "jti": secrets.token_urlsafe(12)}
+        cuerpo = _b64(json.dumps(datos, separators=(",", ":"), ensure_ascii=False).encode())
+        self._emitidos += 1
+        return f"{cuerpo}.{self._firma(cuerpo)}", datos
+
+    def verificar(self, token):
+        """Datos del token si la firma es válida, no expiró y no está revocado; si no, TokenInvalidoError"""
+        cuerpo, _, firma = token.partition(".")
+        if not hmac.compare_digest(firma.encode(), self._firma(cuerpo).encode()):
+            self._rechazados["invalido"] += 1
+            raise TokenInvalidoError("Token inválido")
+        datos = json.loads(_desde_b64(cuerpo))
+        if datos["exp"] < time.time():
+            self._rechazados["expirado"] += 1
+            raise TokenInvalidoError("Sesión expirada")
+        if self.revocado(datos):
+            self._rechazados["revocado"] += 1
+            raise TokenInvalidoError("Sesión revocada")
+        return datos
+
+    def revocado(self, datos):
+        if datos["jti"] in self._tokens: return True
+        usuario = self._usuarios.get(datos["uid"])
+        return usuario is not None and datos["iat"] <= usuario[0]
+
+    def revocar(self, datos):
+        """Cierra una sesión concreta (logout)"""
+        r = self.db.revocar_sesion(f"token:{datos['jti']}", datetime.fromtimestamp(datos["exp"]))
+        if r["exito"]:
+            with self._lock: self._tokens[datos["jti"]] = datos["exp"]
+        return r
+
+    def revocar_usuario(self, usuario_id):
+        """Invalida todos los tokens emitidos hasta ahora al usuario (cambio de contraseña o baja)"""
+        ahora = time.time()
+        expira = ahora + self.duracion  # después de esto ya no queda ningún token anterior vigente
+        r = self.db.revocar_sesion(f"usuario:{usuario_id}", datetime.fromtimestamp(expira), datetime.fromtimestamp(ahora))
+        if r["exito"]:
+            with self._lock: self._usuarios[usuario_id] = (ahora, expira)
+        return r
+
+    def recargar(self):
+        """Trae la lista de revocados (la de otras instancias incluida) y descarta lo que ya expiró"""
+        r = self.db.obtener_revocaciones()
+        if not r["exito"]:
+            print(f"❌ No se pudo leer la lista de sesiones revocadas: {r['mensaje']}")
+            return
+        ahora = time.time()
+        with self._lock:
+            tokens = {jti: exp for jti, exp in self._tokens.items() if exp > ahora}
+            usuarios = {uid: v for uid, v in self._usuarios.items() if v[1] > ahora}
+            for fila in r["revocaciones"]:
+                tipo, _, valor = fila["clave"].partition(":")
+                expira = fila["expira"].timestamp()
+                if tipo == "token":
+                    tokens[valor] = expira
+                elif tipo == "usuario":
+                    corte = max(fila["fecha_revocacion"].timestamp(), usuarios.get(int(valor), (0, 0))[0])
+                    usuarios[int(valor)] = (corte, expira)
+            self._tokens, self._usuarios = tokens, usuarios
+
+    def iniciar(self):
+        """Carga la lista de revocados y la refresca periódicamente en el event loop actual"""
+        self.recargar()
+        self._tarea = asyncio.create_task(self._refrescar())
+
+    async def detener(self):
+        if self._tarea is None: return
+        self._tarea.cancel()
+        try: await self._tarea
+        except asyncio.CancelledError: pass
+        self._tarea = None
+
+    async def _refrescar(self):
+        while True:
+            await asyncio.sleep(self.refresco)
+            try: await run_in_threadpool(self.recargar)
+            except Exception as e: print(f"❌ Error al refrescar sesiones revocadas: {e}")
+
+    def metricas(self):
+        return {"emitidos": self._emitidos, "rechazados": dict(self._rechazados),
+                "revocados": {"tokens": len(self._tokens), "usuarios": len(self._usuarios)}}
+
+def token_de(scope):
+    """Token de la cabecera `Authorization: Bearer <token>` o None"""
+    for nombre, valor in scope["headers"]:
+        if nombre == b"authorization":
+            tipo, _, token = valor.decode("latin-1").partition(" ")
+            return token.strip() if tipo.lower() == "bearer" else None
+    return None
+
+class MiddlewareSesiones:
+    """
+    Middleware ASGI: verifica el token Bearer y deja sus datos en request.state.sesion (None si no hay token)
+    Las rutas /api/admin exigen rol admin; con SESION_OBLIGATORIA, el resto de /api (salvo registro y login) exige token.
+    En registro y login el token no se mira: uno caducado o revocado no debe impedir volver a entrar.
+    """
+    def __init__(self, app, sesiones, obligatoria=SESION_OBLIGATORIA):
+        self.app = app
+        self.sesiones = sesiones
+        self.obligatoria = obligatoria
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+        ruta = scope["path"]
+        token = token_de(scope) if ruta not in RUTAS_PUBLICAS else None
+        sesion = None
+        if token:
+            try: sesion = self.sesiones.verificar(token)
+            except TokenInvalidoError as e: return await self._rechazar(scope, receive, send, 401, str(e))
+            except (ValueError, KeyError, TypeError): return await self._rechazar(scope, receive, send, 401, "Token inválido")
+        if sesion is None and ruta.startswith("/api/") and ruta not in RUTAS_PUBLICAS:
+            if self.obligatoria or ruta.startswith("/api/admin"):
+                return await self._rechazar(scope, receive, send, 401, "Sesión requerida")
+        if ruta.startswith("/api/admin") and sesion["rol"] != "admin":
+            return await self._rechazar(scope, receive, send, 403, "Solo el administrador")
+        scope.setdefault("state", {})["sesion"] = sesion
+        await self.app(scope, receive, send)
+
+    async def _rechazar(self, scope, receive, send, estado, mensaje):
+        respuesta = JSONResponse(content={"exito": False, "mensaje": mensaje}, status_code=estado,
+                                 headers={"WWW-Authenticate": "Bearer"} if estado == 401 else None)
+        await respuesta(scope, receive, send)
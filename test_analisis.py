@@ -0,0 +1,70 @@
+# Cadena de análisis de main: veredicto con la peor zona, subidas que no son imágenes y fotos casi idénticas
+import asyncio
+import hashlib
+import importlib
+import io
+import os
+import random
+from types import SimpleNamespace
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+from clasificadores import ClasificadorFalso
+from indice_perceptual import IndicePerceptual
+
+VERDE, MARRON = (60, 140, 50), (120, 80, 40)
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    carpeta = tmp_path_factory.mktemp("main")
+    parche = pytest.MonkeyPatch()
+    parche.chdir(carpeta)
+    parche.setenv("DATABASE_URL", f"sqlite:///{carpeta / 'mayaflora.db'}")
+    modulo = importlib.import_module("main")
+    yield modulo
+    modulo.db.cerrar()
+    parche.undo()
+
+def hoja(color, ruta):
+    """
+    Hoja con franjas de distinto brillo, algunas en sombra (dHash informativo); el mismo dibujo en otro
+    color da el mismo hash. En verde solo cuentan las sombras (Sana); en marrón, sombras y marrón (Enferma)
+    """
+    rng = random.Random(3)
+    img = Image.new("RGB", (640, 480))
+    for x in range(0, 640, 40):
+        f = rng.choice((0.4, 0.8, 0.9, 1.0))
+        img.paste(tuple(round(c * f) for c in color), (x, 0, x + 40, 480))
+    img.save(ruta, format="PNG")
+    with open(ruta, "rb") as archivo: return str(ruta), hashlib.sha256(archivo.read()).hexdigest()
+
+def test_copia_marron_de_una_hoja_sana_no_sale_sana(main, tmp_path):
+    main.clasificador = ClasificadorFalso(predicciones=[{"label": "leaf", "score": 0.9}], latencia=0)
+    main.indice = IndicePerceptual(distancia_usuario=6, distancia_global=3, max_entradas=100, ttl=60)
+    verde, marron = hoja(VERDE, tmp_path / "verde.png"), hoja(MARRON, tmp_path / "marron.png")
+    sana, _ = asyncio.run(main.analizar_contenido(*verde, usuario_id=1))
+    copia, en_cache = asyncio.run(main.analizar_contenido(*marron, usuario_id=2))
+    assert sana["resultado"] == "Sana"
+    assert copia.get("casi_duplicado") and main.clasificador.llamadas == 1  # reutilizó las predicciones
+    assert copia["resultado"] == "Enferma"
+    assert main.cache.obtener(marron[1]) is None  # ni pasa a la caché por contenido
+
+def test_subida_que_no_es_imagen_responde_400_sin_quedar_en_disco(main):
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(main.guardar_subida(SimpleNamespace(file=io.BytesIO(b"no es una imagen" * 100))))
+    assert e.value.status_code == 400 and main.almacen.carpeta not in e.value.detail
+    assert [archivos for _, _, archivos in os.walk(main.almacen.carpeta) if archivos] == []
+    assert main.almacen.metricas()["rechazadas_invalidas"] == 1
+
+def test_score_combinado_con_la_peor_zona(main):
+    hoja = [{"label": "leaf", "score": 0.9}]
+    def veredicto(score, peor=None):
+        ac = {"score": score} if peor is None else {"score": score, "zonas": {"peor": {"score": peor}}}
+        an = main.interpretar_resultado(hoja, ac)
+        return an["resultado"], an["confianza"], an["detalle"]
+    assert main.COLORES_ZONAS_PESO == 0.6
+    assert veredicto(35) == ("Sana", 70, "Sin anomalías")  # sin zonas (COLORES_ZONAS_REJILLA=0), como siempre
+    assert veredicto(35, peor=40) == ("Sana", 70, "Sin anomalías")  # 0,6 x 40 = 24 no supera al global
+    assert veredicto(35, peor=75) == ("Enferma", 60, "Manchas localizadas")  # 0,6 x 75 = 45
+    assert veredicto(0, peor=100) == ("Enferma", 60, "Manchas localizadas")  # 60: no llega a "Manchas detectadas"
+    assert veredicto(75, peor=100) == ("Enferma", 85, "Score:75")
@@ -0,0 +1,306 @@
+# Pruebas de conformidad: la misma batería corre contra cada implementación de BaseDatos
+# SQLite siempre; PostgreSQL si TEST_DATABASE_URL apunta a una base desechable (se borra su esquema public)
+import io
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import pytest
+from base_datos import BaseDatosPostgres, decodificar_cursor
+from base_datos_sqlite import BaseDatosSQLite
+from configuracion import ADMIN_USUARIO, ADMIN_CONTRASENA
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+def postgres_limpia():
+    import psycopg2
+    with psycopg2.connect(TEST_DATABASE_URL) as conexion, conexion.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+    conexion.close()
+    return BaseDatosPostgres(TEST_DATABASE_URL)
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def db(request, tmp_path):
+    if request.param == "sqlite":
+        base = BaseDatosSQLite(str(tmp_path / "mayaflora.db"))
+    elif TEST_DATABASE_URL:
+        base = postgres_limpia()
+    else:
+        pytest.skip("TEST_DATABASE_URL no está definida")
+    yield base
+    base.cerrar()
+
+@pytest.fixture
+def usuario(db):
+    return db.crear_usuario("ana", "secreta")["usuario_id"]
+
+def test_inicializar_es_idempotente(db):
+    assert db.inicializar_base_datos() is False
+
+def test_admin_creado_al_inicializar(db):
+    assert db.verificar_usuario(ADMIN_USUARIO, ADMIN_CONTRASENA)["exito"]
+
+def test_migrar_desde_la_version_4_conserva_los_indices_del_historial():
+    if not TEST_DATABASE_URL: pytest.skip("TEST_DATABASE_URL no está definida")
+    import psycopg2
+    from base_datos import INDICES_HISTORIAL
+    with psycopg2.connect(TEST_DATABASE_URL) as conexion, conexion.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+        cursor.execute('''
+            CREATE TABLE usuarios (id SERIAL PRIMARY KEY, nombre_usuario VARCHAR(100) UNIQUE NOT NULL,
+                                   contrasena VARCHAR(255) NOT NULL, fecha_creacion TIMESTAMP NOT NULL);
+            CREATE TABLE historial_escaneos (id SERIAL PRIMARY KEY, usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+                                             nombre_usuario VARCHAR(100) NOT NULL, ruta_imagen TEXT, resultado VARCHAR(50) NOT NULL,
+                                             confianza REAL NOT NULL, fecha_escaneo TIMESTAMP NOT NULL);
+            CREATE INDEX idx_historial_usuario ON historial_escaneos(usuario_id);
+            CREATE INDEX idx_historial_fecha ON historial_escaneos(fecha_escaneo DESC);
+            CREATE INDEX idx_historial_usuario_fecha_id ON historial_escaneos(usuario_id, fecha_escaneo DESC, id DESC);
+            CREATE INDEX idx_historial_fecha_id ON historial_escaneos(fecha_escaneo DESC, id DESC);
+            CREATE TABLE esquema_version (id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id), version INTEGER NOT NULL,
+                                          fecha_actualizacion TIMESTAMP NOT NULL);
+            INSERT INTO esquema_version VALUES (TRUE, 4, now());
+            INSERT INTO usuarios (nombre_usuario, contrasena, fecha_creacion) VALUES ('ana', 'x', now());
+            INSERT INTO historial_escaneos (usuario_id, nombre_usuario, resultado, confianza, fecha_escaneo)
+            VALUES (1, 'ana', 'Sana', 90, '2024-02-03'), (1, 'ana', 'Enferma', 70, '2024-05-06');
+        ''')
+    conexion.close()
+    db = BaseDatosPostgres(TEST_DATABASE_URL)
+    try:
+        with db.conexion() as conexion, conexion.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'historial_escaneos'")
+            indices = {nombre for nombre, in cursor.fetchall()}
+            conexion.rollback()
+        assert set(INDICES_HISTORIAL) <= indices
+        assert [e["resultado"] for e in db.obtener_historial(1)["historial"]] == ["Enferma", "Sana"]
+    finally:
+        db.cerrar()
+
+def test_crear_y_verificar_usuario(db, usuario):
+    r = db.verificar_usuario("ana", "secreta")
+    assert r["exito"] and r["usuario"] == {"id": usuario, "nombre_usuario": "ana"}
+    assert not db.verificar_usuario("ana", "otra")["exito"]
+    assert db.crear_usuario("ana", "x") == {"exito": False, "mensaje": "El usuario ya existe"}
+
+def test_cambiar_contrasena(db, usuario):
+    assert db.cambiar_contrasena(usuario, "nueva")["exito"]
+    assert db.verificar_usuario("ana", "nueva")["exito"]
+    assert not db.verificar_usuario("ana", "secreta")["exito"]
+
+def test_guardar_escaneo_y_estadisticas(db, usuario):
+    assert db.guardar_escaneo(usuario, "ana", "a.jpg", "Enferma", 80.0)["escaneo_id"]
+    db.guardar_escaneo(usuario, "ana", "b.jpg", "Sana", 70.0)
+    assert db.obtener_estadisticas(usuario)["estadisticas"] == {
+        "total_escaneos": 2, "plantas_enfermas": 1, "plantas_sanas": 1, "confianza_promedio": 75.0}
+
+def test_estadisticas_de_usuario_sin_escaneos(db, usuario):
+    assert db.obtener_estadisticas(usuario)["estadisticas"]["total_escaneos"] == 0
+
+def test_guardar_lote_retorna_ids_en_orden(db, usuario):
+    registros = [(usuario, "ana", f"{i}.jpg", "Sana", 90.0) for i in range(5)]
+    ids = db.guardar_escaneos_lote(registros)["escaneo_ids"]
+    assert len(ids) == 5 and ids == sorted(ids)
+    assert db.obtener_estadisticas(usuario)["estadisticas"]["total_escaneos"] == 5
+
+def test_historial_pagina_por_cursor(db, usuario):
+    ids = db.guardar_escaneos_lote([(usuario, "ana", f"{i}.jpg", "Sana", 90.0) for i in range(7)])["escaneo_ids"]
+    vistos, cursor = [], None
+    while True:
+        r = db.obtener_historial(usuario, 3, decodificar_cursor(cursor) if cursor else None)
+        vistos += [e["id"] for e in r["historial"]]
+        cursor = r["siguiente_cursor"]
+        if cursor is None: break
+    assert vistos == sorted(ids, reverse=True)
+
+def test_historial_completo_y_por_usuario(db, usuario):
+    otro = db.crear_usuario("luis", "x")["usuario_id"]
+    db.guardar_escaneo(usuario, "ana", "a.jpg", "Sana", 90.0)
+    db.guardar_escaneo(otro, "luis", "b.jpg", "Enferma", 60.0)
+    propio = db.obtener_historial(usuario)["historial"]
+    assert [e["nombre_usuario"] for e in propio] == ["ana"] and "usuario_id" not in propio[0]
+    todos = db.obtener_historial(None)["historial"]
+    assert {e["usuario_id"] for e in todos} == {usuario, otro}
+    assert isinstance(datetime.fromisoformat(todos[0]["fecha_escaneo"]), datetime)
+
+def test_iterar_historial_coincide_con_obtener(db, usuario):
+    db.guardar_escaneos_lote([(usuario, "ana", f"{i}.jpg", "Sana", 90.0) for i in range(5)])
+    assert list(db.iterar_historial(usuario, filas_por_lote=2)) == db.obtener_historial(usuario)["historial"]
+
+def test_eliminar_escaneo_descuenta_estadisticas(db, usuario):
+    ids = db.guardar_escaneos_lote([(usuario, "ana", "a.jpg", "Enferma", 80.0), (usuario, "ana", "b.jpg", "Sana", 60.0)])["escaneo_ids"]
+    assert db.eliminar_escaneo(ids[0])["eliminados"] == 1
+    assert db.eliminar_escaneo(ids[0])["eliminados"] == 0
+    assert db.obtener_estadisticas(usuario)["estadisticas"] == {
+        "total_escaneos": 1, "plantas_enfermas": 0, "plantas_sanas": 1, "confianza_promedio": 60.0}
+
+def test_eliminar_historial_completo(db, usuario):
+    db.guardar_escaneos_lote([(usuario, "ana", f"{i}.jpg", "Sana", 90.0) for i in range(3)])
+    assert db.eliminar_historial_completo()["eliminados"] == 3
+    assert db.obtener_historial(usuario)["historial"] == []
+    assert db.obtener_estadisticas(usuario)["estadisticas"]["total_escaneos"] == 0
+
+def test_listar_y_eliminar_usuarios(db, usuario):
+    db.guardar_escaneo(usuario, "ana", "a.jpg", "Sana", 90.0)
+    usuarios = {u["nombre_usuario"]: u for u in db.listar_usuarios()["usuarios"]}
+    assert usuarios["ana"]["total_escaneos"] == 1 and usuarios[ADMIN_USUARIO]["total_escaneos"] == 0
+    assert db.eliminar_usuario(usuario)["exito"]
+    assert db.obtener_historial(None)["historial"] == []
+    admin = usuarios[ADMIN_USUARIO]["id"]
+    assert db.eliminar_usuario(admin) == {"exito": False, "mensaje": "No eliminar admin", "protegido": True}
+
+def test_estadisticas_por_periodo(db, usuario):
+    db.guardar_escaneos_lote([(usuario, "ana", "a.jpg", "Enferma", 80.0), (usuario, "ana", "b.jpg", "Sana", 60.0)])
+    hoy = datetime.now().date()
+    dia = db.obtener_estadisticas_periodo(usuario, "dia")["series"]
+    assert dia == [{"periodo": hoy.isoformat(), "total_escaneos": 2, "plantas_enfermas": 1, "plantas_sanas": 1, "confianza_promedio": 70.0}]
+    semana = db.obtener_estadisticas_periodo(usuario, "semana", datetime.now() - timedelta(days=1))["series"]
+    assert semana[0]["periodo"] == (hoy - timedelta(days=hoy.weekday())).isoformat()
+    assert db.obtener_estadisticas_periodo(usuario, "dia", datetime.now() + timedelta(days=1))["series"] == []
+
+def test_ciclo_de_vida_de_un_trabajo(db, usuario):
+    trabajo_id = db.crear_trabajo(usuario, "ana", "a.jpg")["trabajo_id"]
+    assert db.obtener_trabajo(trabajo_id)["trabajo"]["estado"] == "pendiente"
+    trabajo = db.tomar_trabajo()
+    assert str(trabajo["id"]) == trabajo_id and trabajo["intentos"] == 1
+    assert db.tomar_trabajo() is None
+    db.fallar_trabajo(trabajo_id, "fallo pasajero", definitivo=False)
+    assert db.tomar_trabajo()["intentos"] == 2
+    db.completar_trabajo(trabajo_id, {"resultado": "Sana", "confianza": 90.0})
+    t = db.obtener_trabajo(trabajo_id)["trabajo"]
+    assert t["estado"] == "completado" and t["resultado"] == {"resultado": "Sana", "confianza": 90.0}
+    assert not db.obtener_trabajo("00000000-0000-0000-0000-000000000000")["exito"]
+
+def test_liberar_y_reencolar_trabajos(db, usuario):
+    trabajo_id = db.crear_trabajo(usuario, "ana", "a.jpg")["trabajo_id"]
+    db.tomar_trabajo()
+    assert db.liberar_trabajo(trabajo_id) == 1
+    assert db.obtener_trabajo(trabajo_id)["trabajo"]["intentos"] == 0
+    db.tomar_trabajo()
+    assert db.reencolar_trabajos_huerfanos(3600) == 0
+    time.sleep(0.01)
+    assert db.reencolar_trabajos_huerfanos(0) == 1
+
+def test_tomar_trabajo_desde_varios_hilos_no_duplica(db, usuario):
+    for i in range(20): db.crear_trabajo(usuario, "ana", f"{i}.jpg")
+    tomados, lock = [], threading.Lock()
+
+    def consumir():
+        while (trabajo := db.tomar_trabajo()) is not None:
+            with lock: tomados.append(str(trabajo["id"]))
+
+    hilos = [threading.Thread(target=consumir) for _ in range(4)]
+    for h in hilos: h.start()
+    for h in hilos: h.join()
+    assert len(tomados) == 20 and len(set(tomados)) == 20
+
+def test_cache_de_analisis(db):
+    clave = "a" * 64
+    assert db.obtener_cache_analisis(clave, 60) is None
+    db.guardar_cache_analisis(clave, [{"label": "leaf", "score": 0.9}], {"score": 10})
+    assert db.obtener_cache_analisis(clave, 60) == {"predicciones": [{"label": "leaf", "score": 0.9}], "analisis_colores": {"score": 10}}
+    assert db.obtener_cache_analisis(clave, 0) is None
+    db.guardar_cache_analisis(clave, [], {"score": 0})
+    assert db.obtener_cache_analisis(clave, 60)["predicciones"] == []
+
+def test_revocaciones_de_sesion(db, usuario):
+    ahora = datetime.now()
+    assert db.revocar_sesion("token:abc", ahora + timedelta(hours=1))["exito"]
+    db.revocar_sesion(f"usuario:{usuario}", ahora + timedelta(hours=1), ahora - timedelta(minutes=5))
+    db.revocar_sesion("token:viejo", ahora - timedelta(seconds=1))
+    filas = {f["clave"]: f for f in db.obtener_revocaciones()["revocaciones"]}
+    assert set(filas) == {"token:abc", f"usuario:{usuario}"}
+    assert filas[f"usuario:{usuario}"]["fecha_revocacion"] == ahora - timedelta(minutes=5)
+    db.revocar_sesion(f"usuario:{usuario}", ahora + timedelta(hours=2), ahora)
+    filas = {f["clave"]: f for f in db.obtener_revocaciones()["revocaciones"]}
+    assert filas[f"usuario:{usuario}"]["fecha_revocacion"] == ahora
+
+def test_version_del_historial_cambia_con_cada_alta_o_baja(db, usuario):
+    versiones = [db.obtener_version_historial(usuario)["version"]]
+    ids = db.guardar_escaneos_lote([(usuario, "ana", "a.jpg", "Sana", 90.0), (usuario, "ana", "b.jpg", "Sana", 80.0)])["escaneo_ids"]
+    versiones.append(db.obtener_version_historial(usuario)["version"])
+    db.eliminar_escaneo(ids[0])
+    versiones.append(db.obtener_version_historial(usuario)["version"])
+    db.eliminar_historial_completo()
+    versiones.append(db.obtener_version_historial(usuario)["version"])
+    db.guardar_escaneo(usuario, "ana", "c.jpg", "Sana", 90.0)
+    versiones.append(db.obtener_version_historial(usuario)["version"])
+    assert versiones[0] == 0 and versiones == sorted(set(versiones))
+
+def test_purgar_historial_por_fecha_y_por_usuario_en_lotes(db, usuario):
+    otro = db.crear_usuario("luis", "clave")["usuario_id"]
+    hace_un_ano = datetime.now() - timedelta(days=365)
+    db.guardar_escaneos_lote([(usuario, "ana", f"{i}.jpg", "Enferma", 50.0, hace_un_ano + timedelta(days=i)) for i in range(5)]
+                             + [(otro, "luis", "l.jpg", "Sana", 90.0, hace_un_ano)])
+    db.guardar_escaneos_lote([(usuario, "ana", "hoy.jpg", "Sana", 80.0), (otro, "luis", "hoy.jpg", "Sana", 70.0)])
+    r = db.purgar_historial(antes_de=datetime.now() - timedelta(days=30), usuario_id=usuario, lote=2)
+    assert r["exito"] and r["eliminados"] == 5 and r["lotes"] == 3
+    assert db.obtener_estadisticas(usuario)["estadisticas"] == {
+        "total_escaneos": 1, "plantas_enfermas": 0, "plantas_sanas": 1, "confianza_promedio": 80.0}
+    assert db.purgar_historial(antes_de=datetime.now() - timedelta(days=30))["eliminados"] == 1
+    assert [e["nombre_usuario"] for e in db.obtener_historial(None)["historial"]] == ["luis", "ana"]
+    assert db.obtener_estadisticas(otro)["estadisticas"]["total_escaneos"] == 1
+
+def test_retencion_elimina_solo_lo_antiguo(db, usuario):
+    db.guardar_escaneos_lote([(usuario, "ana", "viejo.jpg", "Enferma", 60.0, datetime(2020, 1, 15)),
+                              (usuario, "ana", "nuevo.jpg", "Sana", 90.0)])
+    assert db.mantener_historial(retencion_meses=0)["eliminados"] == 0
+    r = db.mantener_historial(retencion_meses=12)
+    assert r["exito"] and r["eliminados"] == 1
+    assert [e["resultado"] for e in db.obtener_historial(usuario)["historial"]] == ["Sana"]
+    assert db.obtener_estadisticas(usuario)["estadisticas"]["total_escaneos"] == 1
+
+def test_eliminar_usuario_borra_su_historial(db, usuario):
+    db.guardar_escaneos_lote([(usuario, "ana", f"{i}.jpg", "Sana", 90.0) for i in range(3)])
+    assert db.eliminar_usuario(usuario)["eliminados"] == 1
+    assert db.obtener_historial(None)["historial"] == []
+
+def test_exportar_e_importar_csv_ida_y_vuelta(db, usuario):
+    otro = db.crear_usuario("luis", "clave")["usuario_id"]
+    db.guardar_escaneos_lote([(usuario, "ana", "a.jpg", "Enferma", 60.5, datetime(2025, 3, 2, 10, 30)),
+                              (otro, "luis", None, "Sana", 90.0, datetime(2025, 5, 1)),
+                              (usuario, "ana", "c,\"raro\".jpg", "Sana", 80.0, datetime(2025, 5, 9))])
+    csv_completo = b"".join(db.exportar_historial_csv())
+    assert csv_completo.splitlines()[0] == b"id,usuario_id,nombre_usuario,ruta_imagen,resultado,confianza,fecha_escaneo"
+    assert len(csv_completo.splitlines()) == 4
+    solo_ana = b"".join(db.exportar_historial_csv(usuario_id=usuario, desde=datetime(2025, 4, 1)))
+    assert len(solo_ana.splitlines()) == 2 and b"raro" in solo_ana
+
+    antes = db.obtener_historial(None)["historial"]
+    db.eliminar_historial_completo()
+    db.eliminar_usuario(otro)
+    r = db.importar_historial_csv(io.BytesIO(csv_completo))
+    assert r["exito"] and r["importados"] == 2 and r["omitidos"] == 1
+    despues = db.obtener_historial(None)["historial"]
+    assert [(e["resultado"], e["confianza"], e["fecha_escaneo"]) for e in despues] == \
+           [(e["resultado"], e["confianza"], e["fecha_escaneo"]) for e in antes if e["nombre_usuario"] == "ana"]
+    assert db.obtener_estadisticas(usuario)["estadisticas"]["total_escaneos"] == 2
+
+def test_importar_csv_invalido_no_guarda_nada(db, usuario):
+    assert not db.importar_historial_csv(io.BytesIO(b"usuario,resultado\nana,Sana\n"))["exito"]
+    malo = b"id,usuario_id,nombre_usuario,ruta_imagen,resultado,confianza,fecha_escaneo\n1,1,ana,a.jpg,Sana,90,2025-01-01\n2,1,ana,b.jpg,Sana,mucho,2025-01-02\n"
+    assert not db.importar_historial_csv(io.BytesIO(malo))["exito"]
+    assert db.obtener_historial(None)["historial"] == []
+
+def test_importar_crea_particiones_con_su_propia_conexion(db, usuario):
+    if not isinstance(db, BaseDatosPostgres): pytest.skip("Solo PostgreSQL particiona el historial")
+    from base_datos import PoolConexiones
+    db.pool.cerrar()
+    db.pool = PoolConexiones(db.connection_string, minimo=1, maximo=1, timeout=2)  # una sola conexión: sin pedir otra
+    csv = b"id,usuario_id,nombre_usuario,ruta_imagen,resultado,confianza,fecha_escaneo\n1,1,ana,a.jpg,Sana,90,2019-01-05\n"
+    r = db.importar_historial_csv(io.BytesIO(csv))
+    assert r["exito"] and r["importados"] == 1
+    db._particiones.clear()
+    malo = b"id,usuario_id,nombre_usuario,ruta_imagen,resultado,confianza,fecha_escaneo\n1,1,ana,a.jpg,Enferma,90,2018-06-05\n"
+    with db.conexion() as conexion, conexion.cursor() as cursor:
+        cursor.execute("ALTER TABLE estadisticas_usuario ADD CONSTRAINT sin_enfermas CHECK (plantas_enfermas = 0)")
+        conexion.commit()
+    assert not db.importar_historial_csv(io.BytesIO(malo))["exito"]
+    with db.conexion() as conexion, conexion.cursor() as cursor:
+        meses = [mes for _, mes in db._particiones_historial(cursor)]
+    assert datetime(2019, 1, 1) in meses and datetime(2018, 6, 1) not in meses  # la del import fallido se deshizo
+
+def test_exportacion_abandonada_libera_la_conexion(db, usuario):
+    db.guardar_escaneos_lote([(usuario, "ana", f"{i}.jpg", "Sana", 90.0) for i in range(5000)])
+    exportacion = db.exportar_historial_csv()
+    next(exportacion)
+    exportacion.close()
+    assert db.obtener_estadisticas(usuario)["estadisticas"]["total_escaneos"] == 5000
@@ -0,0 +1,93 @@
+# Control de admisión: rechazos 429/503 con Retry-After, y sin leer el cuerpo de la subida
+import asyncio
+import pytest
+from control_admision import ControlAdmision, AdmisionRechazadaError, MiddlewareAdmision
+
+async def ocupar(admision, usuario_id, liberar):
+    async with admision.admitir(usuario_id): await liberar.wait()
+
+def test_cola_llena_y_espera_agotada_responden_503():
+    async def escenario():
+        admision = ControlAdmision(max_concurrencia=1, max_cola=1, max_por_usuario=5, espera_maxima=0.1)
+        liberar = asyncio.Event()
+        activa = asyncio.create_task(ocupar(admision, 1, liberar))
+        await asyncio.sleep(0)
+        en_cola = asyncio.create_task(ocupar(admision, 2, liberar))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmisionRechazadaError) as llena:
+            async with admision.admitir(3): pass
+        with pytest.raises(AdmisionRechazadaError) as agotada: await en_cola
+        liberar.set()
+        await activa
+        return admision, llena.value, agotada.value
+    admision, llena, agotada = asyncio.run(escenario())
+    assert (llena.estado, agotada.estado) == (503, 503)
+    assert llena.reintentar_en >= 1 and agotada.reintentar_en >= 1
+    m = admision.metricas()
+    assert m["rechazadas"] == {"usuario": 0, "cola_llena": 1, "espera_agotada": 1}
+    assert (m["activos"], m["en_cola"], m["usuarios_activos"]) == (0, 0, 0)
+
+def test_limite_por_usuario_responde_429():
+    async def escenario():
+        admision = ControlAdmision(max_concurrencia=4, max_cola=4, max_por_usuario=1, espera_maxima=1)
+        liberar = asyncio.Event()
+        activa = asyncio.create_task(ocupar(admision, 7, liberar))
+        await asyncio.sleep(0)
+        try:
+            async with admision.admitir(7): pass
+        finally:
+            liberar.set()
+            await activa
+    with pytest.raises(AdmisionRechazadaError) as e: asyncio.run(escenario())
+    assert e.value.estado == 429
+
+def test_middleware_rechaza_sin_leer_el_cuerpo():
+    async def escenario():
+        admision = ControlAdmision(max_concurrencia=1, max_cola=0, max_por_usuario=5, espera_maxima=1)
+        liberar, leidos = asyncio.Event(), []
+
+        async def app(scope, receive, send):
+            await receive()
+            leidos.append(scope["path"])
+            await liberar.wait()
+
+        async def receive():
+            return {"type": "http.request", "body": b"imagen", "more_body": False}
+
+        enviados = []
+        async def send(mensaje): enviados.append(mensaje)
+
+        middleware = MiddlewareAdmision(app, admision)
+        scope = {"type": "http", "method": "POST", "path": "/api/analizar", "headers": [], "client": ("10.0.0.1", 5000)}
+        activa = asyncio.create_task(middleware(scope, receive, send))
+        await asyncio.sleep(0.01)
+        await middleware({**scope, "client": ("10.0.0.2", 5000)}, receive, send)
+        liberar.set()
+        await activa
+        return leidos, enviados
+    leidos, enviados = asyncio.run(escenario())
+    assert leidos == ["/api/analizar"]  # la petición rechazada nunca llegó a leer su cuerpo
+    inicio = enviados[0]
+    assert inicio["status"] == 503 and (b"retry-after", b"1") in inicio["headers"]
+
+def test_sin_token_solo_cuenta_la_cola_global():
+    async def escenario(por_direccion):
+        admision = ControlAdmision(max_concurrencia=4, max_cola=4, max_por_usuario=1, espera_maxima=1)
+        liberar, estados = asyncio.Event(), []
+
+        async def app(scope, receive, send):
+            estados.append(200)
+            await liberar.wait()
+
+        async def send(mensaje):
+            if mensaje["type"] == "http.response.start": estados.append(mensaje["status"])
+
+        middleware = MiddlewareAdmision(app, admision, por_direccion=por_direccion)
+        scope = {"type": "http", "method": "POST", "path": "/api/analizar", "headers": [], "client": ("10.0.0.1", 5000)}
+        tareas = [asyncio.create_task(middleware(dict(scope), None, send)) for _ in range(3)]  # tras el mismo NAT
+        await asyncio.sleep(0.01)
+        liberar.set()
+        await asyncio.gather(*tareas)
+        return sorted(estados), admision.metricas()["usuarios_activos"]
+    assert asyncio.run(escenario(False)) == ([200, 200, 200], 0)
+    assert asyncio.run(escenario(True)) == ([200, 429, 429], 0)
@@ -0,0 +1,108 @@
+# Escritura diferida del historial: lotes por tamaño y por tiempo, vaciado al detener y spool si la base falla
+import asyncio
+import glob
+import time
+import pytest
+from base_datos_sqlite import BaseDatosSQLite
+from escritura_diferida import EscrituraDiferida
+
+class BaseIntermitente(BaseDatosSQLite):
+    """SQLite que rechaza los lotes mientras `caida` es True"""
+    caida = False
+    lotes = 0
+
+    def guardar_escaneos_lote(self, registros):
+        if self.caida: return {"exito": False, "mensaje": "Error al guardar escaneos: base caída"}
+        self.lotes += 1
+        return super().guardar_escaneos_lote(registros)
+
+@pytest.fixture
+def db(tmp_path):
+    base = BaseIntermitente(str(tmp_path / "mayaflora.db"))
+    base.usuario = base.crear_usuario("ana", "x")["usuario_id"]
+    yield base
+    base.cerrar()
+
+@pytest.fixture
+def spool(tmp_path):
+    return str(tmp_path / "pendiente.jsonl")
+
+def total(db):
+    return db.obtener_estadisticas(db.usuario)["estadisticas"]["total_escaneos"]
+
+def agregar(escritura, db, n):
+    for i in range(n): escritura.agregar(db.usuario, "ana", f"{i}.jpg", "Sana", 90.0)
+
+def test_vacia_por_tamano_en_lotes_multifila(db, spool):
+    async def escenario():
+        escritura = EscrituraDiferida(db, max_lote=10, intervalo=60, spool=spool)
+        escritura.iniciar()
+        agregar(escritura, db, 25)
+        await asyncio.sleep(0.2)
+        guardados = total(db)
+        await escritura.detener()
+        return guardados
+    assert asyncio.run(escenario()) >= 20
+    assert total(db) == 25 and db.lotes == 3
+
+def test_vacia_por_tiempo_y_conserva_la_fecha_del_analisis(db, spool):
+    async def escenario():
+        escritura = EscrituraDiferida(db, max_lote=100, intervalo=0.05, spool=spool)
+        escritura.iniciar()
+        agregar(escritura, db, 3)
+        fecha = escritura._pendientes[0][5]
+        await asyncio.sleep(0.3)
+        try: return fecha, total(db)
+        finally: await escritura.detener()
+    fecha, guardados = asyncio.run(escenario())
+    assert guardados == 3
+    assert {e["fecha_escaneo"] for e in db.obtener_historial(db.usuario)["historial"]} >= {fecha.isoformat()}
+
+def test_base_caida_va_al_spool_y_se_recupera(db, spool):
+    async def escenario():
+        escritura = EscrituraDiferida(db, max_lote=4, intervalo=60, spool=spool)
+        db.caida = True
+        agregar(escritura, db, 6)
+        await escritura.vaciar()
+        assert total(db) == 0 and len(open(spool).readlines()) == 6
+        db.caida = False
+        agregar(escritura, db, 1)
+        await escritura.vaciar()
+        return escritura.metricas()
+    m = asyncio.run(escenario())
+    assert total(db) == 7 and glob.glob(spool + "*") == []
+    assert m["enviados_spool"] == 6 and m["recuperados_spool"] == 6
+
+def test_lo_agregado_mientras_se_escribe_el_spool_no_se_pierde(db, spool):
+    class EscrituraConcurrente(EscrituraDiferida):
+        def _al_spool(self, registros):
+            self.loop.call_soon_threadsafe(agregar, self, db, 1)  # una petición que llega durante la escritura
+            time.sleep(0.05)
+            super()._al_spool(registros)
+
+    async def escenario():
+        escritura = EscrituraConcurrente(db, max_lote=4, intervalo=60, spool=spool)
+        escritura.loop = asyncio.get_running_loop()
+        db.caida = True
+        agregar(escritura, db, 6)
+        await escritura.vaciar()
+        pendientes = len(escritura._pendientes)
+        db.caida = False
+        await escritura.vaciar()
+        return pendientes
+    assert asyncio.run(escenario()) == 1
+    assert total(db) == 7
+
+def test_detener_sin_base_deja_todo_en_el_spool(db, spool):
+    async def escenario():
+        escritura = EscrituraDiferida(db, max_lote=100, intervalo=60, spool=spool)
+        escritura.iniciar()
+        agregar(escritura, db, 5)
+        db.caida = True
+        await escritura.detener()
+    asyncio.run(escenario())
+    assert len(open(spool).readlines()) == 5
+    # Otra instancia (un reinicio) recoge el spool en su primer vaciado
+    db.caida = False
+    asyncio.run(EscrituraDiferida(db, spool=spool).vaciar())
+    assert total(db) == 5
@@ -0,0 +1,28 @@
+# Pruebas de la exportación Parquet (se omiten si pyarrow no está instalado)
+import io
+from datetime import datetime
+import pytest
+from base_datos import COLUMNAS_HISTORIAL
+from base_datos_sqlite import BaseDatosSQLite
+from exportacion import parquet_por_lotes
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+@pytest.fixture
+def db(tmp_path):
+    base = BaseDatosSQLite(str(tmp_path / "mayaflora.db"))
+    yield base
+    base.cerrar()
+
+def test_parquet_con_un_grupo_de_filas_por_lote(db):
+    usuario = db.crear_usuario("ana", "secreta")["usuario_id"]
+    db.guardar_escaneos_lote([(usuario, "ana", None if i % 2 else f"{i}.jpg", "Sana", 90.0, datetime(2025, 1, 1, 0, i)) for i in range(25)])
+    archivo = pq.ParquetFile(io.BytesIO(b"".join(parquet_por_lotes(db.lotes_historial(filas_por_lote=10)))))
+    assert archivo.metadata.num_rows == 25 and archivo.metadata.num_row_groups == 3
+    tabla = archivo.read()
+    assert tuple(tabla.column_names) == COLUMNAS_HISTORIAL
+    assert tabla.column("fecha_escaneo")[24].as_py() == datetime(2025, 1, 1, 0, 24)
+    assert tabla.column("ruta_imagen")[1].as_py() is None
+
+def test_parquet_vacio_es_valido(db):
+    assert pq.ParquetFile(io.BytesIO(b"".join(parquet_por_lotes(db.lotes_historial())))).metadata.num_rows == 0
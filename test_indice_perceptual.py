@@ -0,0 +1,73 @@
+# Índice perceptual: ámbitos usuario/global, coincidencia con búsqueda exhaustiva y expulsión
+import io
+import random
+import time
+from PIL import Image, ImageEnhance
+from indice_perceptual import IndicePerceptual
+from procesamiento_imagen import preprocesar_imagen
+
+def voltear(h, *bits):
+    for b in bits: h ^= 1 << b
+    return h
+
+def jpeg_de(img, calidad=88):
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=calidad)
+    return buf.getvalue()
+
+def test_prefiere_el_mismo_usuario_y_es_mas_estricto_entre_usuarios():
+    indice = IndicePerceptual(distancia_usuario=6, distancia_global=2, max_entradas=100, ttl=60)
+    h = 0x0123456789ABCDEF
+    indice.agregar(h, 1, "de ana")
+    indice.agregar(voltear(h, 0), 2, "de luis")
+    assert indice.buscar(voltear(h, 3, 20, 40), 1) == ("de ana", 3, "usuario")
+    assert indice.buscar(voltear(h, 3, 20, 40), 3) is None
+    assert indice.buscar(voltear(h, 0, 30), 3) == ("de luis", 1, "global")
+    assert indice.buscar(voltear(h, 1, 2, 3, 4, 5, 6, 7), 1) is None
+
+def test_encuentra_lo_mismo_que_una_busqueda_exhaustiva():
+    rng = random.Random(0)
+    indice = IndicePerceptual(distancia_usuario=-1, distancia_global=7, max_entradas=5000, ttl=60)
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    for i, h in enumerate(hashes): indice.agregar(h, 0, i)
+    for _ in range(300):
+        consulta = voltear(rng.choice(hashes), *rng.sample(range(64), rng.randint(0, 9)))
+        mejor = min(range(len(hashes)), key=lambda i: ((consulta ^ hashes[i]).bit_count(), i))
+        distancia = (consulta ^ hashes[mejor]).bit_count()
+        r = indice.buscar(consulta, 0)
+        if distancia > 7: assert r is None
+        else: assert r is not None and r[1] == distancia
+
+def test_expulsa_las_menos_usadas_y_las_vencidas():
+    indice = IndicePerceptual(distancia_usuario=4, distancia_global=-1, max_entradas=3, ttl=0.2, min_bits=0)
+    for i, h in enumerate([0, 1 << 63 | 0xFFFF, 0xFFFF << 20]): indice.agregar(h, 1, i)
+    assert indice.buscar(0, 1)[0] == 0  # la primera pasa a ser la más reciente
+    indice.agregar(0xFFFFFFFF << 32, 1, 3)
+    assert indice.buscar(1 << 63 | 0xFFFF, 1) is None
+    assert indice.metricas()["entradas"] == 3
+    time.sleep(0.25)
+    assert indice.buscar(0, 1) is None and indice.metricas()["entradas"] == 0
+
+def test_fotos_lisas_no_se_comparan():
+    indice = IndicePerceptual(distancia_usuario=6, distancia_global=3, max_entradas=100, ttl=60, min_bits=8)
+    lisa = preprocesar_imagen(jpeg_de(Image.new("RGB", (640, 480), (120, 80, 40))))["dhash"]
+    assert lisa.bit_count() < 8
+    indice.agregar(lisa, 1, "lisa")
+    indice.agregar(voltear(0, 3), 1, "casi cero")
+    assert indice.metricas()["entradas"] == 0
+    assert indice.buscar(lisa, 1) is None and indice.buscar((1 << 64) - 1, 1) is None
+
+def test_dhash_acerca_rafagas_y_separa_hojas_distintas():
+    def jpeg(img, calidad=88): return preprocesar_imagen(jpeg_de(img, calidad))["dhash"]
+    rng = random.Random(1)
+    hojas = []
+    for _ in range(2):
+        img = Image.new("RGB", (800, 600), (60, 140, 50))
+        for _ in range(30):
+            x, y, r = rng.randrange(800), rng.randrange(600), rng.randint(10, 60)
+            img.paste((rng.randint(20, 200), rng.randint(20, 200), 30), (x, y, x + r, y + r))
+        hojas.append(img)
+    base = jpeg(hojas[0])
+    assert (base ^ jpeg(hojas[0], calidad=60)).bit_count() <= 2
+    assert (base ^ jpeg(ImageEnhance.Brightness(hojas[0]).enhance(1.08))).bit_count() <= 4
+    assert (base ^ jpeg(hojas[1])).bit_count() > 12
@@ -0,0 +1,48 @@
+# Verifica que varias inferencias se atienden a la vez en un solo worker
+import asyncio
+import io
+import time
+from PIL import Image
+import cliente_inferencia
+from servidor_inferencia_falso import ServidorInferenciaFalso
+
+RETARDO = 0.3
+PETICIONES = 20
+
+def imagen_de_prueba():
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64), (40, 160, 40)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+def test_inferencias_concurrentes_no_bloquean_el_loop(monkeypatch):
+    servidor = ServidorInferenciaFalso(retardo=RETARDO).iniciar()
+    monkeypatch.setattr(cliente_inferencia, "HUGGINGFACE_API_URL", servidor.url)
+    imagen = imagen_de_prueba()
+
+    async def escenario():
+        # Importar httpx y crear el contexto TLS del cliente ocurre una vez por proceso: fuera de la medición
+        cliente_inferencia.obtener_cliente()
+        latidos = 0
+        async def latido():
+            nonlocal latidos
+            while True:
+                await asyncio.sleep(0.01)
+                latidos += 1
+        tarea = asyncio.create_task(latido())
+        inicio = time.monotonic()
+        resultados = await asyncio.gather(*[cliente_inferencia.analizar_con_huggingface(imagen) for _ in range(PETICIONES)])
+        duracion = time.monotonic() - inicio
+        tarea.cancel()
+        await cliente_inferencia.cerrar_cliente()
+        return resultados, duracion, latidos
+
+    try:
+        resultados, duracion, latidos = asyncio.run(escenario())
+    finally:
+        servidor.detener()
+
+    assert all(r["exito"] for r in resultados)
+    # En serie tardaría PETICIONES * RETARDO (6 s); en paralelo, poco más que un RETARDO
+    assert duracion < PETICIONES * RETARDO / 4
+    # El event loop siguió atendiendo otras tareas mientras tanto
+    assert latidos >= duracion / 0.01 / 2
@@ -0,0 +1,131 @@
+# Reintentos, plazo y circuit breaker del cliente de inferencia frente a un servidor falso
+import asyncio
+import time
+import pytest
+import cliente_inferencia
+from servidor_inferencia_falso import ServidorInferenciaFalso
+
+IMAGEN = b"\xff\xd8 jpeg de prueba \xff\xd9"
+
+@pytest.fixture
+def cliente(monkeypatch):
+    """Backoff corto e interruptor nuevo para cada prueba"""
+    monkeypatch.setattr(cliente_inferencia, "HF_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(cliente_inferencia, "HF_BACKOFF_MAXIMO", 0.05)
+    monkeypatch.setattr(cliente_inferencia, "HF_MAX_REINTENTOS", 3)
+    monkeypatch.setattr(cliente_inferencia, "interruptor", cliente_inferencia.Interruptor(umbral=5, espera=0.3))
+    monkeypatch.setattr(cliente_inferencia, "_contadores", dict.fromkeys(cliente_inferencia._contadores, 0))
+    return cliente_inferencia
+
+def usar(monkeypatch, servidor):
+    monkeypatch.setattr(cliente_inferencia, "HUGGINGFACE_API_URL", servidor.url)
+
+def analizar(*plazos):
+    """Ejecuta un análisis por plazo (None = plazo por defecto) y cierra el cliente en el mismo loop"""
+    async def escenario():
+        try: return [await cliente_inferencia.analizar_con_huggingface(IMAGEN, p) for p in plazos]
+        finally: await cliente_inferencia.cerrar_cliente()
+    return asyncio.run(escenario())
+
+def test_tormenta_de_503_se_supera_con_reintentos(cliente, monkeypatch):
+    with ServidorInferenciaFalso(estados=[503, 503, 503]) as servidor:
+        usar(monkeypatch, servidor)
+        r, = analizar(None)
+    assert r["exito"]
+    assert servidor.peticiones == 4
+    m = cliente.metricas_inferencia()
+    assert m["reintentos"] == 3 and m["exitosas"] == 1
+    assert m["interruptor"]["estado"] == "cerrado"
+
+def test_reintentos_agotados_devuelven_el_ultimo_error(cliente, monkeypatch):
+    with ServidorInferenciaFalso(estados=[503] * 10) as servidor:
+        usar(monkeypatch, servidor)
+        r, = analizar(None)
+    assert not r["exito"] and "503" in r["mensaje"]
+    assert servidor.peticiones == 4
+
+def test_error_del_cliente_no_se_reintenta(cliente, monkeypatch):
+    with ServidorInferenciaFalso(estados=[400]) as servidor:
+        usar(monkeypatch, servidor)
+        r, = analizar(None)
+    assert not r["exito"] and servidor.peticiones == 1
+    assert cliente.interruptor.estado == "cerrado"
+
+def test_200_que_no_es_json_es_un_fallo_y_se_reintenta(cliente, monkeypatch):
+    with ServidorInferenciaFalso(estados=[(200, b"<html>proxy</html>")]) as servidor:
+        usar(monkeypatch, servidor)
+        bien, = analizar(None)
+    assert bien["exito"] and servidor.peticiones == 2
+    with ServidorInferenciaFalso(estados=[(200, b"<html>proxy</html>")] * 10) as servidor:
+        usar(monkeypatch, servidor)
+        mal, = analizar(None)
+    assert not mal["exito"] and "no válida" in mal["mensaje"]
+    assert cliente.interruptor.metricas()["fallos_seguidos"] == 4
+
+def test_respuestas_lentas_respetan_el_plazo(cliente, monkeypatch):
+    with ServidorInferenciaFalso(retardo=1.0) as servidor:
+        usar(monkeypatch, servidor)
+        inicio = time.monotonic()
+        r, = analizar(time.monotonic() + 0.3)
+        duracion = time.monotonic() - inicio
+    assert not r["exito"]
+    assert duracion < 0.8
+    assert cliente.metricas_inferencia()["plazos_agotados"] == 1
+
+def test_interruptor_se_abre_y_corta_las_llamadas(cliente, monkeypatch):
+    with ServidorInferenciaFalso(estados=[503] * 5) as servidor:
+        usar(monkeypatch, servidor)
+        fallida, rechazada = analizar(None, None)
+        llamadas = servidor.peticiones
+    assert not fallida["exito"]
+    assert llamadas == 5
+    assert rechazada["interruptor_abierto"] and rechazada["reintentar_en"] > 0
+    assert cliente.interruptor.estado == "abierto"
+    assert cliente.metricas_inferencia()["rechazadas_interruptor"] == 1
+
+def test_interruptor_semiabierto_se_cierra_con_una_sonda_exitosa(cliente, monkeypatch):
+    with ServidorInferenciaFalso(estados=[503] * 5) as servidor:
+        usar(monkeypatch, servidor)
+        analizar(None, None)
+        time.sleep(0.35)
+        r, = analizar(None)
+    assert r["exito"]
+    assert cliente.interruptor.estado == "cerrado"
+    assert cliente.interruptor.aperturas == 1
+
+def test_sonda_fallida_reabre_el_interruptor(cliente, monkeypatch):
+    with ServidorInferenciaFalso(estados=[503] * 6) as servidor:
+        usar(monkeypatch, servidor)
+        analizar(None, None)
+        time.sleep(0.35)
+        r, = analizar(None)
+        assert servidor.peticiones == 6
+    assert r["interruptor_abierto"]
+    assert cliente.interruptor.aperturas == 2
+
+def abrir_y_esperar(cliente):
+    for _ in range(5): cliente.interruptor.registrar_fallo()
+    time.sleep(0.35)
+
+def test_plazo_agotado_no_retiene_la_sonda(cliente, monkeypatch):
+    with ServidorInferenciaFalso() as servidor:
+        usar(monkeypatch, servidor)
+        abrir_y_esperar(cliente)
+        vencida, r = analizar(time.monotonic() - 1, None)
+        assert servidor.peticiones == 1
+    assert not vencida["exito"] and not vencida.get("interruptor_abierto")
+    assert r["exito"] and cliente.interruptor.estado == "cerrado"
+
+def test_sonda_cancelada_deja_probar_a_la_siguiente(cliente, monkeypatch):
+    async def escenario():
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(cliente_inferencia.analizar_con_huggingface(IMAGEN), 0.1)
+            servidor.retardo = 0
+            return await cliente_inferencia.analizar_con_huggingface(IMAGEN)
+        finally: await cliente_inferencia.cerrar_cliente()
+    with ServidorInferenciaFalso(retardo=1.0) as servidor:
+        usar(monkeypatch, servidor)
+        abrir_y_esperar(cliente)
+        r = asyncio.run(escenario())
+    assert r["exito"] and cliente.interruptor.estado == "cerrado"
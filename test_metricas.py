@@ -0,0 +1,39 @@
+# Métricas de varios trabajadores: instantáneas combinadas y publicadas en una carpeta compartida
+import json
+import os
+import time
+from metricas import RegistroMetricas, MetricasCompartidas
+
+def registro_con(peticiones, conexiones):
+    registro = RegistroMetricas()
+    h = registro.histograma("prueba_segundos", "Duración", ("ruta",))
+    for segundos in peticiones: h.observar(segundos, "/")
+    registro.contador("prueba_total", "Contador", ("estado",)).incrementar("200", cantidad=len(peticiones))
+    registro.calibre("prueba_conexiones", "En uso", lambda: conexiones)
+    registro.calibre("prueba_rota", "Falla al leerse", lambda: 1 / 0)
+    return registro
+
+def test_exportar_suma_las_instantaneas_de_otros_procesos():
+    uno, otro = registro_con([0.002, 0.2], 3), registro_con([0.2, 7.0, 50.0], 4)
+    texto = uno.exportar([json.loads(json.dumps(otro.instantanea()))])
+    assert 'prueba_segundos_bucket{ruta="/",le="0.0025"} 1' in texto
+    assert 'prueba_segundos_bucket{ruta="/",le="0.25"} 3' in texto
+    assert 'prueba_segundos_bucket{ruta="/",le="+Inf"} 5' in texto
+    assert 'prueba_segundos_count{ruta="/"} 5' in texto and 'prueba_segundos_sum{ruta="/"} 57.402000' in texto
+    assert 'prueba_total{estado="200"} 5' in texto and "prueba_conexiones 7" in texto and "prueba_rota" not in texto
+    assert uno.exportar() == uno.exportar([])
+
+def test_ignora_trabajadores_que_dejaron_de_publicar(tmp_path):
+    propio = MetricasCompartidas(str(tmp_path), registro_con([0.1], 1), intervalo=1)
+    propio.iniciar()
+    try:
+        for pid, antiguedad in ((101, 0), (102, 10)):
+            ruta = tmp_path / f"{pid}.json"
+            ruta.write_text(json.dumps({"pid": pid, **registro_con([0.1], 1).instantanea()}))
+            os.utime(ruta, (time.time() - antiguedad,) * 2)
+        (tmp_path / "103.json").write_text("{a medias")
+        assert "prueba_conexiones 2" in propio.exportar()
+        assert propio.metricas()["trabajadores"] == sorted([os.getpid(), 101])
+    finally:
+        propio.detener()
+    assert not (tmp_path / f"{os.getpid()}.json").exists()
@@ -0,0 +1,43 @@
+# Análisis de colores por zonas: tablas de áreas sumadas frente a conteos directos y mapa de manchas
+import numpy as np
+from procesamiento_imagen import TablasIntegrales, analizar_colores_hongos, analizar_colores_por_zonas, MASCARAS
+
+VERDE, MARRON = (60, 140, 50), (120, 80, 40)
+
+def mascaras_directas(img):
+    r, g, b = (img[:, :, k].astype(int) for k in range(3))
+    lum = (77 * r + 150 * g + 29 * b) >> 8
+    return np.stack([lum < 60, (r > 80) & (r < 150) & (g > 50) & (g < 120) & (b < 80), (r > 180) & (g > 180) & (b < 120)])
+
+def test_cualquier_rectangulo_coincide_con_el_conteo_directo():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (301, 457, 3), dtype=np.uint8)
+    tablas, mascaras = TablasIntegrales(img), mascaras_directas(img)
+    for _ in range(200):
+        y0, y1 = sorted(rng.integers(0, 302, 2))
+        x0, x1 = sorted(rng.integers(0, 458, 2))
+        assert tablas.contar(y0, x0, y1, x1).tolist() == mascaras[:, y0:y1, x0:x1].sum(axis=(1, 2)).tolist()
+
+def test_el_resultado_global_no_cambia():
+    img = np.random.default_rng(1).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    global_, por_zonas = analizar_colores_hongos(img), analizar_colores_por_zonas(img)
+    assert por_zonas["score"] == global_["score"]
+    for k in MASCARAS: assert abs(por_zonas["detalles"][k] - global_["detalles"][k]) < 1e-9
+
+def test_una_mancha_pequena_aparece_en_el_mapa():
+    img = np.empty((800, 1200, 3), dtype=np.uint8)
+    img[:] = VERDE
+    img[500:560, 900:960] = MARRON  # 0,4 % de la hoja: invisible en el score global
+    r = analizar_colores_por_zonas(img, rejilla=8)
+    zonas = r["zonas"]
+    assert r["score"] == 0 and (zonas["filas"], zonas["columnas"]) == (8, 8)
+    assert zonas["mapa"][5][6] == 40 and sum(map(sum, zonas["mapa"])) == 40
+    assert zonas["densidades"]["marrones"][5][6] > 3
+    # La peor ventana se busca a saltos de media zona: contiene la mancha entera
+    x0, y0, x1, y1 = zonas["peor"]["caja"]
+    assert x0 * 1200 <= 900 and x1 * 1200 >= 960 and y0 * 800 <= 500 and y1 * 800 >= 560
+    assert zonas["peor"]["score"] == 40
+
+def test_imagen_mas_pequena_que_la_rejilla():
+    zonas = analizar_colores_por_zonas(np.zeros((3, 5, 3), dtype=np.uint8), rejilla=8)["zonas"]
+    assert (zonas["filas"], zonas["columnas"]) == (3, 5) and zonas["mapa"] == [[35] * 5] * 3
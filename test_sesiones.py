@@ -0,0 +1,72 @@
+# Tokens de sesión: firma, expiración y revocación, con la lista de revocados en SQLite
+import asyncio
+import time
+import pytest
+from base_datos_sqlite import BaseDatosSQLite
+from configuracion import ADMIN_USUARIO
+from sesiones import Sesiones, TokenInvalidoError, MiddlewareSesiones
+
+@pytest.fixture
+def db(tmp_path):
+    base = BaseDatosSQLite(str(tmp_path / "mayaflora.db"))
+    yield base
+    base.cerrar()
+
+@pytest.fixture
+def sesiones(db):
+    return Sesiones(db, secreto="prueba", duracion=60)
+
+def test_token_valido_lleva_usuario_y_rol(sesiones):
+    token, _ = sesiones.emitir(7, "ana")
+    datos = sesiones.verificar(token)
+    assert (datos["uid"], datos["nombre"], datos["rol"]) == (7, "ana", "usuario")
+    assert sesiones.verificar(sesiones.emitir(1, ADMIN_USUARIO)[0])["rol"] == "admin"
+
+def test_token_alterado_o_de_otro_secreto_se_rechaza(sesiones, db):
+    token, _ = sesiones.emitir(7, "ana")
+    cuerpo, _, firma = token.partition(".")
+    otro, _ = sesiones.emitir(1, ADMIN_USUARIO)
+    with pytest.raises(TokenInvalidoError): sesiones.verificar(f"{otro.partition('.')[0]}.{firma}")
+    with pytest.raises(TokenInvalidoError): sesiones.verificar(cuerpo)
+    with pytest.raises(TokenInvalidoError): Sesiones(db, secreto="otro").verificar(token)
+
+def test_token_expirado(db):
+    token, _ = Sesiones(db, secreto="prueba", duracion=-1).emitir(7, "ana")
+    with pytest.raises(TokenInvalidoError, match="expirada"): Sesiones(db, secreto="prueba").verificar(token)
+
+def test_revocar_token_llega_a_otras_instancias_al_recargar(sesiones, db):
+    token, datos = sesiones.emitir(7, "ana")
+    otra = Sesiones(db, secreto="prueba")
+    otra.recargar()
+    assert otra.verificar(token)
+    sesiones.revocar(datos)
+    with pytest.raises(TokenInvalidoError, match="revocada"): sesiones.verificar(token)
+    otra.recargar()
+    with pytest.raises(TokenInvalidoError, match="revocada"): otra.verificar(token)
+
+def test_revocar_usuario_solo_afecta_tokens_anteriores(sesiones):
+    anterior, _ = sesiones.emitir(7, "ana")
+    sesiones.revocar_usuario(7)
+    time.sleep(0.01)
+    posterior, _ = sesiones.emitir(7, "ana")
+    with pytest.raises(TokenInvalidoError): sesiones.verificar(anterior)
+    assert sesiones.verificar(posterior)["uid"] == 7
+
+def test_variantes_del_nombre_admin_no_se_registran_ni_son_admin(sesiones, db):
+    for variante in (ADMIN_USUARIO.upper(), ADMIN_USUARIO.capitalize(), ADMIN_USUARIO):
+        assert not db.crear_usuario(variante, "x")["exito"]
+    assert sesiones.verificar(sesiones.emitir(9, ADMIN_USUARIO.upper())[0])["rol"] == "usuario"
+
+def test_token_invalido_no_impide_login_ni_registro(sesiones, db):
+    async def pedir(ruta, token):
+        llegadas, enviados = [], []
+        async def app(scope, receive, send): llegadas.append(scope["state"]["sesion"])
+        async def send(mensaje): enviados.append(mensaje)
+        scope = {"type": "http", "method": "POST", "path": ruta, "headers": [(b"authorization", f"Bearer {token}".encode())]}
+        await MiddlewareSesiones(app, sesiones, obligatoria=True)(scope, None, send)
+        return llegadas, enviados
+    caducado, _ = Sesiones(db, secreto="prueba", duracion=-1).emitir(7, "ana")
+    for ruta in ("/api/login", "/api/registro"):
+        assert asyncio.run(pedir(ruta, caducado)) == ([None], [])
+    llegadas, enviados = asyncio.run(pedir("/api/historial/7", caducado))
+    assert llegadas == [] and enviados[0]["status"] == 401